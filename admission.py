@@ -0,0 +1,177 @@
+"""
+Admission control. Each class of routes gets its own concurrency limit and
+bounded wait queue, so a burst of slow model calls cannot take the workers
+that page views need. A request that finds its class's queue full, or waits
+longer than the class allows, is answered at once with 503 and Retry-After.
+"""
+import os
+import threading
+import time
+from flask import g, request
+
+# Load balancers and probes must always get through
+EXEMPT_ENDPOINTS = {"health", "ready", "metrics_route", "static", "asset_route"}
+
+
+class Limit:  # pylint: disable=too-many-instance-attributes
+    "At most concurrency requests of a class at once, and queue more waiting up to wait seconds"
+
+    def __init__(self, concurrency, queue, wait=1.0, retry_after=1, clock=time.monotonic):
+        self.concurrency = concurrency
+        self.queue = queue
+        self.wait = wait
+        self.retry_after = retry_after
+        self.clock = clock
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.shed = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        "Take a slot, waiting in the queue if there is room, returning whether one was taken"
+        with self._condition:
+            if self.active >= self.concurrency:
+                if self.waiting >= self.queue:
+                    self.shed += 1
+                    return False
+                self.waiting += 1
+                deadline = self.clock() + self.wait
+                try:
+                    while self.active >= self.concurrency:
+                        remaining = deadline - self.clock()
+                        if remaining <= 0:
+                            self.shed += 1
+                            return False
+                        self._condition.wait(remaining)
+                finally:
+                    self.waiting -= 1
+            self.active += 1
+            self.admitted += 1
+            return True
+
+    def release(self):
+        "Give a slot back to the next request in the queue"
+        with self._condition:
+            self.active -= 1
+            self._condition.notify()
+
+    def saturation(self):
+        "How full the slots and the queue are together, 1.0 when the next request is shed"
+        return (self.active + self.waiting) / max(self.concurrency + self.queue, 1)
+
+    def stats(self):
+        "Counters for /health, /ready and /metrics"
+        with self._condition:
+            return {
+                "Active": self.active,
+                "Waiting": self.waiting,
+                "Concurrency": self.concurrency,
+                "Queue": self.queue,
+                "Admitted": self.admitted,
+                "Shed": self.shed,
+                "Saturation": round(self.saturation(), 3)
+            }
+
+def limit_from_env(name, concurrency, queue, wait=1.0, retry_after=1):
+    "A Limit with settings from ADMIT_<NAME>_CONCURRENCY, _QUEUE, _WAIT and _RETRY_AFTER"
+    prefix = f"ADMIT_{name.upper()}"
+    return Limit(
+        int(os.getenv(f"{prefix}_CONCURRENCY", str(concurrency))),
+        int(os.getenv(f"{prefix}_QUEUE", str(queue))),
+        float(os.getenv(f"{prefix}_WAIT", str(wait))),
+        int(os.getenv(f"{prefix}_RETRY_AFTER", str(retry_after)))
+    )
+
+
+class Admission:
+    "The Limit of every class of routes, and which endpoints belong to which class"
+
+    def __init__(self, limits, routes=None, default=None):
+        self.limits = limits
+        self.routes = routes or {}
+        self.default = default
+
+    def limit_for(self, endpoint):
+        "The Limit an endpoint is admitted by, or None"
+        if endpoint is None or endpoint in EXEMPT_ENDPOINTS:
+            return None
+        return self.limits.get(self.routes.get(endpoint, self.default))
+
+    def stats(self):
+        "The counters of every class"
+        return {name: limit.stats() for name, limit in self.limits.items()}
+
+    def health(self):
+        """
+        The load report for /health and /ready and whether to report ready: a
+        full queue means this worker is shedding, so the balancer should prefer
+        others. Only /ready reports that with a 503, a busy worker is still alive
+        """
+        classes = self.stats()
+        overloaded = [name for name, limit in self.limits.items() if limit.saturation() >= 1.0]
+        report = {
+            "Status": "overloaded" if overloaded else "ok",
+            "Saturation": max((stats["Saturation"] for stats in classes.values()), default=0.0),
+            "QueueDepth": sum(stats["Waiting"] for stats in classes.values()),
+            "Classes": classes
+        }
+        return report, not overloaded
+
+
+def release_after(body, release):
+    "Pass a streamed body through, calling release once it is finished or abandoned"
+    try:
+        yield from body
+    finally:
+        release()
+        close = getattr(body, "close", None)
+        if close is not None:
+            close()
+
+def init_admission(app, admission, registry=None):
+    "Admit every request of a Flask app through its class's Limit"
+    if registry is not None:
+        registry.add_stats("admission", "class", admission.limits)
+
+    @app.before_request
+    def admit():
+        limit = admission.limit_for(request.endpoint)
+        if limit is None:
+            return None
+        if not limit.acquire():
+            response = app.response_class(
+                '{"Error": "Too busy, try again shortly"}', status=503, mimetype="application/json"
+            )
+            response.headers["Retry-After"] = str(limit.retry_after)
+            return response
+        released = []
+
+        def release():
+            # Once only, whether the body finished streaming or the request failed first
+            if not released:
+                released.append(True)
+                limit.release()
+        g.admission_release = release
+        return None
+
+    @app.after_request
+    def release_when_sent(response):
+        release = g.pop("admission_release", None)
+        if release is None:
+            return response
+        if response.is_streamed:
+            # A streamed body does its work as it is sent, so it keeps the slot until then
+            response.response = release_after(response.response, release)
+            response.call_on_close(release)
+        else:
+            release()
+        return response
+
+    @app.teardown_request
+    def release_on_error(_error):
+        release = g.pop("admission_release", None)
+        if release is not None:
+            release()
+
+    return admission
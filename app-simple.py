@@ -1,14 +1,26 @@
-from flask import Flask, render_template_string, request, jsonify
+from flask import Flask, render_template, request, jsonify
+from jinja2 import ChoiceLoader, DictLoader
 import datetime
 import random
 import os
 import socket
+from admission import Admission, init_admission, limit_from_env
+from metrics import instrument
+from state import open_state
+from templating import jinja_options
 
 app = Flask(__name__)
-
-# In-memory storage for demo purposes
-todos = []
-visit_counter = 0
+# Before the first use of app.jinja_env, which is created from these
+app.jinja_options = jinja_options(app)
+# Per-route timings at /metrics, profiling with X-Profile: $PROFILE_TOKEN
+metrics = instrument(app, profile_token=os.getenv("PROFILE_TOKEN"))
+# Requests beyond what a worker can serve are shed with a 503 instead of queueing unseen
+admission = init_admission(app, Admission({
+    "pages": limit_from_env("pages", concurrency=64, queue=128)
+}, default="pages"), registry=metrics)
+
+# Todos and visits, per process or shared by the workers, see STATE_BACKEND
+state = open_state()
 
 # HTML Templates
 HOME_TEMPLATE = '''
@@ -58,7 +70,7 @@ HOME_TEMPLATE = '''
                 <div class="todo-item">
                     ✅ {{ todo.text }} 
                     <small>(Added: {{ todo.timestamp }})</small>
-                    <a href="/delete_todo/{{ loop.index0 }}" style="color: #ff6b6b; text-decoration: none; float: right;">❌</a>
+                    <a href="/delete_todo/{{ todo.id }}" style="color: #ff6b6b; text-decoration: none; float: right;">❌</a>
                 </div>
                 {% endfor %}
             </div>
@@ -90,6 +102,7 @@ HOME_TEMPLATE = '''
                 <li><a href="/api/random" style="color: #87CEEB;">/api/random</a> - Random Number</li>
                 <li><a href="/api/todos" style="color: #87CEEB;">/api/todos</a> - Todos as JSON</li>
                 <li><a href="/health" style="color: #87CEEB;">/health</a> - Health Check</li>
+                <li><a href="/ready" style="color: #87CEEB;">/ready</a> - Readiness Check</li>
             </ul>
         </div>
     </div>
@@ -121,34 +134,36 @@ QUOTES = [
     "If you are working on something that you really care about, you don't have to be pushed. - Steve Jobs"
 ]
 
+# Serve HOME_TEMPLATE through the loader, so it is compiled once and cached
+app.jinja_env.loader = ChoiceLoader([DictLoader({"home.html": HOME_TEMPLATE}), app.jinja_env.loader])
+
+PYTHON_VERSION = ".".join(str(part) for part in os.sys.version_info[:3])
+
+def render_home(result=None, visits=None):
+    "The home page, with the result of a calculation if there is one"
+    return render_template("home.html",
+                           hostname=socket.gethostname(),
+                           current_time=datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                           visits=state.visits() if visits is None else visits,
+                           python_version=PYTHON_VERSION,
+                           quote=random.choice(QUOTES),
+                           todos=state.todos(),
+                           result=result)
+
 @app.route('/')
 def home():
-    global visit_counter
-    visit_counter += 1
-    
-    return render_template_string(HOME_TEMPLATE, 
-                                hostname=socket.gethostname(),
-                                current_time=datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                                visits=visit_counter,
-                                python_version=f"{os.sys.version_info.major}.{os.sys.version_info.minor}.{os.sys.version_info.micro}",
-                                quote=random.choice(QUOTES),
-                                todos=todos,
-                                result=None)
+    return render_home(visits=state.visit())
 
 @app.route('/add_todo', methods=['POST'])
 def add_todo():
     todo_text = request.form.get('todo')
     if todo_text:
-        todos.append({
-            'text': todo_text,
-            'timestamp': datetime.datetime.now().strftime("%H:%M:%S")
-        })
+        state.add_todo(todo_text)
     return home()
 
-@app.route('/delete_todo/<int:index>')
-def delete_todo(index):
-    if 0 <= index < len(todos):
-        todos.pop(index)
+@app.route('/delete_todo/<int:todo_id>')
+def delete_todo(todo_id):
+    state.delete_todo(todo_id)
     return home()
 
 @app.route('/calculate', methods=['POST'])
@@ -172,23 +187,9 @@ def calculate():
         else:
             result = "Error: Invalid operation!"
             
-        return render_template_string(HOME_TEMPLATE, 
-                                    hostname=socket.gethostname(),
-                                    current_time=datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                                    visits=visit_counter,
-                                    python_version=f"{os.sys.version_info.major}.{os.sys.version_info.minor}.{os.sys.version_info.micro}",
-                                    quote=random.choice(QUOTES),
-                                    todos=todos,
-                                    result=result)
+        return render_home(result)
     except ValueError:
-        return render_template_string(HOME_TEMPLATE, 
-                                    hostname=socket.gethostname(),
-                                    current_time=datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                                    visits=visit_counter,
-                                    python_version=f"{os.sys.version_info.major}.{os.sys.version_info.minor}.{os.sys.version_info.micro}",
-                                    quote=random.choice(QUOTES),
-                                    todos=todos,
-                                    result="Error: Invalid numbers!")
+        return render_home("Error: Invalid numbers!")
 
 # API Endpoints
 @app.route('/api/status')
@@ -198,7 +199,7 @@ def api_status():
         "message": "Flask app is running successfully",
         "hostname": socket.gethostname(),
         "timestamp": datetime.datetime.now().isoformat(),
-        "visits": visit_counter
+        "visits": state.visits()
     })
 
 @app.route('/api/random')
@@ -217,20 +218,35 @@ def api_quote():
 
 @app.route('/api/todos')
 def api_todos():
+    todos = state.todos()
     return jsonify({
         "todos": todos,
         "count": len(todos),
         "timestamp": datetime.datetime.now().isoformat()
     })
 
+def load_report(load, is_ready):
+    "The health and readiness body"
+    return {
+        "status": "healthy" if is_ready else "overloaded",
+        "message": "Flask app is running successfully" if is_ready else "Shedding requests",
+        "uptime": "Running in Kubernetes",
+        "hostname": socket.gethostname(),
+        "queue_depth": load["QueueDepth"],
+        "saturation": load["Saturation"],
+        "load": load["Classes"]
+    }
+
 @app.route('/health')
 def health():
-    return jsonify({
-        "status": "healthy", 
-        "message": "Flask app is running successfully",
-        "uptime": "Running in Kubernetes",
-        "hostname": socket.gethostname()
-    })
+    # Liveness: a busy worker is still alive, so this stays 200 while shedding
+    return jsonify(load_report(*admission.health()))
+
+@app.route('/ready')
+def ready():
+    "Readiness: 503 while shedding, so the balancer sends requests elsewhere"
+    load, is_ready = admission.health()
+    return jsonify(load_report(load, is_ready)), 200 if is_ready else 503
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000, debug=True)
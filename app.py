@@ -1,87 +1,421 @@
 "City Info App"
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+import contextvars
+import hashlib
+import heapq
+import json
 import os
 #import math
-from urllib.parse import urlparse
-import boto3
-from flask import Flask, render_template, request
+import time
+from flask import Flask, abort, render_template, request, stream_template
 from markupsafe import Markup
+from admission import Admission, init_admission, limit_from_env
+from assets import init_assets
+from aws_helpers import decode_cursor, encode_cursor
+from cache import TTLCache
+from compression import init_compression  # pylint: disable=wrong-import-order
+from metrics import instrument
+from search import CityIndex
+from snapshot import SnapshotStore
+from storage import BATCH_GET_SIZE, open_store
+from templating import jinja_options, relative_url
 
 app = Flask(__name__)
-dynamodb = boto3.resource('dynamodb')
-cities_table = dynamodb.Table('Cities')
-reviews_table = dynamodb.Table('CityReviews')
+# Before the first use of app.jinja_env, which is created from these
+app.jinja_options = jinja_options(app)
+# DynamoDB in AWS, SQLite or memory locally, see STORAGE_BACKEND
+store = open_store()
+# A catalogue snapshot (see snapshot.py) is mapped before gunicorn forks, if
+# preloading, and its pages are shared by every worker instead of each one
+# caching the catalogue; a rebuilt snapshot is picked up without a restart
+if os.getenv("CATALOGUE_SNAPSHOT"):
+    store = SnapshotStore(
+        os.getenv("CATALOGUE_SNAPSHOT"), store,
+        check_interval=float(os.getenv("SNAPSHOT_CHECK_INTERVAL", "5")),
+        on_swap=lambda: invalidate_cities()  # pylint: disable=unnecessary-lambda
+    )
+
+# The catalogue only changes a few times a day, so keep it in memory
+cities_cache = TTLCache(
+    ttl=int(os.getenv("CITIES_CACHE_TTL", "300")),
+    maxsize=int(os.getenv("CITIES_CACHE_SIZE", "1024"))
+)
+# Rendered city pages, keyed by city name and query, identified by a content hash
+page_cache = TTLCache(
+    ttl=int(os.getenv("PAGE_CACHE_TTL", "300")),
+    maxsize=int(os.getenv("PAGE_CACHE_SIZE", "512"))
+)
+# How long browsers and the CDN may reuse a city page without revalidating
+PAGE_MAX_AGE = int(os.getenv("PAGE_MAX_AGE", "60"))
+CITIES_PAGE_SIZE = int(os.getenv("CITIES_PAGE_SIZE", "50"))
+
+REVIEWS_PAGE_SIZE = int(os.getenv("REVIEWS_PAGE_SIZE", "20"))
+TOP_REVIEWS = int(os.getenv("TOP_REVIEWS", "10"))
+
+# Autocomplete over city and country names, built from the cached catalogue
+city_index = CityIndex()
+SEARCH_LIMIT = int(os.getenv("SEARCH_LIMIT", "10"))
+# Cities read per call while loading the catalogue for the search index
+CITY_INDEX_PAGE_SIZE = 1000
+# Most cities one /api/cities/batch request may ask for
+BATCH_MAX_CITIES = int(os.getenv("BATCH_MAX_CITIES", "1000"))
+
+# Bounded pool shared by all requests for backend lookups that can overlap
+backend_pool = ThreadPoolExecutor(
+    max_workers=int(os.getenv("BACKEND_WORKERS", "16")),
+    thread_name_prefix="backend"
+)
+# Batch lookups get their own pool, so big batches cannot take the page views' threads
+batch_pool = ThreadPoolExecutor(
+    max_workers=int(os.getenv("BATCH_WORKERS", "4")),
+    thread_name_prefix="batch"
+)
+# Seconds a city page may spend waiting on the data store
+CITY_PAGE_DEADLINE = float(os.getenv("CITY_PAGE_DEADLINE", "2.0"))
+# Seconds a batch may spend waiting on the data store, chunks after that come back as errors
+BATCH_DEADLINE = float(os.getenv("BATCH_DEADLINE", "5.0"))
 
 def nl2br(value):
     "Custom filter to replace newlines with <br> tags"
     return Markup(value.replace("\n", "<br>"))
 
-def relative_url(endpoint):
-    "Build a relative URL from an absolute path"
-    start_dir = os.path.dirname(urlparse(request.url).path)
-    relative_path = os.path.relpath(endpoint, start=start_dir)
-    return relative_path
-
 # Register the custom filters with Flask
 app.jinja_env.filters['nl2br'] = nl2br
 app.jinja_env.filters['relative_url'] = relative_url
 
+# Fingerprinted static files with year-long caching, asset_url() in templates
+init_assets(app)
+
+# gzip or br for HTML and JSON, registered before instrument() so it runs last
+init_compression(app, min_size=int(os.getenv("COMPRESS_MIN_SIZE", "1024")))
+
+# Per-route timings and cache counters at /metrics, profiling with X-Profile: $PROFILE_TOKEN
+metrics = instrument(
+    app,
+    caches={"cities": cities_cache, "pages": page_cache},
+    profile_token=os.getenv("PROFILE_TOKEN")
+)
+
+# Batches queue apart from the pages, so a few big ones cannot hold up page views
+admission = init_admission(app, Admission({
+    "pages": limit_from_env("pages", concurrency=64, queue=128),
+    "batch": limit_from_env("batch", concurrency=4, queue=8, wait=2.0, retry_after=2)
+}, routes={"batch_route": "batch"}, default="pages"), registry=metrics)
+
+def load_catalogue(key, loader):
+    "Load catalogue data through the cache, unless the store shares it between workers already"
+    if store.shared_catalogue:
+        return loader()
+    return cities_cache.get_or_load(key, loader)
+
 def load_cities():
-    "Load all the cities from the data store"
-    results = []
-    response = cities_table.scan()
-    for item in response['Items']:
-        city = {
-            "Name": item['CityName'],
-            "CountryCode": item['CountryCode'],
-            "CountryName": item['CountryName'],
-            "TopThingsToDo": item['TopThingsToDo'],
-            "Itinerary": item['Itinerary']
-        }
-        results.append(city)
-    return results
+    "Load the name and country of every city, from the cache if possible"
+    # Cached even with a shared catalogue, the search index goes by the cached list
+    return cities_cache.get_or_load(("cities",), fetch_cities)
+
+def load_cities_page(cursor=None):
+    "Load one page of city links, from the cache if possible"
+    return load_catalogue(("page", cursor), lambda: fetch_cities_page(cursor))
 
 def load_city(name):
+    "Load a single city, from the cache if possible"
+    return load_catalogue(("city", name), lambda: fetch_city(name))
+
+def invalidate_cities(name=None):
+    "Drop cached catalogue data and pages after the Cities table changes"
+    if name is None:
+        cities_cache.invalidate()
+        page_cache.invalidate()
+        city_index.mark_stale()
+    else:
+        cities_cache.invalidate(("cities",))
+        cities_cache.invalidate_prefix(("page",))
+        cities_cache.invalidate(("city", name))
+        invalidate_city_pages(name)
+        reindex_city(name)
+
+def load_city_index():
+    """
+    The search index, resynced whenever the cached catalogue it was built
+    from expires or is dropped, so it follows changes made by other workers
+    and loads outside the app
+    """
+    if city_index.source is not None and cities_cache.get(("cities",)) is not city_index.source:
+        city_index.mark_stale()
+    return city_index.ensure(load_cities)
+
+def reindex_city(name):
+    "Bring one city's index entry up to date after it changed"
+    if city_index.stale:
+        return
+    city = load_city(name)
+    if city:
+        city_index.add(city)
+    else:
+        city_index.remove(name)
+
+def invalidate_city_pages(name):
+    "Drop the rendered pages of a city after its data or reviews change"
+    page_cache.invalidate_prefix((name,))
+
+def fetch_cities():
+    "Load the name and country of every city from the data store"
+    links, cursor = store.cities_page(CITY_INDEX_PAGE_SIZE)
+    while cursor:
+        page, cursor = store.cities_page(CITY_INDEX_PAGE_SIZE, cursor)
+        links.extend(page)
+    return links
+
+def fetch_cities_page(cursor=None):
+    "Load one page of city links from the data store"
+    return store.cities_page(CITIES_PAGE_SIZE, cursor)
+
+def fetch_city(name):
     "Load a city name and country code"
-    response = cities_table.query(
-        KeyConditionExpression=boto3.dynamodb.conditions.Key('CityName').eq(name)
-    )
-    if response['Items']:
-        item = response['Items'][0]
-        return {
-            "Name": item['CityName'],
-            "CountryCode": item['CountryCode'],
-            "CountryName": item['CountryName'],
-            "TopThingsToDo": item['TopThingsToDo'],
-            "Itinerary": item['Itinerary']
-        }
-    return None
+    return store.get_city(name)
 
 
-def load_city_reviews(name):
-    "load reviews for a city"
-    results = []
-    response = reviews_table.query(
-        KeyConditionExpression=boto3.dynamodb.conditions.Key('CityName').eq(name)
-    )
-    for item in response['Items']:
-        review = {
-            "ReviewContent": item['ReviewContent'],
-            "Stars": int(item['Stars'])
-        }
-        results.append(review)
-    return results
+def load_city_reviews(name, cursor=None, order="recent"):
+    """
+    Load reviews for a city. "recent" returns one page, newest ReviewId first,
+    plus the cursor for the next page. "top" returns the best TOP_REVIEWS reviews.
+    """
+    if order == "top":
+        return load_top_reviews(name), None
+    return store.reviews_page(name, REVIEWS_PAGE_SIZE, cursor)
+
+def load_top_reviews(name):
+    "Load the highest rated reviews for a city, from the cache if possible"
+    return cities_cache.get_or_load(("top", name), lambda: fetch_top_reviews(name))
+
+def fetch_top_reviews(name):
+    "Stream every review for a city, keeping only the best TOP_REVIEWS"
+    return heapq.nlargest(TOP_REVIEWS, store.iter_reviews(name), key=review_stars)
+
+def review_stars(review):
+    "Sort key for reviews"
+    return review['Stars']
+
+def load_review_stats(name):
+    "Load the precomputed rating aggregate for a city"
+    return summarize_stats(store.review_stats(name))
+
+def summarize_stats(stats):
+    "The rating summary the templates and the API show, from a stored aggregate"
+    if not stats or not stats['ReviewCount']:
+        return None
+    count = stats['ReviewCount']
+    histogram = []
+    for stars in range(5, 0, -1):
+        votes = stats[f'Stars{stars}']
+        histogram.append({"Stars": stars, "Count": votes, "Percent": round(100 * votes / count)})
+    return {
+        "Count": count,
+        "Mean": round(stats['StarTotal'] / count, 1),
+        "Histogram": histogram
+    }
+
+def record_review(name, review_id, content, stars):
+    "Save a new review and fold it into the city's rating aggregate"
+    store.add_review(name, review_id, content, stars)
+    cities_cache.invalidate(("top", name))
+    invalidate_city_pages(name)
+
+def rebuild_review_stats(name):
+    "Recompute a city's aggregate from all of its reviews, to backfill the stats"
+    store.rebuild_review_stats(name)
+    cities_cache.invalidate(("top", name))
+    invalidate_city_pages(name)
+
+def submit(func, *args, pool=backend_pool):
+    "Run a backend lookup on a pool, the shared one by default, in the request's metrics context"
+    return pool.submit(contextvars.copy_context().run, func, *args)
+
+# Marks a lookup that missed its deadline
+MISSED = object()
+
+def wait_for(future, deadline, default=None):
+    "Wait for a backend lookup until the deadline, falling back to default if it misses it or fails"
+    try:
+        return future.result(timeout=max(deadline - time.monotonic(), 0))
+    except FutureTimeout:
+        future.cancel()
+        return default
+    except Exception:  # pylint: disable=broad-except
+        app.logger.exception("Backend lookup failed")
+        return default
+
+def checked_cursor(cursor, names, **values):
+    """
+    A cursor from the query string in canonical form, so it can be part of a
+    cache key. Aborts with 400 unless it decodes to a key of exactly the
+    attributes names, all strings, matching any values given.
+    """
+    if not cursor:
+        return None
+    key = decode_cursor(cursor)
+    if (not key or set(key) != set(names)
+            or not all(isinstance(value, str) for value in key.values())
+            or any(key[name] != value for name, value in values.items())):
+        abort(400)
+    return encode_cursor(key)
 
 @app.route('/')
 def home_route():
     "Select a city homepage"
-    cities = load_cities()
-    return render_template('index.html', cities=cities)
+    cursor = checked_cursor(request.args.get('page'), ("CityName",))
+    cities, next_cursor = load_cities_page(cursor)
+    return stream_template(
+        'index.html', cities=cities, cursor=cursor, next_cursor=next_cursor, search=True
+    )
 
 @app.route('/city/<name>')
 def city_route(name):
-    "Render a city page"
-    city = load_city(name)
+    "Render a city page, serving repeat visits from the page cache"
+    order = "top" if request.args.get('sort') == "top" else "recent"
+    # The top reviews are one page, so only recent ones have cursors
+    cursor = None if order == "top" else \
+        checked_cursor(request.args.get('reviews'), ("CityName", "ReviewId"), CityName=name)
+    page = page_cache.get_or_load(
+        (name, order, cursor),
+        lambda: render_city_page(name, cursor, order),
+        keep=lambda page: page["Complete"]
+    )
+    response = app.response_class(page["Body"], status=page["Status"], mimetype='text/html')
+    if not page["Complete"]:
+        return response
+    response.set_etag(page["ETag"])
+    response.cache_control.public = True
+    response.cache_control.max_age = PAGE_MAX_AGE
+    return response.make_conditional(request)
+
+def render_city_page(name, cursor, order):
+    "Look up a city and render its page, noting whether it is safe to cache"
+    deadline = time.monotonic() + CITY_PAGE_DEADLINE
+    city_future = submit(load_city, name)
+    reviews_future = submit(load_city_reviews, name, cursor, order)
+    stats_future = submit(load_review_stats, name)
+    try:
+        city = city_future.result(timeout=deadline - time.monotonic())
+    except FutureTimeout:
+        reviews_future.cancel()
+        stats_future.cancel()
+        abort(504)
     if not city:
-        return render_template('404.html'), 404
-    reviews = load_city_reviews(name)
-    return render_template('city.html', city=city, reviews=reviews)
+        reviews_future.cancel()
+        stats_future.cancel()
+        return {"Body": render_template('404.html'), "Status": 404, "Complete": False}
+    # Render the city without its reviews rather than fail the page
+    reviews, next_cursor = wait_for(reviews_future, deadline, (None, None))
+    if reviews is None:
+        app.logger.warning("Reviews for %s missed the page deadline or failed", name)
+    stats = wait_for(stats_future, deadline, MISSED)
+    body = render_template(
+        'city.html',
+        city=city,
+        reviews=reviews,
+        stats=None if stats is MISSED else stats,
+        order=order,
+        cursor=cursor,
+        next_cursor=next_cursor
+    )
+    return {
+        "Body": body,
+        "Status": 200,
+        "ETag": hashlib.sha256(body.encode("utf-8")).hexdigest(),
+        "Complete": reviews is not None and stats is not MISSED
+    }
+
+@app.route('/api/cities/search')
+def search_route():
+    "Cities whose name or country matches the q parameter, for the autocomplete"
+    query = request.args.get('q', '')
+    return {"Query": query, "Cities": load_city_index().search(query, SEARCH_LIMIT)}
+
+@app.route('/api/cities/batch', methods=['GET', 'POST'])
+def batch_route():
+    """
+    Many cities at once, from ?name=A&name=B or a {"Names": [...]} body, as a
+    JSON array streamed in the order asked for. With stats=1 (or "Stats": true)
+    each city includes its rating summary. The cities of a chunk that failed
+    or missed BATCH_DEADLINE come back as {"Name": name, "Error": ...}, so the
+    array is always complete.
+    """
+    if request.method == 'POST':
+        body = request.get_json(silent=True)
+        if not isinstance(body, dict):
+            return {"Error": "The body must be a JSON object with a Names list"}, 400
+        names, with_stats = body.get("Names"), bool(body.get("Stats"))
+    else:
+        names, with_stats = request.args.getlist('name'), request.args.get('stats') in ('1', 'true')
+    if not isinstance(names, list) or not all(isinstance(name, str) for name in names):
+        return {"Error": "Names must be a list of city names"}, 400
+    names = list(dict.fromkeys(names))
+    if len(names) > BATCH_MAX_CITIES:
+        return {"Error": f"At most {BATCH_MAX_CITIES} cities per request"}, 400
+    chunks = [names[start:start + BATCH_GET_SIZE] for start in range(0, len(names), BATCH_GET_SIZE)]
+    futures = [submit(load_cities_batch, chunk, with_stats, pool=batch_pool) for chunk in chunks]
+    deadline = time.monotonic() + BATCH_DEADLINE
+
+    def generate():
+        try:
+            separator = ""
+            yield "["
+            for chunk, future in zip(chunks, futures):
+                cities = wait_for(future, deadline, MISSED)
+                if cities is MISSED:
+                    app.logger.warning(
+                        "A batch of %d cities missed the deadline or failed", len(chunk)
+                    )
+                for name in chunk:
+                    if cities is MISSED:
+                        city = {"Name": name, "Error": "The lookup failed or timed out"}
+                    else:
+                        city = cities.get(name) or {"Name": name, "Found": False}
+                    yield separator + json.dumps(city)
+                    separator = ","
+            yield "]"
+        finally:
+            for future in futures:
+                future.cancel()
+
+    return app.response_class(generate(), mimetype='application/json')
+
+def load_cities_batch(names, with_stats=False):
+    "Up to BATCH_GET_SIZE cities as {name: city}, with their rating summaries if asked"
+    cities = {}
+    for name in names:
+        city = cities_cache.get(("city", name))
+        if city:
+            cities[name] = city
+    # Not cached, so one big batch does not push the popular cities out
+    missing = [name for name in names if name not in cities]
+    if missing:
+        cities.update(store.get_cities(missing))
+    if with_stats:
+        stats = store.review_stats_many(list(cities))
+        cities = {
+            name: dict(city, Stats=summarize_stats(stats.get(name)))
+            for name, city in cities.items()
+        }
+    return cities
+
+@app.route('/health')
+def health():
+    "Liveness check with the load report, 200 whenever the worker answers, busy or not"
+    report, _ = admission.health()
+    return report
+
+@app.route('/ready')
+def ready():
+    "Readiness check, 503 while requests are being shed so the balancer prefers other workers"
+    report, is_ready = admission.health()
+    return report, 200 if is_ready else 503
+
+@app.route('/api/cache')
+def cache_route():
+    "Report the catalogue and page cache counters"
+    return {
+        "Cities": cities_cache.stats(),
+        "Pages": page_cache.stats()
+    }
@@ -0,0 +1,89 @@
+"""
+Fingerprinted static assets. asset_url() in the templates gives each file a
+URL containing a hash of its content, so it can be cached for a year, and
+the route serves the .br or .gz copy made by build_assets.py when the
+client accepts it. The copies carry the hash of the file they were made
+from, so a copy left over from an older version is never sent.
+"""
+import hashlib
+import mimetypes
+import os
+import threading
+from flask import abort, request, send_from_directory, url_for
+from werkzeug.security import safe_join
+from compression import choose_encoding  # pylint: disable=wrong-import-order
+
+# How long browsers and CDNs may keep a fingerprinted file
+ASSET_MAX_AGE = 365 * 24 * 3600
+
+PRECOMPRESSED = {"br": ".br", "gzip": ".gz"}
+
+def precompressed_path(path, digest, suffix):
+    "Where build_assets.py puts the copy of the version digest of a file"
+    return f"{path}.{digest}{suffix}"
+
+def file_digest(path):
+    "Short content hash of a file"
+    with open(path, "rb") as file:
+        return hashlib.sha256(file.read()).hexdigest()[:12]
+
+
+class AssetDigests:  # pylint: disable=too-few-public-methods
+    "Content hashes of the files in a static folder, computed once per file"
+
+    def __init__(self, folder):
+        self.folder = folder
+        self._digests = {}
+        self._lock = threading.Lock()
+
+    def digest(self, filename):
+        "The hash of a static file, or None if there is no such file"
+        digest = self._digests.get(filename)
+        if digest is None:
+            path = safe_join(self.folder, filename)
+            if path is None or not os.path.isfile(path):
+                return None
+            digest = file_digest(path)
+            with self._lock:
+                self._digests[filename] = digest
+        return digest
+
+
+def init_assets(app):
+    "Add the asset_url template helper and the /assets route to an app"
+    digests = AssetDigests(app.static_folder)
+
+    def asset_url(filename):
+        "URL of a static file that changes whenever the file does"
+        digest = digests.digest(filename)
+        if digest is None:
+            return url_for('static', filename=filename)
+        return url_for('asset_route', digest=digest, filename=filename)
+
+    @app.route('/assets/<digest>/<path:filename>')
+    def asset_route(digest, filename):
+        "Serve a fingerprinted file, precompressed when possible"
+        current = digests.digest(filename)
+        if current is None:
+            abort(404)
+        sent = filename
+        encoding = choose_encoding(request.accept_encodings)
+        if encoding and os.path.isfile(os.path.join(
+                app.static_folder, precompressed_path(filename, current, PRECOMPRESSED[encoding]))):
+            sent = precompressed_path(filename, current, PRECOMPRESSED[encoding])
+        else:
+            encoding = None
+        # An old page asking for an old version gets today's file, but must not keep it
+        response = send_from_directory(
+            app.static_folder, sent, mimetype=mimetypes.guess_type(filename)[0], conditional=True,
+            max_age=ASSET_MAX_AGE if digest == current else None
+        )
+        if digest == current:
+            response.cache_control.immutable = True
+        if encoding:
+            response.headers["Content-Encoding"] = encoding
+        response.vary.add("Accept-Encoding")
+        return response
+
+    app.jinja_env.globals['asset_url'] = asset_url
+    return asset_url
@@ -0,0 +1,100 @@
+"Helpers for paging through DynamoDB results and retrying AWS calls"
+import base64
+import json
+import random
+import time
+from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+from botocore.exceptions import BotoCoreError, ClientError
+
+_serializer = TypeSerializer()
+_deserializer = TypeDeserializer()
+
+def encode_cursor(key):
+    "Turn a LastEvaluatedKey into an opaque, URL safe cursor"
+    if not key:
+        return None
+    wire = {name: _serializer.serialize(value) for name, value in key.items()}
+    raw = json.dumps(wire, separators=(",", ":"), sort_keys=True).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+def decode_cursor(cursor):
+    "Turn a cursor back into an ExclusiveStartKey, None if it is invalid"
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        wire = json.loads(raw)
+        return {name: _deserializer.deserialize(value) for name, value in wire.items()}
+    except (ValueError, TypeError, AttributeError):
+        return None
+
+def iter_pages(operation, **kwargs):
+    "Yield each response of a scan or query, following LastEvaluatedKey"
+    while True:
+        response = operation(**kwargs)
+        yield response
+        last_key = response.get('LastEvaluatedKey')
+        if not last_key:
+            return
+        kwargs['ExclusiveStartKey'] = last_key
+
+def iter_items(operation, **kwargs):
+    "Yield every item of a scan or query, one page at a time"
+    for response in iter_pages(operation, **kwargs):
+        yield from response['Items']
+
+def read_page(operation, page_size, cursor=None, **kwargs):
+    "Read up to page_size items from a scan or query plus the cursor for the next page"
+    items = []
+    start_key = decode_cursor(cursor)
+    if start_key:
+        kwargs['ExclusiveStartKey'] = start_key
+    last_key = None
+    while len(items) < page_size:
+        response = operation(Limit=page_size - len(items), **kwargs)
+        items.extend(response['Items'])
+        last_key = response.get('LastEvaluatedKey')
+        if not last_key:
+            break
+        kwargs['ExclusiveStartKey'] = last_key
+    return items, encode_cursor(last_key)
+
+# Errors worth retrying: throttling and transient service faults
+RETRYABLE_ERRORS = {
+    "ProvisionedThroughputExceededException",
+    "ThrottlingException",
+    "RequestLimitExceeded",
+    "SlowDown",
+    "InternalError",
+    "InternalServerError",
+    "ServiceUnavailable",
+    "RequestTimeout"
+}
+
+def is_retryable(error):
+    "True for throttling, transient service errors and dropped connections"
+    if isinstance(error, ClientError):
+        return error.response.get("Error", {}).get("Code") in RETRYABLE_ERRORS
+    return isinstance(error, (BotoCoreError, ConnectionError))
+
+def backoff_delay(attempt, base_delay=0.1, max_delay=10.0):
+    "Exponential backoff with full jitter for the given attempt number"
+    return random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+
+# botocore retry settings for clients whose calls go through with_retries, so
+# the two retry layers do not multiply each other
+NO_CLIENT_RETRIES = {"mode": "standard", "total_max_attempts": 1}
+
+def with_retries(func, *args, attempts=5, base_delay=0.1, **kwargs):
+    """
+    Call func, retrying transient AWS errors with exponential backoff. The
+    client should not retry as well, see NO_CLIENT_RETRIES.
+    """
+    for attempt in range(attempts):
+        try:
+            return func(*args, **kwargs)
+        except Exception as error: # pylint: disable=broad-except
+            if attempt == attempts - 1 or not is_retryable(error):
+                raise
+            time.sleep(backoff_delay(attempt, base_delay))
+    return None
@@ -0,0 +1,67 @@
+"""
+Benchmark the city page against an in-memory store that adds artificial latency,
+comparing sequential lookups with the parallel fetch in city_route
+"""
+import argparse
+from concurrent.futures import Future
+import os
+from unittest.mock import patch
+
+os.environ.setdefault("STORAGE_BACKEND", "memory")
+
+# pylint: disable=wrong-import-position
+import app
+from benchlib import measure, print_report
+from storage import LatencyStore, MemoryStore
+
+CITY = {
+    "Name": "Bench-city",
+    "CountryCode": "BC",
+    "CountryName": "BenchCountry",
+    "TopThingsToDo": ["Walk", "Eat"],
+    "Itinerary": "Day one\nDay two"
+}
+
+REVIEWS = [("Bench-city", f"{n:04d}", f"Review {n}", 1 + n % 5) for n in range(20)]
+
+class InlineExecutor:  # pylint: disable=too-few-public-methods
+    "Runs submitted calls immediately, which is how city_route used to work"
+
+    def submit(self, func, *args):
+        "Run func now and wrap the result in a completed future"
+        future = Future()
+        try:
+            future.set_result(func(*args))
+        except Exception as error: # pylint: disable=broad-except
+            future.set_exception(error)
+        return future
+
+def main():
+    "Run the benchmark"
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds per query")
+    parser.add_argument("--jitter", type=float, default=0.005)
+    args = parser.parse_args()
+
+    # Every request has to go to the store
+    app.cities_cache.ttl = 0
+    app.page_cache.ttl = 0
+    tester = app.app.test_client()
+
+    def request_city():
+        response = tester.get('/city/Bench-city')
+        assert response.status_code == 200, response.status_code
+
+    results = {}
+    store = MemoryStore()
+    store.add_city(CITY)
+    store.add_reviews(REVIEWS)
+    with patch.object(app, 'store', LatencyStore(store, args.latency, args.jitter)):
+        with patch.object(app, 'backend_pool', InlineExecutor()):
+            results["sequential"] = measure(request_city, args.iterations)
+        results["parallel"] = measure(request_city, args.iterations)
+    print_report(results)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+"""
+Benchmark the knowledge base export, comparing one object per review with
+bundled documents, against stand-ins that add latency to every request
+"""
+import argparse
+import random
+import threading
+import time
+import dbb_reviews_to_s3 as export
+
+class SlowReviews:
+    "A reviews table whose scans and queries take latency seconds per page"
+
+    def __init__(self, reviews, latency, page_size=1000):
+        self.reviews = reviews
+        self.latency = latency
+        self.page_size = page_size
+        self.item_count = len(reviews)
+        self.by_city = {}
+        for review in reviews:
+            self.by_city.setdefault(review["CityName"], []).append(review)
+
+    #  pylint: disable=invalid-name
+    def scan(self, ExclusiveStartKey=None):
+        "One page of every review"
+        time.sleep(self.latency)
+        start = int(ExclusiveStartKey["ReviewId"]) + 1 if ExclusiveStartKey else 0
+        response = {"Items": self.reviews[start:start + self.page_size]}
+        if start + self.page_size < len(self.reviews):
+            response["LastEvaluatedKey"] = {"ReviewId": str(start + self.page_size - 1)}
+        return response
+
+    #  pylint: disable=invalid-name, unused-argument
+    def query(self, KeyConditionExpression, ProjectionExpression=None, ExclusiveStartKey=None):
+        "One page of a city's reviews"
+        time.sleep(self.latency)
+        city_name = KeyConditionExpression.get_expression()["values"][1]
+        reviews = self.by_city.get(city_name, [])
+        start = int(ExclusiveStartKey["Offset"]) if ExclusiveStartKey else 0
+        response = {"Items": reviews[start:start + self.page_size]}
+        if start + self.page_size < len(reviews):
+            response["LastEvaluatedKey"] = {"Offset": str(start + self.page_size)}
+        return response
+
+class SlowS3:
+    "Counts objects and sleeps latency seconds per request"
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.requests = 0
+        self.objects = set()
+        self._lock = threading.Lock()
+
+    def _request(self, key=None):
+        time.sleep(self.latency)
+        with self._lock:
+            self.requests += 1
+            if key:
+                self.objects.add(key)
+
+    #  pylint: disable=invalid-name, unused-argument
+    def put_object(self, Body, Bucket, Key):
+        "Write a whole object"
+        self._request(Key)
+
+    #  pylint: disable=invalid-name, unused-argument
+    def create_multipart_upload(self, Bucket, Key):
+        "Start a multipart upload"
+        self._request()
+        return {"UploadId": Key}
+
+    #  pylint: disable=invalid-name, unused-argument, too-many-arguments
+    def upload_part(self, Body, Bucket, Key, PartNumber, UploadId):
+        "Write one part"
+        self._request()
+        return {"ETag": str(PartNumber)}
+
+    #  pylint: disable=invalid-name, unused-argument
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        "Finish a multipart upload"
+        self._request(Key)
+
+    #  pylint: disable=invalid-name, unused-argument
+    def list_objects_v2(self, Bucket, Prefix="", ContinuationToken=None):
+        "List the keys under a prefix, up to 1000 per page like S3"
+        self._request()
+        with self._lock:
+            keys = sorted(key for key in self.objects if key.startswith(Prefix))
+        start = int(ContinuationToken or 0)
+        response = {"Contents": [{"Key": key} for key in keys[start:start + 1000]],
+                    "IsTruncated": start + 1000 < len(keys)}
+        if response["IsTruncated"]:
+            response["NextContinuationToken"] = str(start + 1000)
+        return response
+
+    #  pylint: disable=invalid-name, unused-argument
+    def delete_objects(self, Bucket, Delete):
+        "Delete a batch of objects"
+        self._request()
+        with self._lock:
+            self.objects.difference_update(item["Key"] for item in Delete["Objects"])
+
+def make_reviews(cities, per_city):
+    "Reviews of a few hundred bytes each"
+    words = ["great", "food", "museum", "walk", "river", "busy", "quiet", "view", "tram"]
+    return [
+        {
+            "CityName": f"City-{n % cities}",
+            "ReviewId": str(n),
+            "ReviewContent": " ".join(random.choices(words, k=60)),
+            "Stars": random.randint(1, 5)
+        }
+        for n in range(cities * per_city)
+    ]
+
+def main():
+    "Run the benchmark"
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--cities", type=int, default=20)
+    parser.add_argument("--reviews-per-city", type=int, default=250)
+    parser.add_argument("--latency", type=float, default=0.005, help="seconds per request")
+    parser.add_argument("--workers", type=int, default=16)
+    args = parser.parse_args()
+
+    reviews = make_reviews(args.cities, args.reviews_per_city)
+    table = SlowReviews(reviews, args.latency)
+    city_names = sorted({review["CityName"] for review in reviews})
+
+    per_review = SlowS3(args.latency)
+    began = time.perf_counter()
+    export.export_reviews(lambda: table, per_review, "bench", workers=args.workers)
+    per_review_time = time.perf_counter() - began
+
+    bundled = SlowS3(args.latency)
+    began = time.perf_counter()
+    export.export_bundles(lambda: table, bundled, "bench", city_names, workers=args.workers)
+    bundled_time = time.perf_counter() - began
+
+    print(f"{len(reviews)} reviews in {args.cities} cities")
+    print(f"{'layout':<14}{'objects':>10}{'requests':>10}{'seconds':>10}")
+    for name, s3, seconds in (("per review", per_review, per_review_time),
+                              ("bundled", bundled, bundled_time)):
+        print(f"{name:<14}{len(s3.objects):>10}{s3.requests:>10}{seconds:>10.2f}")
+
+if __name__ == '__main__':
+    main()
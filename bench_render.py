@@ -0,0 +1,70 @@
+"""
+Micro-benchmark of rendering the homepage with a large catalogue (10k city
+links by default): the old link list (url_for and relative_url per city),
+the same with the cheaper relative_url, and the current index.html, plus a
+cold template load with and without the bytecode cache
+"""
+import argparse
+import os
+from urllib.parse import urlparse
+from unittest.mock import patch
+
+os.environ.setdefault("STORAGE_BACKEND", "memory")
+
+# pylint: disable=wrong-import-position
+from flask import render_template, render_template_string, request
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
+import app
+from benchlib import measure, print_report
+
+def legacy_relative_url(endpoint):
+    "relative_url as it was: parse the request URL again for every link"
+    start_dir = os.path.dirname(urlparse(request.url).path)
+    return os.path.relpath(endpoint, start=start_dir)
+
+# The link list as index.html used to render it
+LEGACY_LINKS = """<ul>{% for c in cities %}
+<li><a href="{{ url_for('city_route', name=c.Name) | relative_url }}">{{c.Name}}, {{c.CountryName}}</a></li>
+{% endfor %}</ul>"""
+
+def main():
+    "Run the benchmark"
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--cities", type=int, default=10000)
+    parser.add_argument("--iterations", type=int, default=20)
+    args = parser.parse_args()
+
+    cities = [{"Name": f"City-{n:05d}", "CountryName": "Country"} for n in range(args.cities)]
+
+    def render_legacy_links():
+        with app.app.test_request_context('/'):
+            render_template_string(LEGACY_LINKS, cities=cities)
+
+    def render_home():
+        with app.app.test_request_context('/'):
+            render_template('index.html', cities=cities, cursor=None, next_cursor=None, search=True)
+
+    results = {}
+    with patch.dict(app.app.jinja_env.filters, relative_url=legacy_relative_url):
+        results["links, old relative_url"] = measure(render_legacy_links, args.iterations, warmup=2)
+    results["links, new relative_url"] = measure(render_legacy_links, args.iterations, warmup=2)
+    results["home, index.html"] = measure(render_home, args.iterations, warmup=2)
+
+    folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates")
+    bytecode_cache = FileSystemBytecodeCache()
+
+    def cold_load(cache):
+        # A new environment is what a new worker starts with
+        environment = Environment(loader=FileSystemLoader(folder), bytecode_cache=cache)
+        environment.filters.update(app.app.jinja_env.filters)
+        environment.get_template('city.html')
+
+    cold_load(bytecode_cache)
+    results["cold load, compile"] = measure(lambda: cold_load(None), args.iterations * 5)
+    results["cold load, bytecode cache"] = measure(
+        lambda: cold_load(bytecode_cache), args.iterations * 5
+    )
+    print_report(results)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+"""
+Benchmark the local review index (review_index.py) on synthetic reviews,
+1M over 10k cities by default: the build time, then queries/s for single
+queries and batches, filtered by city (and stars) or over every review.
+"""
+import argparse
+import random
+import tempfile
+import time
+from benchlib import measure, print_report
+from review_index import ReviewIndex, build_index
+from seed_store import WORDS, city_name, make_reviews
+
+def synthetic_reviews(cities, count):
+    "Reviews as items, like the CityReviews table holds"
+    for name, review_id, content, stars in make_reviews(cities, count, random.Random(42)):
+        yield {"CityName": name, "ReviewId": review_id, "ReviewContent": content, "Stars": stars}
+
+def main():
+    "Run the benchmark"
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--cities", type=int, default=10000)
+    parser.add_argument("--reviews", type=int, default=1000000)
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--batch", type=int, default=64, help="queries per batch")
+    parser.add_argument("--iterations", type=int, default=500)
+    parser.add_argument("--path", help="where to build the index, a temporary directory by default")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        path = args.path or f"{folder}/index"
+        reviews = list(synthetic_reviews(args.cities, args.reviews))
+        start = time.perf_counter()
+        build_index(reviews, path, args.dim)
+        print(f"Built the index of {args.reviews} reviews in {time.perf_counter() - start:.1f}s")
+        index = ReviewIndex(path)
+
+        rng = random.Random(7)
+        def query():
+            return " ".join(rng.choice(WORDS) for _ in range(3))
+        def city():
+            return city_name(rng.randrange(args.cities))
+        batch = [query() for _ in range(args.batch)]
+        # Searching every review is much slower, so fewer iterations
+        all_iterations = max(args.iterations // 50, 5)
+        results = {
+            "city": measure(lambda: index.search(query(), city()), args.iterations),
+            "city 4+ stars": measure(
+                lambda: index.search(query(), city(), min_stars=4), args.iterations
+            ),
+            f"city batch of {args.batch}": measure(
+                lambda: index.search_many(batch, city()), args.iterations
+            ),
+            "all reviews": measure(lambda: index.search(query()), all_iterations, warmup=1),
+            f"all batch of {args.batch}": measure(
+                lambda: index.search_many(batch), all_iterations, warmup=1
+            )
+        }
+        print_report(results)
+        for name in (f"city batch of {args.batch}", f"all batch of {args.batch}"):
+            print(f"{name}: {results[name]['throughput'] * args.batch:.0f} queries/s")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,279 @@
+"""
+Benchmark suite for the Flask routes. Drives /, /city/<name>, /suggestions/<name>
+and /kb/<name> through the Flask test client and through a real gunicorn
+worker, against stubbed backends with configurable latency and dataset size,
+and compares the results with a saved baseline:
+
+    python bench_routes.py --save-baseline bench_baseline.json
+    python bench_routes.py --baseline bench_baseline.json   # exits 1 on a regression
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import http.client
+import itertools
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+from importlib.machinery import SourceFileLoader
+from importlib.util import module_from_spec, spec_from_loader
+from benchlib import compare_results, measure, print_report, summarize
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+def setting(name, default):
+    "A benchmark setting, passed to gunicorn workers through the environment"
+    return type(default)(os.getenv(f"BENCH_{name}", str(default)))
+
+
+class SlowCities:
+    "Stands in for the Cities table of app.pybkp, with latency seconds per call"
+
+    def __init__(self, cities, latency):
+        self.items = [{
+            "CityName": city["Name"], "CountryCode": city["CountryCode"],
+            "CountryName": city["CountryName"], "TopThingsToDo": city["TopThingsToDo"]
+        } for city in cities]
+        self.latency = latency
+
+    def scan(self, **_kwargs):
+        "All the cities"
+        time.sleep(self.latency)
+        return {"Items": self.items}
+
+    def query(self, **_kwargs):
+        "One city"
+        time.sleep(self.latency)
+        return {"Items": self.items[:1]}
+
+
+class StubModel:
+    "Stands in for Bedrock, streaming chunks chunk_delay seconds apart"
+
+    def __init__(self, chunks, chunk_delay, latency):
+        self.chunks = chunks
+        self.chunk_delay = chunk_delay
+        self.latency = latency
+
+    def invoke_model_with_response_stream(self, **_kwargs):
+        "A streamed generation"
+        time.sleep(self.latency)
+        def events():
+            for _ in range(self.chunks):
+                time.sleep(self.chunk_delay)
+                yield {"chunk": {"bytes": json.dumps({"outputText": "word "}).encode()}}
+        return {"body": events()}
+
+    def retrieve_and_generate(self, **_kwargs):
+        "A knowledge base answer with one citation"
+        time.sleep(self.latency)
+        return {"citations": [{
+            "generatedResponsePart": {"textResponsePart": {"text": "An answer"}},
+            "retrievedReferences": [{
+                "location": {"s3Location": {"uri": "s3://bench/review.txt"}},
+                "content": {"text": "A review"},
+                "metadata": {"Stars": 4}
+            }]
+        }]}
+
+
+def catalogue_app():
+    "app.py over a seeded in-memory store with BENCH_LATENCY per store call"
+    os.environ.setdefault("STORAGE_BACKEND", "memory")
+    # pylint: disable=import-outside-toplevel
+    import app
+    from seed_store import seed
+    from storage import LatencyStore, MemoryStore
+    store = MemoryStore()
+    seed(store, setting("CITIES", 1000), setting("REVIEWS", 20000))
+    app.store = LatencyStore(store, setting("LATENCY", 0.005))
+    if setting("COLD", 0):
+        app.cities_cache.ttl = 0
+        app.page_cache.ttl = 0
+    return app.app
+
+def bedrock_app():
+    "app.pybkp with stubbed Cities, Bedrock and knowledge base clients"
+    os.environ.setdefault("KB_STORE_PATH", ":memory:")
+    # pylint: disable=import-outside-toplevel
+    from seed_store import make_cities
+    loader = SourceFileLoader("bedrock_app", os.path.join(HERE, "app.pybkp"))
+    module = module_from_spec(spec_from_loader("bedrock_app", loader))
+    sys.modules["bedrock_app"] = module
+    loader.exec_module(module)
+    latency = setting("LATENCY", 0.005)
+    module.cities_table = SlowCities(make_cities(setting("CITIES", 1000)), latency)
+    model = StubModel(setting("CHUNKS", 20), setting("CHUNK_DELAY", 0.001), latency)
+    module.bedrock = model
+    module.bedrock_agent = model
+    return module.app
+
+
+class Scenario:  # pylint: disable=too-few-public-methods
+    "One route to drive: which app serves it and how to build each request"
+
+    def __init__(self, name, factory, method, make_path, make_form=None):
+        self.name = name
+        self.factory = factory
+        self.method = method
+        self.make_path = make_path
+        self.make_form = make_form
+
+    def next_request(self, counter):
+        "Path and form data of the counter'th request"
+        form = self.make_form(counter) if self.make_form else None
+        return self.make_path(counter), form
+
+def scenarios(cities):
+    "The benchmarked routes"
+    def city(counter):
+        return f"City-{random.Random(counter).randrange(cities):05d}"
+    return [
+        Scenario("home", "catalogue_app", "GET", lambda n: "/"),
+        Scenario("city", "catalogue_app", "GET", lambda n: f"/city/{city(n)}"),
+        # Distinct parameters every time, so each request is a new generation
+        Scenario("suggestions", "bedrock_app", "POST", lambda n: "/suggestions/City-00000",
+                 lambda n: {"days": str(n)}),
+        Scenario("kb", "bedrock_app", "POST", lambda n: "/kb/City-00000",
+                 lambda n: {"q": str(n % 4)})
+    ]
+
+
+def run_client(scenario, iterations, apps):
+    "Drive a scenario through the Flask test client, building each app once"
+    if scenario.factory not in apps:
+        apps[scenario.factory] = globals()[scenario.factory]()
+    tester = apps[scenario.factory].test_client()
+    counter = itertools.count()
+
+    def call():
+        path, form = scenario.next_request(next(counter))
+        response = tester.open(path, method=scenario.method, data=form)
+        assert response.status_code == 200, (path, response.status_code)
+        return response.data
+
+    return measure(call, iterations)
+
+def free_port():
+    "An unused local TCP port"
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def start_gunicorn(factory, port, env):
+    "Start one gunicorn worker serving factory() and wait until it answers"
+    server = subprocess.Popen([  # pylint: disable=consider-using-with
+        sys.executable, "-m", "gunicorn", "-c", os.path.join(HERE, "gunicorn.conf.py"),
+        "--chdir", HERE, "-b", f"127.0.0.1:{port}", "-w", "1", "--log-level", "warning",
+        f"bench_routes:{factory}()"
+    ], env=env)
+    for _ in range(300):
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.1).close()
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError(f"gunicorn serving {factory} did not start")
+
+def run_gunicorn(scenario, port, iterations, concurrency):
+    "Drive a scenario over HTTP from concurrency keep-alive connections"
+    counter = itertools.count()
+    lock = threading.Lock()
+    latencies = []
+
+    def client(requests):
+        connection = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+        for _ in range(requests):
+            with lock:
+                path, form = scenario.next_request(next(counter))
+            body = urllib.parse.urlencode(form) if form else None
+            headers = {"Content-Type": "application/x-www-form-urlencoded"} if form else {}
+            began = time.perf_counter()
+            connection.request(scenario.method, path, body, headers)
+            response = connection.getresponse()
+            response.read()
+            assert response.status == 200, (path, response.status)
+            with lock:
+                latencies.append(time.perf_counter() - began)
+        connection.close()
+
+    client(min(5, iterations))
+    latencies.clear()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        shares = [
+            iterations // concurrency + (n < iterations % concurrency) for n in range(concurrency)
+        ]
+        list(pool.map(client, shares))
+    return summarize(latencies, time.perf_counter() - start)
+
+def main():
+    "Run the suite"
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--modes", default="client,gunicorn")
+    parser.add_argument("--routes", default="home,city,suggestions,kb")
+    parser.add_argument("--iterations", type=int, default=300)
+    parser.add_argument("--concurrency", type=int, default=8, help="connections in gunicorn mode")
+    parser.add_argument("--latency", type=float, default=0.005, help="seconds per backend call")
+    parser.add_argument("--cities", type=int, default=1000)
+    parser.add_argument("--reviews", type=int, default=20000)
+    parser.add_argument("--chunks", type=int, default=20, help="chunks per model stream")
+    parser.add_argument("--chunk-delay", type=float, default=0.001)
+    parser.add_argument("--cold", action="store_true",
+                        help="turn the catalogue and page caches off")
+    parser.add_argument("--baseline", help="fail when slower than this saved run")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="allowed slowdown, 0.25 = 25%%")
+    parser.add_argument("--save-baseline", help="write the results here")
+    args = parser.parse_args()
+
+    os.environ.update({
+        "BENCH_LATENCY": str(args.latency), "BENCH_CITIES": str(args.cities),
+        "BENCH_REVIEWS": str(args.reviews), "BENCH_CHUNKS": str(args.chunks),
+        "BENCH_CHUNK_DELAY": str(args.chunk_delay), "BENCH_COLD": str(int(args.cold)),
+        "STORAGE_BACKEND": "memory", "KB_STORE_PATH": ":memory:",
+        "AWS_DEFAULT_REGION": os.getenv("AWS_DEFAULT_REGION", "us-east-1")
+    })
+    selected = [s for s in scenarios(args.cities) if s.name in args.routes.split(",")]
+    modes = args.modes.split(",")
+    results = {}
+    if "client" in modes:
+        apps = {}
+        for scenario in selected:
+            results[f"client {scenario.name}"] = run_client(scenario, args.iterations, apps)
+    if "gunicorn" in modes:
+        for factory in sorted({scenario.factory for scenario in selected}):
+            port = free_port()
+            server = start_gunicorn(factory, port, dict(os.environ))
+            try:
+                for scenario in [s for s in selected if s.factory == factory]:
+                    results[f"gunicorn {scenario.name}"] = run_gunicorn(
+                        scenario, port, args.iterations, args.concurrency
+                    )
+            finally:
+                server.terminate()
+                server.wait()
+    print_report(results)
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as file:
+            json.dump(results, file, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as file:
+            regressions = compare_results(results, json.load(file), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions against {args.baseline}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+"""
+Benchmark the catalogue snapshot (snapshot.py) against per-worker caching.
+Forks workers the way gunicorn does; each one either warms its own copy of
+the catalogue from SQLite, like the app's cities cache, or maps the shared
+snapshot, then looks up every city. Reports per worker the cold start (until
+the first lookup is answered), lookups/s and the memory added, as RSS and as
+PSS, which splits shared pages between the processes mapping them.
+"""
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+from seed_store import WORDS, make_cities
+from snapshot import CatalogueSnapshot, build_snapshot
+from storage import SqliteStore
+
+def memory_kb():
+    "This process's RSS and PSS in kB (PSS is 0 where /proc has no smaps_rollup)"
+    values = {"Rss": 0, "Pss": 0}
+    for path in ("/proc/self/status", "/proc/self/smaps_rollup"):
+        try:
+            with open(path, encoding="ascii") as file:
+                for line in file:
+                    key, _, value = line.partition(":")
+                    if key in ("VmRSS", "Pss"):
+                        values["Rss" if key == "VmRSS" else "Pss"] = int(value.split()[0])
+        except FileNotFoundError:
+            pass
+    return values
+
+def cities_with_itineraries(count, words):
+    "Synthetic cities with itineraries of about words words"
+    rng = random.Random(42)
+    for city in make_cities(count):
+        city["Itinerary"] = " ".join(rng.choice(WORDS) for _ in range(words))
+        yield city
+
+def cache_worker(database, names):
+    "Warm a per-worker catalogue from SQLite, then look up every city"
+    catalogue = {city["Name"]: city for city in SqliteStore(database).list_cities()}
+    first = catalogue[names[0]]
+    return first, catalogue.get
+
+def snapshot_worker(path, names):
+    "Map the snapshot, then look up every city"
+    snapshot = CatalogueSnapshot(path)
+    first = snapshot.get_city(names[0])
+    return first, snapshot.get_city
+
+def run_worker(mode, source, names, write, gate):
+    "One forked worker, reporting its numbers as JSON lines"
+    before = memory_kb()
+    start = time.perf_counter()
+    first, lookup = (cache_worker if mode == "cache" else snapshot_worker)(source, names)
+    cold_start = time.perf_counter() - start
+    assert first is not None
+    start = time.perf_counter()
+    for name in names:
+        lookup(name)
+    elapsed = time.perf_counter() - start
+    write.write(json.dumps({"cold_start": cold_start, "lookups": len(names) / elapsed}) + "\n")
+    write.flush()
+    # Memory is measured once every worker has touched its pages, so PSS splits the shared ones
+    os.read(gate, 1)
+    after = memory_kb()
+    usage = {"rss": after["Rss"] - before["Rss"], "pss": after["Pss"] - before["Pss"]}
+    write.write(json.dumps(usage) + "\n")
+    write.flush()
+
+def run(mode, source, names, workers):
+    "Fork workers and average what they report"
+    read_fd, write_fd = os.pipe()
+    gate_read, gate_write = os.pipe()
+    pids = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            os.close(gate_write)
+            with os.fdopen(write_fd, "w") as write:
+                run_worker(mode, source, names, write, gate_read)
+            os._exit(0)  # pylint: disable=protected-access
+        pids.append(pid)
+    os.close(write_fd)
+    os.close(gate_read)
+    totals = {}
+    with os.fdopen(read_fd) as read:
+        for _ in range(workers):
+            for key, value in json.loads(read.readline()).items():
+                totals[key] = totals.get(key, 0) + value
+        os.write(gate_write, b"x" * workers)
+        for _ in range(workers):
+            for key, value in json.loads(read.readline()).items():
+                totals[key] = totals.get(key, 0) + value
+    os.close(gate_write)
+    for pid in pids:
+        os.waitpid(pid, 0)
+    return {key: value / workers for key, value in totals.items()}
+
+def main():
+    "Run the benchmark"
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--cities", type=int, default=50000)
+    parser.add_argument("--itinerary-words", type=int, default=150)
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        database = os.path.join(folder, "cities.db")
+        path = os.path.join(folder, "catalogue.snap")
+        SqliteStore(database).add_cities(cities_with_itineraries(args.cities, args.itinerary_words))
+        start = time.perf_counter()
+        build_snapshot(SqliteStore(database).list_cities(), path)
+        size = os.path.getsize(path) / 2 ** 20
+        print(f"Built a snapshot of {args.cities} cities ({size:.1f} MB) "
+              f"in {time.perf_counter() - start:.1f}s")
+        names = [city["Name"] for city in SqliteStore(database).list_cities()]
+        random.Random(7).shuffle(names)
+
+        print(f"{'':10} {'cold start':>12} {'lookups/s':>12} {'RSS/worker':>12} {'PSS/worker':>12}")
+        for mode, source in (("cache", database), ("snapshot", path)):
+            result = run(mode, source, names, args.workers)
+            print(f"{mode:10} {result['cold_start'] * 1000:10.1f}ms {result['lookups']:12.0f} "
+                  f"{result['rss'] / 1024:10.1f}MB {result['pss'] / 1024:10.1f}MB")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""
+Benchmark worker cold start: how long a fresh interpreter takes to import the
+app, how long the first AWS clients take to build (now deferred to first use),
+and how long a new gunicorn worker takes to serve its first response
+"""
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+from benchlib import summarize
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+PROBE = '''
+import time
+began = time.perf_counter()
+import app
+imported = time.perf_counter()
+import clients
+for name in ("Cities", "CityReviews", "CityReviewStats"):
+    clients.table(name)
+print(imported - began, time.perf_counter() - imported)
+'''
+
+def free_port():
+    "An unused local TCP port"
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def probe_imports(env):
+    "Import time and first client time in a fresh interpreter"
+    output = subprocess.run(
+        [sys.executable, "-c", PROBE], cwd=HERE, env=env, check=True, capture_output=True, text=True
+    ).stdout
+    imported, clients_built = output.split()
+    return float(imported), float(clients_built)
+
+def first_response(env):
+    "Seconds from starting a one worker gunicorn to its first 200 response"
+    port = free_port()
+    began = time.perf_counter()
+    server = subprocess.Popen([  # pylint: disable=consider-using-with
+        sys.executable, "-m", "gunicorn", "-c", os.path.join(HERE, "gunicorn.conf.py"),
+        "--chdir", HERE, "-b", f"127.0.0.1:{port}", "-w", "1", "-k", "sync",
+        "--log-level", "warning", "app:app"
+    ], env=env)
+    try:
+        while time.perf_counter() - began < 30:
+            try:
+                with urllib.request.urlopen(f"http://127.0.0.1:{port}/", timeout=1) as response:
+                    if response.status == 200:
+                        return time.perf_counter() - began
+            except OSError:
+                time.sleep(0.005)
+        raise RuntimeError("gunicorn did not answer within 30s")
+    finally:
+        server.terminate()
+        server.wait()
+
+def main():
+    "Run the benchmark"
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--iterations", type=int, default=10)
+    args = parser.parse_args()
+
+    env = dict(os.environ, AWS_DEFAULT_REGION=os.getenv("AWS_DEFAULT_REGION", "us-east-1"))
+    imports, builds = zip(*[probe_imports(env) for _ in range(args.iterations)])
+    # The memory store answers without AWS credentials
+    env["STORAGE_BACKEND"] = "memory"
+    responses = [first_response(env) for _ in range(args.iterations)]
+
+    print(f"{'startup step':<28}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}")
+    for name, samples in (("import app", imports), ("first AWS clients", builds),
+                          ("gunicorn first response", responses)):
+        result = summarize(list(samples))
+        print(f"{name:<28}{result['mean_ms']:>10.1f}"
+              f"{result['p50_ms']:>10.1f}{result['p95_ms']:>10.1f}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""
+Benchmark the app's pages against a local seeded store (see seed_store.py),
+with an optional per-call latency to stand in for DynamoDB round trips
+"""
+import argparse
+import os
+import random
+from unittest.mock import patch
+
+os.environ.setdefault("STORAGE_BACKEND", "memory")
+
+# pylint: disable=wrong-import-position
+import app
+from benchlib import measure, print_report
+from seed_store import city_name, seed
+from storage import LatencyStore, MemoryStore, SqliteStore
+
+def main():
+    "Run the benchmark"
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--backend", choices=["sqlite", "memory"], default="sqlite")
+    parser.add_argument("--path", default="cities.db", help="seeded SQLite database")
+    parser.add_argument("--cities", type=int, default=10000, help="cities in the seeded data")
+    parser.add_argument("--reviews", type=int, default=100000, help="reviews to seed for memory")
+    parser.add_argument("--iterations", type=int, default=500)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds per store call")
+    parser.add_argument("--cached", action="store_true", help="keep the app caches on")
+    args = parser.parse_args()
+
+    if args.backend == "sqlite":
+        store = SqliteStore(args.path)
+    else:
+        store = MemoryStore()
+        seed(store, args.cities, args.reviews)
+    if args.latency:
+        store = LatencyStore(store, args.latency)
+    if not args.cached:
+        app.cities_cache.ttl = 0
+        app.page_cache.ttl = 0
+    tester = app.app.test_client()
+    rng = random.Random(1)
+
+    def get(path):
+        response = tester.get(path)
+        assert response.status_code == 200, (path, response.status_code)
+
+    with patch.object(app, 'store', store):
+        print_report({
+            "home": measure(lambda: get('/'), args.iterations),
+            "city": measure(
+                lambda: get(f'/city/{city_name(rng.randrange(args.cities))}'), args.iterations
+            ),
+            "city top rated": measure(
+                lambda: get(f'/city/{city_name(rng.randrange(args.cities))}?sort=top'),
+                args.iterations
+            )
+        })
+
+if __name__ == '__main__':
+    main()
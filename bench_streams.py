@@ -0,0 +1,171 @@
+"""
+Load test the /suggestions stream: start one gunicorn worker against a stubbed
+model that emits a chunk every --chunk-delay seconds, open increasing numbers
+of concurrent streams, and report how many the worker sustains. A stream
+only counts when it is a 200 with a body; failed ones are counted apart and
+a level with any is not sustained.
+"""
+import argparse
+import http.client
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import textwrap
+import threading
+import time
+import urllib.parse
+from benchlib import percentile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+ENTRY = textwrap.dedent('''
+    "WSGI entry point: the Bedrock app with a stubbed model and table"
+    import json
+    import os
+    import sys
+    import time
+    from importlib.machinery import SourceFileLoader
+    from importlib.util import module_from_spec, spec_from_loader
+
+    sys.path.insert(0, {here!r})
+    os.environ.setdefault("KB_STORE_PATH", ":memory:")
+    loader = SourceFileLoader("app", os.path.join({here!r}, "app.pybkp"))
+    app = module_from_spec(spec_from_loader("app", loader))
+    sys.modules["app"] = app
+    loader.exec_module(app)
+
+    CHUNKS = int(os.environ["BENCH_CHUNKS"])
+    CHUNK_DELAY = float(os.environ["BENCH_CHUNK_DELAY"])
+
+    class StubModel:
+        def invoke_model_with_response_stream(self, body, modelId):
+            def events():
+                for _ in range(CHUNKS):
+                    time.sleep(CHUNK_DELAY)
+                    yield {{"chunk": {{"bytes": json.dumps({{"outputText": "word "}}).encode()}}}}
+            return {{"body": events()}}
+
+    class StubCities:
+        def query(self, **kwargs):
+            return {{"Items": [{{"CityName": "Bench", "CountryCode": "BC",
+                                "CountryName": "Bench", "TopThingsToDo": ["Walk"]}}]}}
+
+    app.bedrock = StubModel()
+    app.cities_table = StubCities()
+    application = app.app
+''')
+
+def free_port():
+    "An unused local TCP port"
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def start_server(folder, worker_class, port, args):
+    "Start one gunicorn worker and wait until it accepts connections"
+    env = dict(os.environ, BENCH_CHUNKS=str(args.chunks), BENCH_CHUNK_DELAY=str(args.chunk_delay),
+               AWS_DEFAULT_REGION=os.getenv("AWS_DEFAULT_REGION", "us-east-1"))
+    command = [
+        sys.executable, "-m", "gunicorn", "-c", os.path.join(HERE, "gunicorn.conf.py"),
+        "--chdir", folder, "-b", f"127.0.0.1:{port}", "-w", "1", "-k", worker_class,
+        "--log-level", "warning", "bench_entry:application"
+    ]
+    # gunicorn quietly turns a sync worker with threads into a gthread one
+    if worker_class == "gthread":
+        command += ["--threads", str(args.threads)]
+    server = subprocess.Popen(command, env=env)  # pylint: disable=consider-using-with
+    for _ in range(100):
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.1).close()
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError(f"gunicorn ({worker_class}) did not start")
+
+def one_stream(port, days, results, failures):
+    """
+    POST a suggestions request and read the stream, recording TTFB and total
+    time, or the reason it failed unless it is a 200 with a body
+    """
+    began = time.perf_counter()
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=300)
+    try:
+        body = urllib.parse.urlencode({"days": str(days)})
+        connection.request("POST", "/suggestions/Bench", body,
+                           {"Content-Type": "application/x-www-form-urlencoded"})
+        response = connection.getresponse()
+        first = response.read(1)
+        first_byte = time.perf_counter() - began
+        rest = response.read()
+    except (OSError, http.client.HTTPException) as error:
+        failures.append(repr(error))
+        return
+    finally:
+        connection.close()
+    if response.status != 200 or not first + rest:
+        failures.append(f"HTTP {response.status} with {len(first + rest)} bytes")
+        return
+    results.append((first_byte, time.perf_counter() - began))
+
+def run_level(port, streams):
+    "Open streams concurrent requests with their own parameters, return results and failures"
+    results, failures = [], []
+    # Distinct parameters, so every stream is a separate generation
+    threads = [
+        threading.Thread(target=one_stream, args=(port, f"{streams}-{n}", results, failures))
+        for n in range(streams)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, failures
+
+def main():
+    "Run the load test"
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--worker-classes", default="sync,gthread,gevent")
+    parser.add_argument("--levels", default="1,10,50,100,200")
+    parser.add_argument("--chunks", type=int, default=20)
+    parser.add_argument("--chunk-delay", type=float, default=0.05)
+    parser.add_argument("--threads", type=int, default=4, help="threads for gthread workers")
+    args = parser.parse_args()
+
+    stream_time = args.chunks * args.chunk_delay
+    print(f"one stream takes ~{stream_time:.2f}s; "
+          f"'sustained' means p99 under {1.5 * stream_time:.2f}s")
+    print(f"{'worker':<10}{'streams':>8}{'failed':>8}"
+          f"{'ttfb p50':>10}{'ttfb p99':>10}{'total p99':>11}  sustained")
+    with tempfile.TemporaryDirectory() as folder:
+        with open(os.path.join(folder, "bench_entry.py"), "w", encoding="utf-8") as file:
+            file.write(ENTRY.format(here=HERE))
+        for worker_class in args.worker_classes.split(","):
+            port = free_port()
+            server = start_server(folder, worker_class, port, args)
+            try:
+                # Let the worker import everything first, and stop if the route is broken
+                failures = []
+                one_stream(port, "warm-up", [], failures)
+                if failures:
+                    raise RuntimeError(f"The warm-up stream failed ({worker_class}): {failures[0]}")
+                for streams in [int(level) for level in args.levels.split(",")]:
+                    results, failures = run_level(port, streams)
+                    ttfb = [first for first, _ in results]
+                    total = [whole for _, whole in results]
+                    sustained = not failures and percentile(total, 99) < 1.5 * stream_time
+                    print(f"{worker_class:<10}{streams:>8}{len(failures):>8}"
+                          f"{percentile(ttfb, 50):>10.2f}{percentile(ttfb, 99):>10.2f}"
+                          f"{percentile(total, 99):>11.2f}  {sustained}")
+                    if failures:
+                        print(f"  first failure: {failures[0]}")
+                    if not sustained:
+                        break
+            finally:
+                server.terminate()
+                server.wait()
+
+if __name__ == '__main__':
+    main()
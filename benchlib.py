@@ -0,0 +1,64 @@
+"Shared helpers for the benchmark scripts"
+import statistics
+import time
+
+def percentile(samples, pct):
+    "Nearest-rank percentile of a list of samples"
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    rank = max(int(round(pct / 100.0 * len(ordered))) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+def summarize(latencies, elapsed=None):
+    "Latency percentiles (in ms) and throughput for a run"
+    elapsed = elapsed if elapsed is not None else sum(latencies)
+    return {
+        "requests": len(latencies),
+        "throughput": len(latencies) / elapsed if elapsed else 0.0,
+        "mean_ms": statistics.fmean(latencies) * 1000 if latencies else 0.0,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000
+    }
+
+def measure(func, iterations, warmup=5):
+    "Call func repeatedly and return the summary of its latencies"
+    for _ in range(warmup):
+        func()
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(iterations):
+        began = time.perf_counter()
+        func()
+        latencies.append(time.perf_counter() - began)
+    return summarize(latencies, time.perf_counter() - start)
+
+def print_report(results):
+    "Print a table of named benchmark summaries"
+    print(f"{'benchmark':<28}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name, result in results.items():
+        print(
+            f"{name:<28}{result['throughput']:>10.1f}{result['p50_ms']:>10.2f}"
+            f"{result['p95_ms']:>10.2f}{result['p99_ms']:>10.2f}"
+        )
+
+def compare_results(results, baseline, tolerance=0.25):
+    """
+    Describe every benchmark that got slower than its baseline by more than
+    tolerance, in p95 latency or in throughput
+    """
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if result["p95_ms"] > base["p95_ms"] * (1 + tolerance):
+            regressions.append(
+                f"{name}: p95 {result['p95_ms']:.2f} ms, baseline {base['p95_ms']:.2f} ms"
+            )
+        if result["throughput"] < base["throughput"] * (1 - tolerance):
+            regressions.append(
+                f"{name}: {result['throughput']:.1f} req/s, baseline {base['throughput']:.1f} req/s"
+            )
+    return regressions
@@ -0,0 +1,74 @@
+"""
+Precompress the static files for the /assets route: writes a .gz (and a .br
+when Brotli is installed) next to every text file in static/ at the highest
+levels, which would be too slow to use per request. The copies are named
+after the content hash, like style.css.<hash>.gz, and older copies are
+removed. Run it as part of the build, before starting the app:
+
+    python build_assets.py
+"""
+import argparse
+import glob
+import gzip
+import os
+import re
+import time
+from assets import file_digest, precompressed_path
+from compression import brotli  # pylint: disable=wrong-import-order
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Already compressed formats gain nothing
+TEXT_SUFFIXES = (".css", ".js", ".svg", ".html", ".json", ".txt", ".map")
+
+# What lies between a file's name and the suffix of one of its copies
+STALE_COPY = re.compile(r"(\.[0-9a-f]{12})?")
+
+def precompress(path):
+    "Write path.<hash>.gz and path.<hash>.br, returning {suffix: size}"
+    with open(path, "rb") as file:
+        data = file.read()
+    digest = file_digest(path)
+    variants = {".gz": gzip.compress(data, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        variants[".br"] = brotli.compress(data, quality=11)
+    for suffix, compressed in variants.items():
+        # Written to the side and renamed, so a running app never sends half a file
+        target = precompressed_path(path, digest, suffix)
+        partial = f"{target}.tmp"
+        with open(partial, "wb") as file:
+            file.write(compressed)
+        os.replace(partial, target)
+        # Copies of earlier versions, and the unhashed ones of earlier builds
+        for stale in glob.glob(glob.escape(path) + "*" + suffix):
+            if stale != target and STALE_COPY.fullmatch(stale[len(path):-len(suffix)]):
+                os.remove(stale)
+    return {suffix: len(compressed) for suffix, compressed in variants.items()}
+
+def build(folder):
+    "Precompress every text file under folder, returning {path: (size, {suffix: size})}"
+    built = {}
+    for root, _dirs, files in os.walk(folder):
+        for name in sorted(files):
+            if name.endswith(TEXT_SUFFIXES):
+                path = os.path.join(root, name)
+                built[path] = (os.path.getsize(path), precompress(path))
+    return built
+
+def main():
+    "Precompress static/"
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--folder", default=os.path.join(HERE, "static"))
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    built = build(args.folder)
+    for path, (size, variants) in built.items():
+        sizes = ", ".join(f"{suffix} {compressed}" for suffix, compressed in variants.items())
+        print(f"{os.path.relpath(path, args.folder)}: {size} -> {sizes}")
+    print(f"Precompressed {len(built)} files in {time.perf_counter() - start:.1f}s")
+
+if __name__ == '__main__':
+    main()
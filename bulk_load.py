@@ -0,0 +1,240 @@
+"""
+Bulk import of Cities, CityReviews (or any table's) items from a JSONL or
+CSV file. The file is streamed, items are written 25 at a time with
+BatchWriteItem from a bounded pool of workers, unprocessed items are retried
+with exponential backoff and an optional rate limit keeps the writes within
+the table's provisioned write capacity. Items with the same key in a batch,
+which BatchWriteItem refuses, are written once, the last one winning, e.g.
+
+    python bulk_load.py --table Cities cities.jsonl
+    python bulk_load.py --table CityReviews reviews.csv --rate 1000 --stats-table CityReviewStats
+    python bulk_load.py --table Cities cities.jsonl --endpoint-url http://localhost:8000
+
+Attribute names are the table's (CityName, ReviewId, Stars...). In CSV files
+every value is a string except the --number columns; list values need JSONL.
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import csv
+from decimal import Decimal
+import json
+import math
+import os
+import threading
+import time
+import boto3
+from boto3.dynamodb.types import TypeSerializer
+from botocore.config import Config
+from aws_helpers import NO_CLIENT_RETRIES, backoff_delay, with_retries
+from seed_store import batched
+from storage import add_to_stats, empty_stats
+
+# BatchWriteItem takes at most this many items
+BATCH_SIZE = 25
+# A write capacity unit covers this many bytes of an item
+WRITE_UNIT_BYTES = 1024
+
+_serializer = TypeSerializer()
+
+def read_items(path, file_format=None, numbers=("Stars",)):
+    "Stream the items of a .jsonl or .csv file, numbers as Decimal"
+    file_format = file_format or os.path.splitext(path)[1].lstrip(".").lower()
+    with open(path, encoding="utf-8", newline="") as file:
+        if file_format in ("jsonl", "json"):
+            for line in file:
+                if line.strip():
+                    yield json.loads(line, parse_float=Decimal)
+        elif file_format == "csv":
+            for row in csv.DictReader(file):
+                yield {
+                    name: Decimal(value) if name in numbers else value
+                    for name, value in row.items() if value != ""
+                }
+        else:
+            raise ValueError(f"Unknown file format {file_format!r}, expected jsonl or csv")
+
+def item_units(wire):
+    "Write capacity units a put of an item uses (its size in KB, rounded up)"
+    size = len(json.dumps(wire, separators=(",", ":"), default=str).encode("utf-8"))
+    return max(1, math.ceil(size / WRITE_UNIT_BYTES))
+
+
+class RateLimiter:  # pylint: disable=too-few-public-methods
+    "A token bucket of write capacity units per second, shared by the workers"
+
+    def __init__(self, rate, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.clock = clock
+        self.sleep = sleep
+        # Allows a one second burst, like unused provisioned capacity does
+        self._tokens = rate
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def acquire(self, units):
+        "Wait until units can be spent"
+        with self._lock:
+            now = self.clock()
+            self._tokens = min(self.rate, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            # Going into debt keeps batches bigger than the rate from waiting forever
+            self._tokens -= units
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        if wait:
+            self.sleep(wait)
+
+
+class LoadCounts:  # pylint: disable=too-many-instance-attributes
+    "Items written so far and the throughput, reported at most every interval seconds"
+
+    def __init__(self, interval=5.0, clock=time.monotonic):
+        self.interval = interval
+        self.clock = clock
+        self.started = clock()
+        self.items = 0
+        self.batches = 0
+        self.retries = 0
+        self.last_report = self.started
+        self._lock = threading.Lock()
+
+    def add(self, items, retries):
+        "Count one written batch and report if it is time to"
+        with self._lock:
+            self.items += items
+            self.batches += 1
+            self.retries += retries
+            now = self.clock()
+            if now - self.last_report >= self.interval:
+                self.last_report = now
+                print(self.report(), flush=True)
+
+    def elapsed(self):
+        "Seconds since the load started"
+        return self.clock() - self.started
+
+    def report(self):
+        "One line of progress"
+        elapsed = self.elapsed()
+        rate = self.items / elapsed if elapsed > 0 else 0.0
+        return (f"Wrote {self.items} items in {self.batches} batches, "
+                f"{rate:.1f} items/s, {self.retries} retries")
+
+
+def table_keys(client, table_name):
+    "The names of the key attributes of a table"
+    table = with_retries(client.describe_table, TableName=table_name)["Table"]
+    return tuple(key["AttributeName"] for key in table["KeySchema"])
+
+def unique_by_key(batch, keys):
+    "The items of a batch, one per key, the last of each"
+    return list({tuple(item.get(key) for key in keys): item for item in batch}.values())
+
+def write_batch(client, table_name, items, limiter=None, attempts=8, base_delay=0.05,
+                sleep=time.sleep):
+    """
+    Write up to 25 items with BatchWriteItem, retrying the UnprocessedItems
+    with exponential backoff. Returns the number of retries.
+    """
+    # pylint: disable=too-many-arguments, too-many-positional-arguments
+    requests = [
+        {"PutRequest": {"Item": {
+            name: _serializer.serialize(value) for name, value in item.items()
+        }}}
+        for item in items
+    ]
+    for attempt in range(attempts):
+        if limiter is not None:
+            limiter.acquire(sum(item_units(request["PutRequest"]["Item"]) for request in requests))
+        response = with_retries(client.batch_write_item, RequestItems={table_name: requests})
+        requests = response.get("UnprocessedItems", {}).get(table_name)
+        if not requests:
+            return attempt
+        sleep(backoff_delay(attempt, base_delay))
+    raise RuntimeError(
+        f"{len(requests)} items of {table_name} still unprocessed after {attempts} attempts"
+    )
+
+def bulk_load(client, table_name, items, workers=8, rate=None, counts=None, keys=None):
+    """
+    Write every item to the table, workers batches at a time, spending at most
+    rate write capacity units per second. keys are the names of the table's key
+    attributes, looked up when not given. The first failed batch stops the
+    load. Returns the LoadCounts.
+    """
+    # pylint: disable=too-many-arguments, too-many-positional-arguments
+    counts = counts or LoadCounts()
+    limiter = RateLimiter(rate) if rate else None
+    keys = keys or table_keys(client, table_name)
+    # Caps the batches read ahead of the workers, so the file is streamed
+    slots = threading.BoundedSemaphore(workers * 2)
+    errors = []
+    failed = threading.Event()
+
+    def write(batch):
+        try:
+            # Batches a worker picks up after a failure are dropped too
+            if not failed.is_set():
+                counts.add(len(batch), write_batch(client, table_name, batch, limiter))
+        except Exception as error:  # pylint: disable=broad-except
+            errors.append(error)
+            failed.set()
+        finally:
+            slots.release()
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="load") as pool:
+        for batch in batched(items, BATCH_SIZE):
+            slots.acquire()  # pylint: disable=consider-using-with
+            if failed.is_set():
+                slots.release()
+                pool.shutdown(cancel_futures=True)
+                break
+            pool.submit(write, unique_by_key(batch, keys))
+    if errors:
+        raise errors[0]
+    return counts
+
+def with_review_stats(items, stats):
+    "Pass reviews through, folding each into stats ({city name: aggregate})"
+    for item in items:
+        add_to_stats(stats.setdefault(item["CityName"], empty_stats()), item["Stars"])
+        yield item
+
+def main():
+    "Load a file into a table"
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("path", help="a .jsonl or .csv file of items")
+    parser.add_argument("--table", required=True)
+    parser.add_argument("--format", choices=["jsonl", "csv"],
+                        help="default: from the file extension")
+    parser.add_argument("--number", action="append", default=None,
+                        help="a numeric CSV column, can be repeated (default Stars)")
+    parser.add_argument("--workers", type=int, default=8, help="concurrent BatchWriteItem calls")
+    parser.add_argument("--rate", type=float, help="write capacity units per second to stay under")
+    parser.add_argument("--stats-table",
+                        help="also write the rating aggregates of the loaded reviews here "
+                             "(fresh tables only)")
+    parser.add_argument("--endpoint-url", default=os.getenv("DYNAMODB_ENDPOINT_URL"),
+                        help="e.g. a DynamoDB Local at http://localhost:8000")
+    args = parser.parse_args()
+
+    client = boto3.session.Session().client(
+        'dynamodb', endpoint_url=args.endpoint_url,
+        config=Config(max_pool_connections=args.workers, retries=NO_CLIENT_RETRIES)
+    )
+    items = read_items(args.path, args.format, tuple(args.number or ["Stars"]))
+    stats = {}
+    if args.stats_table:
+        items = with_review_stats(items, stats)
+    counts = bulk_load(client, args.table, items, args.workers, args.rate)
+    print(counts.report())
+    if args.stats_table:
+        # The aggregates replace what is there, so they only add up on a fresh load
+        aggregates = ({"CityName": name, **aggregate} for name, aggregate in stats.items())
+        bulk_load(client, args.stats_table, aggregates, args.workers, args.rate)
+        print(f"Wrote the rating aggregates of {len(stats)} cities to {args.stats_table}")
+    print(f"Loaded {counts.items} items into {args.table} in {counts.elapsed():.1f}s")
+
+if __name__ == '__main__':
+    main()
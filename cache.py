@@ -0,0 +1,247 @@
+"In-process caches for the City Info App"
+from collections import OrderedDict
+import threading
+import time
+
+
+class _Flight:  # pylint: disable=too-few-public-methods
+    "A backend load in progress that other callers can wait on"
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class TTLCache:  # pylint: disable=too-many-instance-attributes
+    """
+    Read-through cache with a time-to-live, a size bound with LRU eviction
+    and single-flight loading, so a cold key only hits the backend once.
+    """
+
+    def __init__(self, ttl=300, maxsize=1024, clock=time.monotonic):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def get_or_load(self, key, loader, keep=None):
+        """
+        Return the cached value for key, calling loader() on a miss. When keep
+        is given, loaded values it rejects are returned but not cached.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > self.clock():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                self.misses += 1
+            else:
+                # Somebody else is already loading this key
+                self.hits += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = loader()
+        except Exception as error:
+            flight.error = error
+            raise
+        finally:
+            with self._lock:
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+                    if flight.error is None and (keep is None or keep(flight.value)):
+                        self._store(key, flight.value)
+            flight.done.set()
+        return flight.value
+
+    def get(self, key, default=None):
+        "Return a fresh cached value without loading it"
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= self.clock():
+                return default
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, value):
+        "Cache a value that was produced outside get_or_load"
+        with self._lock:
+            self._store(key, value)
+
+    def _store(self, key, value):
+        "Insert a value, evicting the least recently used entries"
+        if self.ttl <= 0 or self.maxsize <= 0:
+            return
+        self._entries[key] = (self.clock() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key=None):
+        "Drop one key, or everything when no key is given"
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+                self._flights.clear()
+            else:
+                self._entries.pop(key, None)
+                self._flights.pop(key, None)
+
+    def invalidate_prefix(self, prefix):
+        "Drop every tuple key that starts with prefix"
+        size = len(prefix)
+        with self._lock:
+            for key in [k for k in self._entries if k[:size] == prefix]:
+                del self._entries[key]
+            for key in [k for k in self._flights if k[:size] == prefix]:
+                del self._flights[key]
+
+    def stats(self):
+        "Hit/miss counters for the cache"
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "Hits": self.hits,
+                "Misses": self.misses,
+                "Evictions": self.evictions,
+                "Size": len(self._entries),
+                "MaxSize": self.maxsize,
+                "TTL": self.ttl,
+                "HitRatio": self.hits / lookups if lookups else 0.0
+            }
+
+
+class _Broadcast:  # pylint: disable=too-few-public-methods
+    """
+    One upstream stream shared by every reader of the same key. Whichever
+    reader runs out of buffered chunks pulls the next one from upstream.
+    """
+
+    def __init__(self, chunks):
+        self.upstream = chunks
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.readers = 0
+        self.pull_lock = threading.Lock()
+
+
+class StreamCache:
+    """
+    Caches the chunks of generated streams. A finished stream is replayed
+    from memory, and concurrent requests for a key that is still streaming
+    follow the one in-flight upstream instead of starting another.
+    """
+
+    def __init__(self, ttl=3600, maxsize=256, clock=time.monotonic):
+        self.finished = TTLCache(ttl=ttl, maxsize=maxsize, clock=clock)
+        self.replays = 0
+        self.coalesced = 0
+        self.misses = 0
+        self._broadcasts = {}
+        self._lock = threading.Lock()
+
+    def stream(self, key, producer):
+        "Iterate the chunks for key, calling producer() for a new upstream on a miss"
+        chunks = self.finished.get(key)
+        if chunks is not None:
+            with self._lock:
+                self.replays += 1
+            return iter(chunks)
+        with self._lock:
+            broadcast = self._broadcasts.get(key)
+            if broadcast is None:
+                broadcast = self._broadcasts[key] = _Broadcast(None)
+                self.misses += 1
+            else:
+                self.coalesced += 1
+            broadcast.readers += 1
+        return self._follow(key, broadcast, producer)
+
+    def _follow(self, key, broadcast, producer):
+        "Yield every chunk of the broadcast, pulling from upstream when needed"
+        position = 0
+        try:
+            while True:
+                if position < len(broadcast.chunks):
+                    position += 1
+                    yield broadcast.chunks[position - 1]
+                    continue
+                if broadcast.done:
+                    if broadcast.error is not None:
+                        raise broadcast.error
+                    return
+                self._pull(key, broadcast, producer, position)
+        finally:
+            self._leave(key, broadcast)
+
+    def _pull(self, key, broadcast, producer, position):
+        "Read the next upstream chunk unless another reader already did"
+        with broadcast.pull_lock:
+            if broadcast.done or len(broadcast.chunks) > position:
+                return
+            try:
+                if broadcast.upstream is None:
+                    broadcast.upstream = iter(producer())
+                broadcast.chunks.append(next(broadcast.upstream))
+            except StopIteration:
+                broadcast.done = True
+                self.finished.put(key, list(broadcast.chunks))
+                self._forget(key, broadcast)
+            except Exception as error: # pylint: disable=broad-except
+                broadcast.error = error
+                broadcast.done = True
+                self._forget(key, broadcast)
+
+    def _leave(self, key, broadcast):
+        "Stop the upstream when the last reader goes away before it finished"
+        with self._lock:
+            broadcast.readers -= 1
+            abandoned = broadcast.readers == 0 and not broadcast.done
+            if abandoned and self._broadcasts.get(key) is broadcast:
+                del self._broadcasts[key]
+        if abandoned:
+            with broadcast.pull_lock:
+                broadcast.done = True
+                close = getattr(broadcast.upstream, "close", None)
+                if close is not None:
+                    close()
+
+    def _forget(self, key, broadcast):
+        "Let the next request for key start afresh"
+        with self._lock:
+            if self._broadcasts.get(key) is broadcast:
+                del self._broadcasts[key]
+
+    def invalidate(self, key=None):
+        "Drop finished streams, one key or everything"
+        self.finished.invalidate(key)
+
+    def stats(self):
+        "Replay, coalescing and miss counters"
+        with self._lock:
+            return {
+                "Replays": self.replays,
+                "Coalesced": self.coalesced,
+                "Misses": self.misses,
+                "Size": self.finished.stats()["Size"],
+                "MaxSize": self.finished.maxsize,
+                "TTL": self.finished.ttl
+            }
@@ -0,0 +1,93 @@
+"""
+AWS clients created on first use and shared by the threads of each process.
+Resources and Tables are not thread safe, so every thread builds its own.
+Nothing is created at import time, and a forked worker builds its own clients
+rather than inheriting the parent's connection pools.
+"""
+import os
+import threading
+import time
+import boto3
+from botocore.config import Config
+from metrics import REGISTRY
+
+# One pool of keep-alive connections per client, big enough for BACKEND_WORKERS
+CLIENT_CONFIG = Config(
+    max_pool_connections=int(os.getenv("AWS_MAX_POOL_CONNECTIONS", "50")),
+    tcp_keepalive=True,
+    connect_timeout=float(os.getenv("AWS_CONNECT_TIMEOUT", "2")),
+    read_timeout=float(os.getenv("AWS_READ_TIMEOUT", "60")),
+    retries={"mode": "standard", "max_attempts": int(os.getenv("AWS_MAX_ATTEMPTS", "3"))}
+)
+
+_lock = threading.Lock()
+_state = {"pid": None, "session": None, "clients": {}}
+_local = threading.local()
+
+def _start_call(model, context, **_kwargs):
+    "Note when an AWS call starts"
+    context["metrics_call"] = (model.service_model.service_name, model.name, time.perf_counter())
+
+def _finish_call(context, **_kwargs):
+    "Record how long an AWS call took, whether or not it failed"
+    backend, operation, began = context.pop("metrics_call", (None, None, None))
+    if backend is not None:
+        REGISTRY.observe_backend(backend, operation, time.perf_counter() - began)
+
+def _process_state():
+    "This process's session and clients, starting afresh after a fork"
+    if _state["pid"] != os.getpid():
+        session = boto3.session.Session()
+        session.events.register("before-parameter-build", _start_call)
+        session.events.register("after-call", _finish_call)
+        session.events.register("after-call-error", _finish_call)
+        _state.update(pid=os.getpid(), session=session, clients={})
+    return _state
+
+def _thread_state(session):
+    "This thread's resources and Tables, starting afresh when the session changes"
+    if getattr(_local, "session", None) is not session:
+        _local.session, _local.resources, _local.tables = session, {}, {}
+    return _local
+
+def client(service):
+    "The shared low-level client for an AWS service"
+    with _lock:
+        state = _process_state()
+        if service not in state["clients"]:
+            state["clients"][service] = state["session"].client(service, config=CLIENT_CONFIG)
+        return state["clients"][service]
+
+def resource(service):
+    "This thread's resource for an AWS service"
+    with _lock:
+        session = _process_state()["session"]
+        resources = _thread_state(session).resources
+        if service not in resources:
+            # The session is shared, so resources are built under the lock too
+            resources[service] = session.resource(service, config=CLIENT_CONFIG)
+        return resources[service]
+
+def table(name):
+    "This thread's DynamoDB Table"
+    dynamodb = resource('dynamodb')
+    tables = _local.tables
+    if name not in tables:
+        tables[name] = dynamodb.Table(name)
+    return tables[name]
+
+def reset():
+    "Forget every client, e.g. after the credentials change"
+    with _lock:
+        _state["pid"] = None
+
+
+class Lazy:  # pylint: disable=too-few-public-methods
+    "Stands in for a module level client or table, creating it on first use"
+
+    def __init__(self, factory, *args):
+        self._factory = factory
+        self._args = args
+
+    def __getattr__(self, name):
+        return getattr(self._factory(*self._args), name)
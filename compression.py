@@ -0,0 +1,102 @@
+"""
+gzip and brotli compression of HTML and JSON responses, negotiated from
+Accept-Encoding. Brotli is used when the Brotli package is installed.
+"""
+import functools
+import gzip
+import zlib
+from flask import request
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+COMPRESSIBLE = {"text/html", "application/json"}
+
+# Streamed bodies are flushed to the client after this many input bytes
+STREAM_FLUSH_BYTES = 8192
+
+def available_encodings():
+    "Encodings this process can produce, best first"
+    return ["br", "gzip"] if brotli is not None else ["gzip"]
+
+def choose_encoding(accept_encodings):
+    "The best encoding the client accepts, or None"
+    for encoding in available_encodings():
+        if accept_encodings[encoding]:
+            return encoding
+    return None
+
+def compress(data, encoding, level):
+    "Compress a whole body"
+    if encoding == "br":
+        return brotli.compress(data, quality=level["br"])
+    return gzip.compress(data, compresslevel=level["gzip"], mtime=0)
+
+def compress_stream(chunks, encoding, level):
+    "Compress a streamed body, flushing every STREAM_FLUSH_BYTES so it keeps streaming"
+    if encoding == "br":
+        compressor = brotli.Compressor(quality=level["br"])
+        process, flush, finish = compressor.process, compressor.flush, compressor.finish
+    else:
+        compressor = zlib.compressobj(level["gzip"], zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        process = compressor.compress
+        flush = functools.partial(compressor.flush, zlib.Z_SYNC_FLUSH)
+        finish = compressor.flush
+    pending = 0
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode("utf-8")
+            data = process(chunk)
+            pending += len(chunk)
+            if pending >= STREAM_FLUSH_BYTES:
+                data += flush()
+                pending = 0
+            if data:
+                yield data
+        yield finish()
+    finally:
+        close = getattr(chunks, "close", None)
+        if close is not None:
+            close()
+
+def init_compression(app, min_size=1024, gzip_level=6, brotli_quality=5):
+    """
+    Compress HTML and JSON responses of at least min_size bytes (any size when
+    streamed) for clients that accept gzip or br
+    """
+    level = {"gzip": gzip_level, "br": brotli_quality}
+
+    @app.after_request
+    def compress_response(response):
+        if response.mimetype not in COMPRESSIBLE or response.status_code < 200 \
+                or response.status_code in (204, 206, 304) \
+                or "Content-Encoding" in response.headers:
+            return response
+        response.vary.add("Accept-Encoding")
+        encoding = choose_encoding(request.accept_encodings)
+        if encoding is None:
+            return response
+        # The compressed bytes differ, so they get their own strong ETag, "<etag>-<encoding>"
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            etag = f"{etag}-{encoding}"
+            if request.if_none_match.contains(etag):
+                response.set_etag(etag)
+                return response.make_conditional(request)
+        if response.is_streamed:
+            response.response = compress_stream(response.response, encoding, level)
+            response.headers.pop("Content-Length", None)
+        else:
+            data = response.get_data()
+            if len(data) < min_size:
+                return response
+            response.set_data(compress(data, encoding, level))
+        response.headers["Content-Encoding"] = encoding
+        if etag and not weak:
+            response.set_etag(etag)
+        return response
+
+    return app
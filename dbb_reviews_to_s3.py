@@ -1,34 +1,673 @@
-""" 
+"""
 This script reads all the reviews in the Dynamo table and creates files in S3
-for the Bedrock knowledge base data source
+for the Bedrock knowledge base data source.
+
+The table is scanned page by page (optionally as a parallel segmented scan),
+uploads run on a bounded thread pool with retries, and progress is saved to a
+checkpoint file so an interrupted export resumes where it stopped.
+
+With --incremental a local manifest of content hashes is kept so that only new
+or changed reviews are uploaded, and --delete-removed also deletes the files of
+reviews that are no longer in the table.
+
+With --bundle the reviews of each city are instead packed into size-bounded
+documents, one series per star rating so the City and Stars metadata filters
+keep working, and streamed to S3 with multipart uploads. Every other object
+of a bundled city, older bundles or per-review files, is then deleted, so the
+knowledge base never holds a review twice. Switching back to per-review files
+needs --delete-bundles.
 """
+import argparse
+import bisect
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
 import json
 import os
+import re
+import sqlite3
+import threading
+import time
+import uuid
 import boto3
+from botocore.config import Config
+from boto3.dynamodb.conditions import Key
+from aws_helpers import (
+    NO_CLIENT_RETRIES, decode_cursor, encode_cursor, iter_items, iter_pages, with_retries
+)
+
+DEFAULT_CHECKPOINT = "reviews_export.checkpoint.json"
+DEFAULT_MANIFEST = "reviews_export.manifest.db"
+# DeleteObjects accepts at most this many keys per call
+DELETE_BATCH = 1000
+# Smallest part S3 accepts for every part of a multipart upload but the last
+PART_SIZE = 5 * 1024 * 1024
+DEFAULT_BUNDLE_BYTES = 10 * 1024 * 1024
+BUNDLE_SEPARATOR = b"\n\n"
+# The documents and metadata files of --bundle exports
+BUNDLE_KEY = re.compile(r"_[1-5]stars_\d{4}\.txt(\.metadata\.json)?$")
+
+def review_key(review):
+    "The {city}_{review_id} name shared by a review's files"
+    return f"{review['CityName']}_{review['ReviewId']}"
+
+def object_keys(key):
+    "The review file and metadata file names for a review key"
+    return [f"{key}.txt", f"{key}.txt.metadata.json"]
+
+def review_objects(review):
+    "The review file and its metadata file for the knowledge base"
+    metadata = {"metadataAttributes": {"City": review['CityName'], "Stars": int(review['Stars'])}}
+    file_name, metadata_file_name = object_keys(review_key(review))
+    return [
+        (file_name, review['ReviewContent']),
+        (metadata_file_name, json.dumps(metadata))
+    ]
+
+def content_hash(objects):
+    "Hash of everything that would be uploaded for a review"
+    digest = hashlib.sha256()
+    for key, body in objects:
+        digest.update(key.encode("utf-8"))
+        digest.update(b"\0")
+        digest.update(body.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+def upload_objects(s3, bucket, objects):
+    "Save the review and metadata files to the S3 bucket"
+    for key, body in objects:
+        with_retries(s3.put_object, Body=body, Bucket=bucket, Key=key)
+
+def list_keys(s3, bucket, prefix=""):
+    "Every object key in the S3 bucket under prefix"
+    kwargs = {"Bucket": bucket, "Prefix": prefix}
+    while True:
+        response = with_retries(s3.list_objects_v2, **kwargs)
+        for item in response.get("Contents", []):
+            yield item["Key"]
+        if not response.get("IsTruncated"):
+            return
+        kwargs["ContinuationToken"] = response["NextContinuationToken"]
+
+def delete_objects(s3, bucket, keys):
+    "Delete objects from the S3 bucket in batches"
+    for start in range(0, len(keys), DELETE_BATCH):
+        batch = [{"Key": key} for key in keys[start:start + DELETE_BATCH]]
+        with_retries(s3.delete_objects, Bucket=bucket, Delete={"Objects": batch, "Quiet": True})
+
+class Manifest:
+    """
+    Content hash of every exported review, kept in SQLite so each page can be
+    recorded cheaply. Every row remembers the last run that saw the review.
+    """
+
+    def __init__(self, path):
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS manifest "
+                "(key TEXT PRIMARY KEY, hash TEXT NOT NULL, run TEXT NOT NULL)"
+            )
+
+    def hashes(self, keys):
+        "The recorded hash of each key that has been exported before"
+        found = {}
+        with self._lock:
+            # Stay well under SQLite's limit on bound parameters
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                marks = ",".join("?" * len(batch))
+                rows = self._db.execute(
+                    f"SELECT key, hash FROM manifest WHERE key IN ({marks})", batch
+                )
+                found.update(rows.fetchall())
+        return found
+
+    def record(self, entries, run_id):
+        "Save the (key, hash) pairs seen by this run"
+        with self._lock, self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO manifest (key, hash, run) VALUES (?, ?, ?)",
+                [(key, digest, run_id) for key, digest in entries]
+            )
+
+    def unseen(self, run_id):
+        "Keys that this run did not see, because the review was removed"
+        with self._lock:
+            rows = self._db.execute("SELECT key FROM manifest WHERE run != ?", (run_id,))
+            return [key for (key,) in rows.fetchall()]
+
+    def remove(self, keys):
+        "Forget deleted keys"
+        with self._lock, self._db:
+            self._db.executemany("DELETE FROM manifest WHERE key = ?", [(key,) for key in keys])
+
+    def close(self):
+        "Close the database"
+        self._db.close()
+
+class SyncCounts:  # pylint: disable=too-few-public-methods
+    "How many reviews were uploaded, skipped and deleted"
+
+    def __init__(self):
+        self.uploaded = 0
+        self.skipped = 0
+        self.deleted = 0
+        self._lock = threading.Lock()
+
+    def add(self, uploaded=0, skipped=0, deleted=0):
+        "Add to the counters"
+        with self._lock:
+            self.uploaded += uploaded
+            self.skipped += skipped
+            self.deleted += deleted
+
+class Checkpoint:
+    "Scan position of each segment, saved to disk after every page"
+
+    def __init__(self, path, total_segments):
+        self.path = path
+        self.total_segments = total_segments
+        self.run_id = uuid.uuid4().hex
+        self.exported = 0
+        self.segments = {}
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path, encoding="utf-8") as file:
+                saved = json.load(file)
+            if saved.get("Layout") == "bundle":
+                raise ValueError(
+                    f"{path} was written by a --bundle export, use --bundle or --restart"
+                )
+            if saved["TotalSegments"] != total_segments:
+                raise ValueError(
+                    f"{path} was written for {saved['TotalSegments']} segments, "
+                    "use the same --segments or --restart"
+                )
+            # Checkpoints from before incremental exports have no RunId, they continue as a new run
+            self.run_id = saved.get("RunId") or self.run_id
+            self.exported = saved["Exported"]
+            self.segments = {int(k): v for k, v in saved["Segments"].items()}
+
+    def start_key(self, segment):
+        "Where the scan of a segment should resume, None to start from the top"
+        return decode_cursor(self.segments.get(segment, {}).get("Cursor"))
+
+    def is_done(self, segment):
+        "True when the segment was fully exported by an earlier run"
+        return self.segments.get(segment, {}).get("Done", False)
+
+    def advance(self, segment, last_key, count):
+        "Record that a page was exported and save the checkpoint"
+        with self._lock:
+            self.exported += count
+            self.segments[segment] = {"Cursor": encode_cursor(last_key), "Done": not last_key}
+            self._save()
+
+    def _save(self):
+        "Write the checkpoint atomically"
+        if not self.path:
+            return
+        state = {
+            "TotalSegments": self.total_segments,
+            "RunId": self.run_id,
+            "Exported": self.exported,
+            "Segments": self.segments
+        }
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as file:
+            json.dump(state, file)
+        os.replace(temp_path, self.path)
+
+class Progress:
+    "Prints throughput and ETA at most every interval seconds"
+
+    def __init__(self, total, done=0, interval=5.0):
+        self.total = total
+        self.done = done
+        self.interval = interval
+        self.started = time.monotonic()
+        self.since_start = 0
+        self.last_report = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, count, force=False):
+        "Count exported reviews and report if it is time to"
+        with self._lock:
+            self.done += count
+            self.since_start += count
+            now = time.monotonic()
+            if force or now - self.last_report >= self.interval:
+                self.last_report = now
+                print(self.report(now - self.started), flush=True)
+
+    def report(self, elapsed):
+        "One line of progress"
+        rate = self.since_start / elapsed if elapsed > 0 else 0.0
+        line = f"Exported {self.done} reviews, {rate:.1f} reviews/s"
+        if self.total and rate:
+            remaining = max(self.total - self.done, 0) / rate
+            line += f", {self.done * 100 // max(self.total, 1)}% of ~{self.total}"
+            line += f", ETA {int(remaining // 60)}m{int(remaining % 60):02d}s"
+        return line
+
+def export_page(items, s3, bucket, uploads, manifest, run_id, counts):
+    "Upload one page of reviews, skipping those the manifest says are unchanged"
+    # pylint: disable=too-many-arguments, too-many-positional-arguments
+    pending = [(review_key(review), review_objects(review)) for review in items]
+    hashes = {}
+    if manifest is not None and pending:
+        hashes = {key: content_hash(objects) for key, objects in pending}
+        known = manifest.hashes(list(hashes))
+        pending = [(key, objects) for key, objects in pending if known.get(key) != hashes[key]]
+    futures = [uploads.submit(upload_objects, s3, bucket, objects) for _, objects in pending]
+    for future in futures:
+        future.result()
+    if hashes:
+        manifest.record(hashes.items(), run_id)
+    counts.add(uploaded=len(pending), skipped=len(items) - len(pending))
+
+def export_segment(table, s3, bucket, segment, export):
+    "Scan one segment page by page and upload each page before reading the next"
+    checkpoint = export["Checkpoint"]
+    if checkpoint.is_done(segment):
+        return
+    kwargs = {}
+    if checkpoint.total_segments > 1:
+        kwargs = {"Segment": segment, "TotalSegments": checkpoint.total_segments}
+    start_key = checkpoint.start_key(segment)
+    if start_key:
+        kwargs["ExclusiveStartKey"] = start_key
+    for page in iter_pages(lambda **args: with_retries(table.scan, **args), **kwargs):
+        export_page(
+            page['Items'], s3, bucket, export["Uploads"], export["Manifest"],
+            checkpoint.run_id, export["Counts"]
+        )
+        checkpoint.advance(segment, page.get('LastEvaluatedKey'), len(page['Items']))
+        export["Progress"].add(len(page['Items']))
+
+def export_reviews(open_table, s3, bucket, segments=1, workers=16, checkpoint=None,
+                   manifest=None, delete_removed=False):
+    """
+    Export every review in the table to the bucket. Returns the number of
+    reviews exported, uploaded, skipped as unchanged and deleted.
+    """
+    # pylint: disable=too-many-arguments, too-many-positional-arguments
+    checkpoint = checkpoint or Checkpoint(None, segments)
+    counts = SyncCounts()
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="upload") as uploads, \
+            ThreadPoolExecutor(max_workers=segments, thread_name_prefix="scan") as scans:
+        export = {
+            "Checkpoint": checkpoint,
+            "Manifest": manifest,
+            "Uploads": uploads,
+            "Counts": counts,
+            "Progress": Progress(
+                with_retries(lambda: open_table().item_count), done=checkpoint.exported
+            )
+        }
+        futures = [
+            # Resources are not thread safe, so every segment opens its own table
+            scans.submit(export_segment, open_table(), s3, bucket, segment, export)
+            for segment in range(segments)
+        ]
+        for future in futures:
+            future.result()
+    export["Progress"].add(0, force=True)
+
+    if manifest is not None and delete_removed:
+        removed = manifest.unseen(checkpoint.run_id)
+        delete_objects(s3, bucket, [key for review in removed for key in object_keys(review)])
+        manifest.remove(removed)
+        counts.add(deleted=len(removed))
+    return {
+        "Exported": checkpoint.exported,
+        "Uploaded": counts.uploaded,
+        "Skipped": counts.skipped,
+        "Deleted": counts.deleted
+    }
+
+class MultipartWriter:  # pylint: disable=too-many-instance-attributes
+    "Streams an object to S3, switching to a multipart upload once it outgrows one part"
+
+    def __init__(self, s3, bucket, key, part_size=PART_SIZE):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.size = 0
+        self._buffer = bytearray()
+        self._upload_id = None
+        self._parts = []
+
+    def write(self, data):
+        "Append bytes, uploading a part whenever a full one is buffered"
+        self._buffer += data
+        self.size += len(data)
+        while len(self._buffer) >= self.part_size:
+            self._upload_part(bytes(self._buffer[:self.part_size]))
+            del self._buffer[:self.part_size]
+
+    def _upload_part(self, body):
+        "Upload the next part, starting the multipart upload if needed"
+        if self._upload_id is None:
+            self._upload_id = with_retries(
+                self.s3.create_multipart_upload, Bucket=self.bucket, Key=self.key
+            )["UploadId"]
+        number = len(self._parts) + 1
+        response = with_retries(
+            self.s3.upload_part, Body=body, Bucket=self.bucket, Key=self.key,
+            PartNumber=number, UploadId=self._upload_id
+        )
+        self._parts.append({"ETag": response["ETag"], "PartNumber": number})
+
+    def close(self):
+        "Finish the object, with a plain put if it fitted in one part"
+        if self._upload_id is None:
+            with_retries(
+                self.s3.put_object, Body=bytes(self._buffer), Bucket=self.bucket, Key=self.key
+            )
+            return
+        if self._buffer:
+            self._upload_part(bytes(self._buffer))
+        with_retries(
+            self.s3.complete_multipart_upload, Bucket=self.bucket, Key=self.key,
+            UploadId=self._upload_id, MultipartUpload={"Parts": self._parts}
+        )
+
+    def abort(self):
+        "Throw away a partly uploaded object"
+        if self._upload_id is not None:
+            with_retries(
+                self.s3.abort_multipart_upload, Bucket=self.bucket, Key=self.key,
+                UploadId=self._upload_id
+            )
+
+def bundle_key(city_name, stars, number):
+    "The name of a city's number'th document of stars star reviews"
+    return f"{city_name}_{stars}stars_{number:04d}.txt"
+
+class BundleWriter:  # pylint: disable=too-many-instance-attributes
+    "Packs the reviews of one city and star rating into numbered, size-bounded documents"
+
+    def __init__(self, s3, bucket, city_name, stars, bundle_bytes, part_size=PART_SIZE):
+        # pylint: disable=too-many-arguments, too-many-positional-arguments
+        self.s3 = s3
+        self.bucket = bucket
+        self.city_name = city_name
+        self.stars = stars
+        self.bundle_bytes = bundle_bytes
+        self.part_size = part_size
+        self.bundles = 0
+        self.keys = []
+        self._writer = None
+
+    def add(self, content):
+        "Append a review, starting a new document when this one is full"
+        data = content.encode("utf-8")
+        if (self._writer
+                and self._writer.size + len(BUNDLE_SEPARATOR) + len(data) > self.bundle_bytes):
+            self._finish()
+        if self._writer is None:
+            key = bundle_key(self.city_name, self.stars, self.bundles + 1)
+            self._writer = MultipartWriter(self.s3, self.bucket, key, self.part_size)
+        else:
+            self._writer.write(BUNDLE_SEPARATOR)
+        self._writer.write(data)
+
+    def _finish(self):
+        "Complete the current document and write its metadata file"
+        self._writer.close()
+        metadata = {"metadataAttributes": {"City": self.city_name, "Stars": self.stars}}
+        with_retries(
+            self.s3.put_object, Body=json.dumps(metadata), Bucket=self.bucket,
+            Key=f"{self._writer.key}.metadata.json"
+        )
+        self.keys += [self._writer.key, f"{self._writer.key}.metadata.json"]
+        self.bundles += 1
+        self._writer = None
+
+    def close(self):
+        "Complete the last document"
+        if self._writer is not None:
+            self._finish()
+
+    def abort(self):
+        "Throw away the document being written"
+        if self._writer is not None:
+            self._writer.abort()
+            self._writer = None
+
+def bundle_city(table, s3, bucket, city_name, bundle_bytes, part_size=PART_SIZE):
+    "Bundle every review of one city, returning the number of reviews and the keys written"
+    # pylint: disable=too-many-arguments, too-many-positional-arguments
+    writers = {}
+    reviews = 0
+    items = iter_items(
+        lambda **args: with_retries(table.query, **args),
+        KeyConditionExpression=Key('CityName').eq(city_name),
+        ProjectionExpression="ReviewContent, Stars"
+    )
+    try:
+        for review in items:
+            stars = int(review['Stars'])
+            if stars not in writers:
+                writers[stars] = BundleWriter(s3, bucket, city_name, stars, bundle_bytes, part_size)
+            writers[stars].add(review['ReviewContent'])
+            reviews += 1
+        for writer in writers.values():
+            writer.close()
+    except BaseException:
+        for writer in writers.values():
+            writer.abort()
+        raise
+    return reviews, [key for writer in writers.values() for key in writer.keys]
+
+def other_city_prefixes(sorted_names, city_name):
+    "The key prefixes of the other cities whose keys also start with this city's prefix"
+    prefix = f"{city_name}_"
+    found = []
+    for name in sorted_names[bisect.bisect_left(sorted_names, prefix):]:
+        if not name.startswith(prefix):
+            break
+        found.append(f"{name}_")
+    return tuple(found)
+
+def stale_city_objects(s3, bucket, city_name, written, others=()):
+    "The objects of a city that were not just written: older bundles and per-review files"
+    return [
+        key for key in list_keys(s3, bucket, f"{city_name}_")
+        if key not in written and not key.startswith(others)
+    ]
+
+class BundleCheckpoint:
+    "Cities a --bundle export has finished, saved to disk after each one"
+
+    def __init__(self, path):
+        self.path = path
+        self.done = set()
+        self.exported = 0
+        self.objects = 0
+        self.deleted = 0
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path, encoding="utf-8") as file:
+                saved = json.load(file)
+            if saved.get("Layout") != "bundle":
+                raise ValueError(
+                    f"{path} was written by a per-review export, drop --bundle or use --restart"
+                )
+            self.done = set(saved["Done"])
+            self.exported = saved["Exported"]
+            self.objects = saved["Objects"]
+            self.deleted = saved["Deleted"]
+
+    def is_done(self, city_name):
+        "True when the city was bundled by an earlier run"
+        return city_name in self.done
+
+    def finish(self, city_name, reviews, objects, deleted):
+        "Record that a city was bundled and save the checkpoint"
+        with self._lock:
+            self.done.add(city_name)
+            self.exported += reviews
+            self.objects += objects
+            self.deleted += deleted
+            if not self.path:
+                return
+            state = {
+                "Layout": "bundle",
+                "Done": sorted(self.done),
+                "Exported": self.exported,
+                "Objects": self.objects,
+                "Deleted": self.deleted
+            }
+            temp_path = f"{self.path}.tmp"
+            with open(temp_path, "w", encoding="utf-8") as file:
+                json.dump(state, file)
+            os.replace(temp_path, self.path)
+
+def export_bundles(open_table, s3, bucket, city_names, workers=16,
+                   bundle_bytes=DEFAULT_BUNDLE_BYTES, part_size=PART_SIZE, checkpoint=None):
+    """
+    Bundle the reviews of every city in parallel, one city per task, deleting
+    the city's other objects once its bundles are written. Returns the number
+    of reviews exported and objects written and deleted.
+    """
+    # pylint: disable=too-many-arguments, too-many-positional-arguments
+    checkpoint = checkpoint or BundleCheckpoint(None)
+    sorted_names = sorted(city_names)
+    tables = threading.local()
+    progress = Progress(None, done=checkpoint.exported)
+
+    def export_city(city_name):
+        # Resources are not thread safe, so every worker opens its own table
+        if not hasattr(tables, "table"):
+            tables.table = open_table()
+        reviews, written = bundle_city(tables.table, s3, bucket, city_name, bundle_bytes, part_size)
+        stale = stale_city_objects(
+            s3, bucket, city_name, set(written), other_city_prefixes(sorted_names, city_name)
+        )
+        delete_objects(s3, bucket, stale)
+        checkpoint.finish(city_name, reviews, len(written), len(stale))
+        progress.add(reviews)
+
+    pending = [city_name for city_name in city_names if not checkpoint.is_done(city_name)]
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bundle") as pool:
+        list(pool.map(export_city, pending))
+    progress.add(0, force=True)
+    return {
+        "Exported": checkpoint.exported,
+        "Objects": checkpoint.objects,
+        "Deleted": checkpoint.deleted
+    }
+
+def unlisted_cities(city_names, reviewed_names):
+    "Cities that have reviews but are missing from the list of cities, sorted"
+    return sorted(set(reviewed_names) - set(city_names))
+
+def main():
+    "Export the CityReviews table to the knowledge base bucket"
+    # pylint: disable=too-many-branches, too-many-statements
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--bucket", default=os.getenv("KNOWLEDGE_BASE_BUCKET"))
+    parser.add_argument("--table", default="CityReviews")
+    parser.add_argument("--segments", type=int, default=1, help="parallel scan segments")
+    parser.add_argument("--workers", type=int, default=16, help="concurrent uploads")
+    parser.add_argument("--checkpoint", default=DEFAULT_CHECKPOINT)
+    parser.add_argument("--restart", action="store_true", help="ignore an existing checkpoint")
+    parser.add_argument("--incremental", action="store_true",
+                        help="only upload reviews that changed since the last run")
+    parser.add_argument("--manifest", default=DEFAULT_MANIFEST)
+    parser.add_argument("--delete-removed", action="store_true",
+                        help="with --incremental, delete files of reviews no longer in the table")
+    parser.add_argument("--bundle", action="store_true",
+                        help="pack reviews per city and star rating into larger documents")
+    parser.add_argument("--bundle-bytes", type=int, default=DEFAULT_BUNDLE_BYTES)
+    parser.add_argument("--cities-table", default="Cities",
+                        help="with --bundle, the table listing the cities to export")
+    parser.add_argument("--stats-table", default="CityReviewStats",
+                        help="with --bundle, the table listing the cities that have reviews")
+    parser.add_argument("--delete-bundles", action="store_true",
+                        help="without --bundle, delete the documents of an earlier --bundle export")
+    args = parser.parse_args()
+    if not args.bucket:
+        parser.error("set KNOWLEDGE_BASE_BUCKET or pass --bucket")
+    if args.delete_removed and not args.incremental:
+        parser.error("--delete-removed needs --incremental")
+    if args.bundle and args.incremental:
+        parser.error("--bundle always writes every bundle, it cannot go with --incremental")
+    if args.bundle and args.segments > 1:
+        parser.error("--bundle exports --workers cities at a time, it does not scan in --segments")
+
+    if args.restart and os.path.exists(args.checkpoint):
+        os.remove(args.checkpoint)
+    # Every call goes through with_retries, so the clients do not retry on their own
+    s3 = boto3.client(
+        's3', config=Config(max_pool_connections=args.workers, retries=NO_CLIENT_RETRIES)
+    )
+
+    def open_table():
+        dynamodb = boto3.session.Session().resource(
+            'dynamodb', config=Config(retries=NO_CLIENT_RETRIES)
+        )
+        return dynamodb.Table(args.table)
+
+    if args.bundle:
+        dynamodb = boto3.resource('dynamodb', config=Config(retries=NO_CLIENT_RETRIES))
+        cities_table = dynamodb.Table(args.cities_table)
+        stats_table = dynamodb.Table(args.stats_table)
+        city_names = [item['CityName'] for item in iter_items(
+            lambda **kwargs: with_retries(cities_table.scan, **kwargs),
+            ProjectionExpression="CityName"
+        )]
+        reviewed = iter_items(
+            lambda **kwargs: with_retries(stats_table.scan, **kwargs),
+            ProjectionExpression="CityName"
+        )
+        unlisted = unlisted_cities(city_names, (item['CityName'] for item in reviewed))
+        if unlisted:
+            print(f"Warning: skipping the reviews of {len(unlisted)} cities missing from "
+                  f"{args.cities_table}: " + ", ".join(unlisted[:20])
+                  + (", ..." if len(unlisted) > 20 else ""), flush=True)
+        # The per-review files it lists are deleted, so a later incremental run must upload them all
+        if os.path.exists(args.manifest):
+            os.remove(args.manifest)
+        result = export_bundles(
+            open_table, s3, args.bucket, city_names, args.workers, args.bundle_bytes,
+            checkpoint=BundleCheckpoint(args.checkpoint)
+        )
+        print(f"Bundled {result['Exported']} reviews into {result['Objects']} objects, "
+              f"deleted {result['Deleted']} older objects")
+        if os.path.exists(args.checkpoint):
+            os.remove(args.checkpoint)
+        return
+
+    # Bundles left by a --bundle export would index every review twice
+    bundles = [key for key in list_keys(s3, args.bucket) if BUNDLE_KEY.search(key)]
+    if bundles and not args.delete_bundles:
+        parser.error(f"{args.bucket} holds {len(bundles)} objects of a --bundle export, "
+                     "pass --delete-bundles to delete them once this export is done")
+
+    checkpoint = Checkpoint(args.checkpoint, args.segments)
+    manifest = Manifest(args.manifest) if args.incremental else None
+    result = export_reviews(
+        open_table, s3, args.bucket, args.segments, args.workers, checkpoint,
+        manifest, args.delete_removed
+    )
+    if manifest is not None:
+        manifest.close()
+    print(
+        f"Uploaded {result['Uploaded']}, skipped {result['Skipped']} unchanged, "
+        f"deleted {result['Deleted']} removed reviews"
+    )
+    if bundles:
+        delete_objects(s3, args.bucket, bundles)
+        print(f"Deleted {len(bundles)} objects of the earlier --bundle export")
+    # A finished export should start from scratch next time
+    if os.path.exists(args.checkpoint):
+        os.remove(args.checkpoint)
 
-# Create a Boto3 clients for DynamoDB and S3
-dynamodb = boto3.resource('dynamodb')
-s3 = boto3.client('s3')
-reviews_table = dynamodb.Table('CityReviews')
-
-reviews = reviews_table.scan()['Items']
-for review in reviews:
-    city_name = review['CityName']
-    review_content = review['ReviewContent']
-    review_id = review['ReviewId']
-    stars = review['Stars']
-    metadata = {"metadataAttributes": {"City": city_name, "Stars": int(stars)}}
-
-    file_name = f"{city_name}_{review_id}.txt"
-    metadata_file_name = f"{city_name}_{review_id}.txt.metadata.json"
-
-    # save the meta data and review files to the s3 bucket
-    print(f"Saving {file_name} and metadata to S3")
-    s3.put_object(
-        Body=review_content,
-        Bucket=os.getenv("KNOWLEDGE_BASE_BUCKET"),
-        Key=file_name)
-    s3.put_object(
-        Body=json.dumps(metadata),
-        Bucket=os.getenv("KNOWLEDGE_BASE_BUCKET"),
-        Key=metadata_file_name)
+if __name__ == '__main__':
+    main()
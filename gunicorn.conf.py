@@ -0,0 +1,14 @@
+"Gunicorn settings for the City Info App"
+import os
+
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:5000")
+workers = int(os.getenv("GUNICORN_WORKERS", "2"))
+# gevent workers multiplex many long model streams per process, a sync worker
+# is tied up for the whole length of each one
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gevent")
+worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", "1000"))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))
+# Import the app once in the master and fork the workers from it, so data it
+# maps at import (the CATALOGUE_SNAPSHOT) is shared from the start; off by
+# default because gevent then patches the workers after the app's imports
+preload_app = os.getenv("GUNICORN_PRELOAD", "false").lower() == "true"
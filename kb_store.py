@@ -0,0 +1,109 @@
+"Persistent store of precomputed knowledge base answers"
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+class KBAnswerStore:
+    """
+    Answers to the fixed KB prompts, one per (city, prompt), kept in SQLite.
+    Answers older than max_age are still served while a background refresh
+    replaces them (stale-while-revalidate).
+    """
+
+    def __init__(self, path, max_age=86400, refresh_workers=2, clock=time.time):
+        self.max_age = max_age
+        self.clock = clock
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._refreshing = {}
+        self._pool = ThreadPoolExecutor(
+            max_workers=refresh_workers, thread_name_prefix="kb-refresh"
+        )
+        with self._lock, self._db:
+            if path != ":memory:":
+                self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS answers (city TEXT NOT NULL, prompt INTEGER NOT NULL, "
+                "answer TEXT NOT NULL, updated REAL NOT NULL, PRIMARY KEY (city, prompt))"
+            )
+
+    def get(self, city, prompt):
+        "The stored answer and whether it is stale, or None if there is none"
+        with self._lock:
+            row = self._db.execute(
+                "SELECT answer, updated FROM answers WHERE city = ? AND prompt = ?", (city, prompt)
+            ).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), self.clock() - row[1] > self.max_age
+
+    def put(self, city, prompt, answer):
+        "Store a freshly computed answer"
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO answers (city, prompt, answer, updated) "
+                "VALUES (?, ?, ?, ?)",
+                (city, prompt, json.dumps(answer), self.clock())
+            )
+
+    def clear(self):
+        "Forget every answer"
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM answers")
+
+    def answer(self, city, prompt, compute):
+        "Serve the stored answer, computing it now only if there is none"
+        found = self.get(city, prompt)
+        if found is None:
+            answer = compute()
+            self.put(city, prompt, answer)
+            return answer
+        answer, stale = found
+        if stale:
+            self.refresh(city, prompt, compute)
+        return answer
+
+    def refresh(self, city, prompt, compute):
+        "Recompute an answer in the background, once per (city, prompt)"
+        key = (city, prompt)
+        with self._lock:
+            if key in self._refreshing:
+                return self._refreshing[key]
+            future = self._refreshing[key] = self._pool.submit(self._recompute, key, compute)
+        return future
+
+    def _recompute(self, key, compute):
+        "Run a refresh and store its result, keeping the stale answer if it fails"
+        try:
+            self.put(key[0], key[1], compute())
+        except Exception:  # pylint: disable=broad-except
+            # Nobody waits on the refresh, so this is the only trace of the failure
+            logger.exception("Refreshing the answer to prompt %s for %s failed", key[1], key[0])
+        finally:
+            with self._lock:
+                del self._refreshing[key]
+
+    def precompute(self, cities, prompt_count, compute, workers=4):
+        """
+        Fill in the answer for every (city, prompt) pair. A pair that fails is
+        logged and skipped, so one throttled call does not lose the others.
+        Returns how many answers were stored and how many failed.
+        """
+        pairs = [(city, prompt) for city in cities for prompt in range(prompt_count)]
+
+        def store(pair):
+            try:
+                self.put(pair[0], pair[1], compute(*pair))
+                return True
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Answering prompt %s for %s failed", pair[1], pair[0])
+                return False
+
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="kb-precompute") as pool:
+            stored = sum(pool.map(store, pairs))
+        return stored, len(pairs) - stored
@@ -0,0 +1,324 @@
+"""
+Request timing metrics for the Flask apps, exposed in the Prometheus text
+format at /metrics, and a sampling profiler that a single request can switch
+on with the X-Profile header.
+"""
+from collections import Counter
+import contextvars
+import hmac
+import re
+import sys
+import threading
+import time
+from flask import g, request, before_render_template, template_rendered
+from admission import release_after
+
+# Histogram buckets in seconds, from a cache hit to a long model call
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+PROFILE_HEADER = "X-Profile"
+
+# The route being served, carried into backend_pool threads with copy_context
+current_route = contextvars.ContextVar("current_route", default="none")
+
+def _escape(value):
+    "Escape a label value"
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(names, values):
+    "Render {name='value',...}, or nothing without labels"
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+def _snake_case(name):
+    "HitRatio -> hit_ratio, TTL -> ttl"
+    return re.sub(r"(?<=[a-z0-9])(?=[A-Z])", "_", name).lower()
+
+
+class _Metric:  # pylint: disable=too-few-public-methods
+    "A named metric with one value per combination of label values"
+
+    kind = None
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def render(self):
+        "The HELP and TYPE lines followed by the samples"
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} {self.kind}"
+        with self._lock:
+            values = sorted(self._values.items())
+        for label_values, value in values:
+            yield from self._samples(label_values, value)
+
+    def _samples(self, label_values, value):
+        "Sample lines for one combination of label values"
+        yield f"{self.name}{_format_labels(self.labels, label_values)} {value}"
+
+
+class CounterMetric(_Metric):
+    "A value that only goes up"
+
+    kind = "counter"
+
+    def inc(self, *label_values, amount=1):
+        "Add amount"
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def value(self, *label_values):
+        "The current count"
+        with self._lock:
+            return self._values.get(label_values, 0)
+
+
+class GaugeMetric(CounterMetric):
+    "A value that goes up and down"
+
+    kind = "gauge"
+
+    def dec(self, *label_values):
+        "Subtract one"
+        self.inc(*label_values, amount=-1)
+
+
+class HistogramMetric(_Metric):
+    "Observations counted into cumulative buckets"
+
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, seconds, *label_values):
+        "Record one observation"
+        with self._lock:
+            counts = self._values.get(label_values)
+            if counts is None:
+                # One count per bucket, then +Inf, the count and the sum
+                counts = self._values[label_values] = [0] * (len(self.buckets) + 1) + [0, 0.0]
+            for position, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    counts[position] += 1
+            counts[len(self.buckets)] += 1
+            counts[-2] += 1
+            counts[-1] += seconds
+
+    def count(self, *label_values):
+        "How many observations were recorded"
+        with self._lock:
+            counts = self._values.get(label_values)
+            return counts[-2] if counts else 0
+
+    def _samples(self, label_values, value):
+        names = self.labels + ("le",)
+        for bound, count in zip(self.buckets + ("+Inf",), value):
+            yield f"{self.name}_bucket{_format_labels(names, label_values + (bound,))} {count}"
+        labels = _format_labels(self.labels, label_values)
+        yield f"{self.name}_count{labels} {value[-2]}"
+        yield f"{self.name}_sum{labels} {value[-1]}"
+
+
+class Registry:
+    "Every metric of a process, plus collectors that read other counters on demand"
+
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+        self.requests = self.add(CounterMetric(
+            "http_requests_total", "Requests served", ("route", "method", "status")
+        ))
+        self.in_flight = self.add(GaugeMetric(
+            "http_requests_in_flight", "Requests being served", ("route",)
+        ))
+        self.request_seconds = self.add(HistogramMetric(
+            "http_request_duration_seconds",
+            "Time per request (total), per template render (render) and per backend call (backend)",
+            ("route", "phase")
+        ))
+        self.backend_seconds = self.add(HistogramMetric(
+            "backend_call_duration_seconds", "Time per backend call", ("backend", "operation")
+        ))
+
+    def add(self, metric):
+        "Register a metric"
+        self.metrics.append(metric)
+        return metric
+
+    def add_caches(self, caches):
+        "Export the stats() of named caches as cache_* gauges"
+        self.add_stats("cache", "cache", caches)
+
+    def add_stats(self, prefix, label, sources):
+        "Export the numeric stats() of named objects as prefix_* gauges labelled with their names"
+        def collect():
+            stats = {name: source.stats() for name, source in sources.items()}
+            keys = sorted({key for values in stats.values() for key in values})
+            for key in keys:
+                gauge = GaugeMetric(
+                    f"{prefix}_{_snake_case(key)}", f"{key} from the {prefix} stats", (label,)
+                )
+                for name, values in stats.items():
+                    if key in values:
+                        gauge.inc(name, amount=values[key])
+                yield gauge
+        self.collectors.append(collect)
+
+    def observe_backend(self, backend, operation, seconds):
+        "Record one backend call against the backend and the current route"
+        self.backend_seconds.observe(seconds, backend, operation)
+        self.request_seconds.observe(seconds, current_route.get(), "backend")
+
+    def render(self):
+        "Everything in the Prometheus text exposition format"
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        for collect in self.collectors:
+            for metric in collect():
+                lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+# The metrics of this process
+REGISTRY = Registry()
+
+
+class Sampler:
+    """
+    Samples the stack of one thread every interval seconds from a background
+    thread, counting collapsed stacks (the input format of flamegraph.pl)
+    """
+
+    def __init__(self, thread_id, interval=0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+
+    def start(self):
+        "Start sampling"
+        self._thread.start()
+        return self
+
+    def stop(self):
+        "Stop sampling and return the collapsed stacks"
+        self._stop.set()
+        self._thread.join()
+        return self.collapsed()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)  # pylint: disable=protected-access
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({code.co_filename}:{frame.f_lineno})")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def collapsed(self):
+        "One 'frame;frame;frame count' line per distinct stack"
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+
+def instrument(app, registry=REGISTRY, caches=None, profile_token=None):
+    """
+    Time every request of a Flask app and serve the registry at /metrics.
+    When profile_token is set, a request whose X-Profile header equals it is
+    answered with its sampled stacks instead of its body.
+    """
+    # pylint: disable=too-many-statements
+    renders = threading.local()
+    if caches:
+        registry.add_caches(caches)
+
+    @app.before_request
+    def start_timing():
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        started = time.perf_counter()
+        g.metrics_route = route
+        g.metrics_started = started
+        current_route.set(route)
+        registry.in_flight.inc(route)
+        finished = []
+
+        def finish_stream():
+            # Once only, whether the body finished streaming or the client went away
+            if not finished:
+                finished.append(True)
+                registry.request_seconds.observe(time.perf_counter() - started, route, "total")
+                registry.in_flight.dec(route)
+        g.metrics_finish_stream = finish_stream
+        token = request.headers.get(PROFILE_HEADER)
+        if profile_token and token and hmac.compare_digest(token, profile_token):
+            g.metrics_sampler = Sampler(threading.get_ident()).start()
+
+    @app.after_request
+    def record_timing(response):
+        route = g.get("metrics_route")
+        if route is None:
+            return response
+        sampler = g.pop("metrics_sampler", None)
+        if sampler is not None:
+            # Run any streamed body while the sampler is still watching
+            response.direct_passthrough = False
+            response.get_data()
+            response.set_data(sampler.stop())
+            response.mimetype = "text/plain"
+            response.headers[f"{PROFILE_HEADER}-Samples"] = str(sum(sampler.stacks.values()))
+        registry.requests.inc(route, request.method, str(response.status_code))
+        g.metrics_recorded = True
+        if response.is_streamed:
+            # The body does its work as it is sent, so it is timed and in flight until then
+            finish_stream = g.pop("metrics_finish_stream")
+            response.response = release_after(response.response, finish_stream)
+            response.call_on_close(finish_stream)
+        else:
+            elapsed = time.perf_counter() - g.metrics_started
+            registry.request_seconds.observe(elapsed, route, "total")
+        return response
+
+    @app.teardown_request
+    def finish_timing(_error):
+        route = g.get("metrics_route")
+        if route is None:
+            return
+        if g.pop("metrics_finish_stream", None) is not None:
+            registry.in_flight.dec(route)
+        if not g.get("metrics_recorded"):
+            registry.requests.inc(route, request.method, "500")
+        sampler = g.pop("metrics_sampler", None)
+        if sampler is not None:
+            sampler.stop()
+        # A streamed body can finish in another context, so no Token.reset here
+        current_route.set("none")
+
+    def start_render(_sender, **_kwargs):
+        renders.__dict__.setdefault("started", []).append(time.perf_counter())
+
+    def finish_render(_sender, **_kwargs):
+        started = getattr(renders, "started", None)
+        if started:
+            elapsed = time.perf_counter() - started.pop()
+            registry.request_seconds.observe(elapsed, current_route.get(), "render")
+
+    before_render_template.connect(start_render, app, weak=False)
+    template_rendered.connect(finish_render, app, weak=False)
+
+    @app.route('/metrics')
+    def metrics_route():
+        "Every metric in the Prometheus text format"
+        return app.response_class(registry.render(), mimetype="text/plain; version=0.0.4")
+
+    return registry
@@ -0,0 +1,298 @@
+"""
+Local retrieval over the reviews, a stand-in for the Bedrock knowledge base
+retrieval step. Every review becomes a hashed TF-IDF vector (words and word
+pairs hashed into dim signed buckets), stored in a memory-mapped matrix whose
+rows are grouped by city and then by stars, so the City and Stars filters are
+row ranges and a batch of queries is one matrix product over them. Each
+build goes to its own directory and the path is a symlink switched to it
+atomically, so running workers keep reading the old one until they notice
+the new one. Build it from the table, a JSONL export or the local store:
+
+    python review_index.py --out review_index                  # CityReviews table
+    python review_index.py --out review_index --jsonl reviews.jsonl
+    python review_index.py --out review_index --store          # STORAGE_BACKEND
+"""
+import argparse
+import json
+import os
+import shutil
+import threading
+import time
+import zlib
+import numpy as np
+from search import normalize
+
+DEFAULT_DIM = 256
+# Rows vectorised or normalised at a time while building
+BUILD_CHUNK = 65536
+# Lower scores come from hash collisions rather than shared words
+MIN_SCORE = 0.05
+# Hashed tokens remembered, per dim
+CODE_CACHE_SIZE = 1000000
+
+_codes = {}
+
+def token_code(token, dim):
+    "The bucket of a token plus one, negated for half the tokens, stable across processes"
+    digest = zlib.crc32(token.encode("utf-8"))
+    code = digest % dim + 1
+    return code if digest & 0x80000000 else -code
+
+def tokens(text):
+    "The words of a text and its word pairs"
+    words = normalize(text).split()
+    return words + [f"{first} {second}" for first, second in zip(words, words[1:])]
+
+def term_counts(texts, dim):
+    "A (len(texts), dim) matrix of signed hashed term counts"
+    codes = _codes.setdefault(dim, {})
+    if len(codes) > CODE_CACHE_SIZE:
+        codes.clear()
+    rows, terms = [], []
+    for row, text in enumerate(texts):
+        text_tokens = tokens(text)
+        rows.extend([row] * len(text_tokens))
+        terms.extend(text_tokens)
+    for token in set(terms).difference(codes):
+        codes[token] = token_code(token, dim)
+    signed = np.array([codes[token] for token in terms], dtype=np.int64)
+    cells = np.array(rows, dtype=np.int64) * dim + np.abs(signed) - 1
+    counts = np.bincount(cells, weights=np.sign(signed), minlength=len(texts) * dim)
+    return counts.astype(np.float32).reshape(len(texts), dim)
+
+def normalize_rows(matrix):
+    "Scale every non-zero row to unit length, in place"
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    matrix /= norms
+    return matrix
+
+def _replace_dir(built, path):
+    """
+    Point the symlink path at a freshly built directory, in one rename, and
+    remove the builds before the one it replaces
+    """
+    if os.path.isdir(path) and not os.path.islink(path):
+        # An index from before the symlinks, moved aside once
+        os.replace(path, f"{path}.v0")
+        os.symlink(os.path.basename(f"{path}.v0"), path)
+    previous = os.path.realpath(path) if os.path.islink(path) else None
+    link = f"{path}.link"
+    if os.path.lexists(link):
+        os.remove(link)
+    os.symlink(os.path.basename(built), link)
+    os.replace(link, path)
+    # The previous build stays, a worker may be opening it right now
+    folder = os.path.realpath(os.path.dirname(os.path.abspath(path)))
+    prefix = f"{os.path.basename(path)}.v"
+    for name in os.listdir(folder):
+        old = os.path.join(folder, name)
+        if name.startswith(prefix) and old not in (os.path.realpath(path), previous):
+            shutil.rmtree(old, ignore_errors=True)
+
+def build_index(reviews, path, dim=DEFAULT_DIM):
+    """
+    Write the index of reviews ({"CityName", "Stars", "ReviewContent"} items)
+    to the directory path, replacing any previous index there. Returns the
+    number of reviews indexed.
+    """
+    # pylint: disable=too-many-locals
+    rows = sorted(
+        (review["CityName"], int(review["Stars"]), review["ReviewContent"]) for review in reviews
+    )
+    building = f"{path}.v{time.time_ns()}"
+    os.makedirs(building)
+
+    # bounds[s - 1] is the first row of a city with at least s stars, bounds[5] its end
+    cities = {}
+    for number, (city, stars, _) in enumerate(rows):
+        if city not in cities:
+            cities[city] = [number] * 6
+        for above in range(stars, 6):
+            cities[city][above] = number + 1
+    ratings = np.array([stars for _, stars, _ in rows], dtype=np.int8)
+    np.save(os.path.join(building, "stars.npy"), ratings)
+    offsets = [0]
+    with open(os.path.join(building, "texts.bin"), "wb") as file:
+        for _, _, text in rows:
+            data = text.encode("utf-8")
+            file.write(data)
+            offsets.append(offsets[-1] + len(data))
+    np.save(os.path.join(building, "text_offsets.npy"), np.array(offsets, dtype=np.int64))
+
+    # Term counts first, then the IDF weights and unit length once all document
+    # frequencies are known
+    counts_path = os.path.join(building, "counts.npy")
+    counts = np.lib.format.open_memmap(
+        counts_path, mode="w+", dtype=np.float32, shape=(len(rows), dim)
+    )
+    frequencies = np.zeros(dim, dtype=np.int64)
+    for start in range(0, len(rows), BUILD_CHUNK):
+        chunk = term_counts([text for _, _, text in rows[start:start + BUILD_CHUNK]], dim)
+        frequencies += np.count_nonzero(chunk, axis=0)
+        counts[start:start + len(chunk)] = chunk
+    idf = (np.log((1 + len(rows)) / (1 + frequencies)) + 1).astype(np.float32)
+    np.save(os.path.join(building, "idf.npy"), idf)
+    vectors = np.lib.format.open_memmap(
+        os.path.join(building, "vectors.npy"), mode="w+", dtype=np.float32, shape=(len(rows), dim)
+    )
+    for start in range(0, len(rows), BUILD_CHUNK):
+        vectors[start:start + BUILD_CHUNK] = normalize_rows(counts[start:start + BUILD_CHUNK] * idf)
+    vectors.flush()
+    del counts, vectors
+    os.remove(counts_path)
+    with open(os.path.join(building, "cities.json"), "w", encoding="utf-8") as file:
+        json.dump({"dim": dim, "cities": cities}, file)
+    _replace_dir(building, path)
+    return len(rows)
+
+
+class ReviewIndex:  # pylint: disable=too-many-instance-attributes
+    "A built index, memory-mapped so forked workers share its pages"
+
+    def __init__(self, path):
+        self.path = path
+        # Every file from the same build, even if the symlink is switched meanwhile
+        real = os.path.realpath(path)
+        self.identity = index_identity(real)
+        with open(os.path.join(real, "cities.json"), encoding="utf-8") as file:
+            meta = json.load(file)
+        self.dim = meta["dim"]
+        self.cities = meta["cities"]
+        self.vectors = np.load(os.path.join(real, "vectors.npy"), mmap_mode="r")
+        self.stars = np.load(os.path.join(real, "stars.npy"), mmap_mode="r")
+        self.offsets = np.load(os.path.join(real, "text_offsets.npy"), mmap_mode="r")
+        self.idf = np.load(os.path.join(real, "idf.npy"))
+        self.texts = np.memmap(os.path.join(real, "texts.bin"), dtype=np.uint8, mode="r") \
+            if self.offsets[-1] else np.zeros(0, dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.vectors)
+
+    def vectorize(self, queries):
+        "The unit TF-IDF vectors of queries, one row each"
+        return normalize_rows(term_counts(queries, self.dim) * self.idf)
+
+    def rows(self, city=None, min_stars=1, max_stars=5):
+        "The row range holding a city's reviews with min_stars to max_stars stars"
+        if city is None:
+            return 0, len(self)
+        bounds = self.cities.get(city)
+        if bounds is None:
+            return 0, 0
+        min_stars, max_stars = max(min_stars, 1), min(max_stars, 5)
+        if min_stars > max_stars:
+            return 0, 0
+        return bounds[min_stars - 1], bounds[max_stars]
+
+    def review(self, row, score):
+        "The review in a row"
+        start, end = self.offsets[row], self.offsets[row + 1]
+        return {
+            "ReviewContent": bytes(self.texts[start:end]).decode("utf-8"),
+            "Stars": int(self.stars[row]),
+            "Score": round(float(score), 4)
+        }
+
+    def search(self, query, city=None, k=5, min_stars=1, max_stars=5):
+        "The k reviews most similar to query, best first"
+        return self.search_many([query], city, k, min_stars, max_stars)[0]
+
+    def search_many(self, queries, city=None, k=5, min_stars=1, max_stars=5):
+        "The top k reviews of each query, answered with one matrix product per BUILD_CHUNK rows"
+        # pylint: disable=too-many-locals
+        start, end = self.rows(city, min_stars, max_stars)
+        if not queries or start >= end:
+            return [[] for _ in queries]
+        query_vectors = self.vectorize(queries)
+        best_rows = np.empty((len(queries), 0), dtype=np.int64)
+        best_scores = np.empty((len(queries), 0), dtype=np.float32)
+        for chunk in range(start, end, BUILD_CHUNK):
+            stop = min(chunk + BUILD_CHUNK, end)
+            scores = query_vectors @ self.vectors[chunk:stop].T
+            rows = np.broadcast_to(np.arange(chunk, stop), scores.shape)
+            best_scores = np.concatenate([best_scores, scores], axis=1)
+            best_rows = np.concatenate([best_rows, rows], axis=1)
+            if best_scores.shape[1] > k:
+                keep = np.argpartition(-best_scores, k - 1, axis=1)[:, :k]
+                best_scores = np.take_along_axis(best_scores, keep, axis=1)
+                best_rows = np.take_along_axis(best_rows, keep, axis=1)
+        order = np.argsort(-best_scores, axis=1, kind="stable")
+        results = []
+        for query_rows, query_scores, ranking in zip(best_rows, best_scores, order):
+            results.append([
+                self.review(query_rows[i], query_scores[i])
+                for i in ranking if query_scores[i] >= MIN_SCORE
+            ])
+        return results
+
+
+def index_identity(path):
+    "What changes when the index at path is rebuilt"
+    latest = os.stat(path)
+    return latest.st_ino, latest.st_dev
+
+
+class LatestReviewIndex:  # pylint: disable=too-few-public-methods
+    "The index at a path, opened again whenever it has been rebuilt"
+
+    def __init__(self, path):
+        self.path = path
+        self.index = None
+        self._lock = threading.Lock()
+
+    def current(self):
+        "The newest index"
+        index = self.index
+        if index is not None and index.identity == index_identity(self.path):
+            return index
+        with self._lock:
+            if self.index is None or self.index.identity != index_identity(self.path):
+                # The old maps are left to the garbage collector, other threads may still read them
+                self.index = ReviewIndex(self.path)
+            return self.index
+
+
+def table_reviews(table_name):
+    "Every review in a DynamoDB table"
+    # pylint: disable=import-outside-toplevel
+    from aws_helpers import iter_items
+    import clients
+    return iter_items(
+        clients.table(table_name).scan, ProjectionExpression="CityName, Stars, ReviewContent"
+    )
+
+def store_reviews(store):
+    "Every review in a Store"
+    for city in store.list_cities():
+        for review in store.iter_reviews(city["Name"]):
+            yield {"CityName": city["Name"], **review}
+
+def main():
+    "Build an index"
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--out", default=os.getenv("REVIEW_INDEX_PATH", "review_index"))
+    parser.add_argument("--table", default="CityReviews")
+    parser.add_argument("--jsonl", help="a JSONL file of reviews, like bulk_load.py reads")
+    parser.add_argument("--store", action="store_true",
+                        help="read the store STORAGE_BACKEND selects")
+    parser.add_argument("--dim", type=int, default=DEFAULT_DIM)
+    args = parser.parse_args()
+
+    # pylint: disable=import-outside-toplevel
+    if args.jsonl:
+        from bulk_load import read_items
+        reviews = read_items(args.jsonl, "jsonl")
+    elif args.store:
+        from storage import open_store
+        reviews = store_reviews(open_store())
+    else:
+        reviews = table_reviews(args.table)
+    start = time.perf_counter()
+    count = build_index(reviews, args.out, args.dim)
+    print(f"Indexed {count} reviews into {args.out} in {time.perf_counter() - start:.1f}s")
+
+if __name__ == '__main__':
+    main()
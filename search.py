@@ -0,0 +1,209 @@
+"""
+In-memory search index over the city catalogue, for the autocomplete on the
+homepage. Prefixes of city and country names match first, then trigram
+similarity catches typos.
+"""
+import bisect
+import math
+import re
+import threading
+import unicodedata
+
+# Fuzzy matches need at least this Dice similarity with a city or country name
+MIN_SIMILARITY = 0.45
+
+def normalize(text):
+    "Casefold, strip accents and reduce to space separated words"
+    if not text.isascii():
+        text = unicodedata.normalize("NFKD", text)
+        text = "".join(char for char in text if not unicodedata.combining(char))
+    return " ".join(re.findall(r"\w+", text.casefold()))
+
+def trigrams(text):
+    "The trigrams of a normalized name, padded so starts of words count double"
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class CityIndex:  # pylint: disable=too-many-instance-attributes
+    """
+    Prefix and trigram index of city links ({"Name", "CountryName"}), kept in
+    sync with the catalogue one city at a time
+    """
+
+    def __init__(self):
+        self.stale = True
+        # The catalogue the index was last synced with
+        self.source = None
+        self._links = {}
+        self._fields = {}
+        self._words = []
+        self._grams = {}
+        self._texts = {}
+        self._text_grams = {}
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._links)
+
+    def ensure(self, load_cities):
+        """
+        Sync with load_cities() if the catalogue changed since the last sync.
+        One caller loads and syncs while the others keep searching the index
+        as it is, unless it was never built.
+        """
+        if not self.stale:
+            return self
+        # pylint: disable-next=consider-using-with
+        if not self._sync_lock.acquire(blocking=self.source is None):
+            return self
+        try:
+            if self.stale:
+                # Cleared first, so a change during the load is synced next time
+                self.stale = False
+                try:
+                    cities = load_cities()
+                    self._sync(cities)
+                except BaseException:
+                    self.stale = True
+                    raise
+                self.source = cities
+        finally:
+            self._sync_lock.release()
+        return self
+
+    def mark_stale(self):
+        "Resync on the next search, after the whole catalogue changed"
+        self.stale = True
+
+    def _sync(self, cities):
+        "Apply the differences from cities, holding the search lock only to apply them"
+        with self._lock:
+            known = {name: link["CountryName"] for name, link in self._links.items()}
+        seen = set()
+        changed = []
+        for city in cities:
+            seen.add(city["Name"])
+            if known.get(city["Name"]) != city["CountryName"]:
+                changed.append(city)
+        with self._lock:
+            for name in [name for name in known if name not in seen]:
+                self._remove(name)
+            for city in changed:
+                self._add(city, keep_sorted=False)
+            if changed:
+                self._words.sort()
+
+    def add(self, city):
+        "Index a new or changed city"
+        with self._lock:
+            self._add(city)
+
+    def remove(self, name):
+        "Drop a city from the index"
+        with self._lock:
+            self._remove(name)
+
+    def _add(self, city, keep_sorted=True):
+        name = city["Name"]
+        self._remove(name)
+        fields = (normalize(name), normalize(city["CountryName"]))
+        self._links[name] = {"Name": name, "CountryName": city["CountryName"]}
+        self._fields[name] = fields
+        for field, text in enumerate(fields):
+            for word in set(text.split()):
+                if keep_sorted:
+                    bisect.insort(self._words, (field, word, name))
+                else:
+                    self._words.append((field, word, name))
+            # Trigrams are kept per distinct text, so a country is scored once
+            if text not in self._texts:
+                self._texts[text] = []
+                self._text_grams[text] = trigrams(text)
+                for gram in self._text_grams[text]:
+                    self._grams.setdefault(gram, set()).add(text)
+            bisect.insort(self._texts[text], (name, field))
+
+    def _remove(self, name):
+        fields = self._fields.pop(name, None)
+        if fields is None:
+            return
+        del self._links[name]
+        for field, text in enumerate(fields):
+            for word in set(text.split()):
+                position = bisect.bisect_left(self._words, (field, word, name))
+                del self._words[position]
+            owners = self._texts[text]
+            del owners[bisect.bisect_left(owners, (name, field))]
+            if owners:
+                continue
+            del self._texts[text]
+            for gram in self._text_grams.pop(text):
+                postings = self._grams[gram]
+                postings.discard(text)
+                if not postings:
+                    del self._grams[gram]
+
+    def search(self, query, limit=10):
+        "Up to limit city links: name prefixes, then country prefixes, then near misses"
+        query = normalize(query)
+        if not query:
+            return []
+        with self._lock:
+            names = self._prefix_matches(query, limit)
+            if len(names) < limit:
+                found = set(names)
+                for name in self._fuzzy_matches(query, limit + len(names)):
+                    if name not in found and len(names) < limit:
+                        names.append(name)
+            return [dict(self._links[name]) for name in names]
+
+    def _prefix_matches(self, query, limit):
+        """
+        Cities where every query word starts a word of the city name, then of
+        the country name, in word order so the scan stops after limit matches
+        """
+        words = query.split()
+        matches = []
+        for field in (0, 1):
+            position = bisect.bisect_left(self._words, (field, words[-1]))
+            while len(matches) < limit and position < len(self._words):
+                word_field, word, name = self._words[position]
+                if word_field != field or not word.startswith(words[-1]):
+                    break
+                if name not in matches and self._all_words_match(words, self._fields[name][field]):
+                    matches.append(name)
+                position += 1
+        return matches
+
+    @staticmethod
+    def _all_words_match(words, text):
+        "Every query word is a prefix of some word of text"
+        targets = text.split()
+        return all(any(target.startswith(word) for target in targets) for word in words)
+
+    def _fuzzy_matches(self, query, limit):
+        "Up to limit cities whose name or country is similar enough to the query, best first"
+        grams = sorted(trigrams(query), key=lambda gram: len(self._grams.get(gram, ())))
+        # A match shares at least `needed` grams, so it has one of the rarest len - needed + 1
+        needed = math.ceil(MIN_SIMILARITY * len(grams) / (2 - MIN_SIMILARITY))
+        candidates = set()
+        for gram in grams[:len(grams) - needed + 1]:
+            candidates.update(self._grams.get(gram, ()))
+        query_grams = set(grams)
+        scored = []
+        for text in candidates:
+            text_grams = self._text_grams[text]
+            score = 2 * len(query_grams & text_grams) / (len(query_grams) + len(text_grams))
+            if score >= MIN_SIMILARITY:
+                scored.append((-score, text))
+        names = []
+        for _, text in sorted(scored):
+            # Owners are sorted by name, so the first few are the ones to show
+            for name, _ in self._texts[text]:
+                if len(names) >= limit:
+                    return names
+                if name not in names:
+                    names.append(name)
+        return names
@@ -0,0 +1,77 @@
+"""
+Seed a local store with a synthetic catalogue (10k cities and 1M reviews by
+default) for load and latency benchmarks, e.g.
+
+    python seed_store.py --path cities.db
+    STORAGE_BACKEND=sqlite STORAGE_PATH=cities.db flask run
+"""
+import argparse
+import random
+import time
+from storage import SqliteStore
+
+COUNTRIES = [
+    ("FR", "France"), ("JP", "Japan"), ("BR", "Brazil"), ("KE", "Kenya"),
+    ("CA", "Canada"), ("IN", "India"), ("IT", "Italy"), ("AU", "Australia")
+]
+
+WORDS = "great lovely busy quiet crowded friendly scenic pricey clean historic".split()
+
+def city_name(number):
+    "The name of the nth synthetic city"
+    return f"City-{number:05d}"
+
+def make_cities(count):
+    "Generate count synthetic cities"
+    for number in range(count):
+        code, country = COUNTRIES[number % len(COUNTRIES)]
+        yield {
+            "Name": city_name(number),
+            "CountryCode": code,
+            "CountryName": country,
+            "TopThingsToDo": [f"Thing {n}" for n in range(1, 6)],
+            "Itinerary": "Day one: walk around\nDay two: museums\nDay three: food tour"
+        }
+
+def make_reviews(cities, count, rng):
+    "Generate count synthetic (name, review_id, content, stars) reviews spread over the cities"
+    for number in range(count):
+        stars = rng.choices(range(1, 6), weights=(1, 1, 3, 6, 5))[0]
+        content = " ".join(rng.choice(WORDS) for _ in range(12))
+        yield (city_name(number % cities), f"{number:08d}", content, stars)
+
+def batched(items, size):
+    "Split an iterator into lists of at most size items"
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def seed(store, cities=10000, reviews=1000000, batch_size=10000, seed_value=42):
+    "Write the synthetic dataset into store"
+    rng = random.Random(seed_value)
+    store.add_cities(make_cities(cities))
+    for batch in batched(make_reviews(cities, reviews, rng), batch_size):
+        store.add_reviews(batch)
+
+def main():
+    "Seed a SQLite store"
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--path", default="cities.db")
+    parser.add_argument("--cities", type=int, default=10000)
+    parser.add_argument("--reviews", type=int, default=1000000)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    seed(SqliteStore(args.path), args.cities, args.reviews)
+    print(f"Seeded {args.cities} cities and {args.reviews} reviews "
+          f"in {time.perf_counter() - start:.1f}s")
+
+if __name__ == '__main__':
+    main()
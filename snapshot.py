@@ -0,0 +1,318 @@
+"""
+Memory-mapped snapshot of the city catalogue. The snapshot is one binary
+file: the city records, a hash table from city name to record for O(1)
+lookups and the record offsets in name order for listing and paging. Every
+worker maps the same file, so they share its pages through the page cache
+instead of each holding and warming its own copy, and a city is decoded only
+when it is looked up. Build a snapshot from the store, and rebuild it to
+publish a new catalogue; running workers switch to it without a restart:
+
+    python snapshot.py --out catalogue.snap
+    CATALOGUE_SNAPSHOT=catalogue.snap gunicorn app:app
+"""
+import argparse
+import bisect
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+from aws_helpers import decode_cursor, encode_cursor
+from storage import Store
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"CITYSNAP"
+VERSION = 2
+# Magic, version, city count, hash slots, hash table offset, name order offset
+HEADER = struct.Struct("<8sIIIQQ")
+# Lengths of the name, country code, country name, itinerary and the number of things to do
+RECORD = struct.Struct("<IIIII")
+THING = struct.Struct("<I")
+# Name hash and record offset, offset 0 marks an empty slot
+SLOT = struct.Struct("<QQ")
+OFFSET = struct.Struct("<Q")
+
+def name_hash(name):
+    "A 64 bit hash of a city name, the same in every process"
+    return int.from_bytes(hashlib.blake2b(name.encode("utf-8"), digest_size=8).digest(), "little")
+
+def encode_city(city):
+    "The binary record of a city"
+    name, code, country, itinerary = (
+        city[key].encode("utf-8") for key in ("Name", "CountryCode", "CountryName", "Itinerary")
+    )
+    things = [thing.encode("utf-8") for thing in city["TopThingsToDo"]]
+    try:
+        header = RECORD.pack(len(name), len(code), len(country), len(itinerary), len(things))
+        parts = [header, name, code, country]
+        for thing in things:
+            parts.append(THING.pack(len(thing)))
+            parts.append(thing)
+    except struct.error as error:
+        raise ValueError(
+            f"City {city['Name']!r} has a field of 4 GB or more, too big for a snapshot"
+        ) from error
+    parts.append(itinerary)
+    return b"".join(parts)
+
+def build_snapshot(cities, path):
+    """
+    Write a snapshot of cities to path, atomically replacing the previous
+    one. Returns the number of cities written.
+    """
+    records = sorted((city["Name"], encode_city(city)) for city in cities)
+    slots = 1
+    while slots < 2 * len(records):
+        slots *= 2
+    table = [(0, 0)] * slots
+    offsets = []
+    position = HEADER.size
+    for name, record in records:
+        offsets.append(position)
+        digest = name_hash(name)
+        slot = digest % slots
+        while table[slot][1]:
+            slot = (slot + 1) % slots
+        table[slot] = (digest, position)
+        position += len(record)
+    partial = f"{path}.tmp"
+    with open(partial, "wb") as file:
+        file.write(HEADER.pack(
+            MAGIC, VERSION, len(records), slots, position, position + slots * SLOT.size
+        ))
+        for _, record in records:
+            file.write(record)
+        file.write(b"".join(SLOT.pack(*entry) for entry in table))
+        file.write(b"".join(OFFSET.pack(offset) for offset in offsets))
+        file.flush()
+        os.fsync(file.fileno())
+    # Workers that mapped the old file keep reading it until they notice the new one
+    os.replace(partial, path)
+    return len(records)
+
+
+class _Names:
+    "The city names of a snapshot in order, decoded on access, for bisect"
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+
+    def __len__(self):
+        return len(self.snapshot)
+
+    def __getitem__(self, position):
+        return self.snapshot.name_at(position)
+
+
+class CatalogueSnapshot:
+    "A read-only view of a snapshot file"
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as file:
+            self.identity = os.fstat(file.fileno())
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._map) < HEADER.size:
+            raise ValueError(f"{path} is too short for a catalogue snapshot")
+        magic, version, self.count, self.slots, self.table_offset, self.order_offset = \
+            HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a version {VERSION} catalogue snapshot")
+
+    def __len__(self):
+        return self.count
+
+    def _offset_at(self, position):
+        "The record offset of the position'th city in name order"
+        return OFFSET.unpack_from(self._map, self.order_offset + position * OFFSET.size)[0]
+
+    def _find(self, name):
+        "The record offset of a city, or None"
+        if not self.slots:
+            return None
+        digest = name_hash(name)
+        slot = digest % self.slots
+        while True:
+            slot_hash, offset = SLOT.unpack_from(self._map, self.table_offset + slot * SLOT.size)
+            if not offset:
+                return None
+            if slot_hash == digest and self._name(offset) == name:
+                return offset
+            slot = (slot + 1) % self.slots
+
+    def _name(self, offset):
+        "The name in a record"
+        name_length = RECORD.unpack_from(self._map, offset)[0]
+        start = offset + RECORD.size
+        return self._map[start:start + name_length].decode("utf-8")
+
+    def _link(self, offset):
+        "The name and country of a record, without decoding the rest"
+        name_length, code_length, country_length, _, _ = RECORD.unpack_from(self._map, offset)
+        start = offset + RECORD.size
+        country = start + name_length + code_length
+        return {
+            "Name": self._map[start:start + name_length].decode("utf-8"),
+            "CountryName": self._map[country:country + country_length].decode("utf-8")
+        }
+
+    def _city(self, offset):
+        "Decode a whole record"
+        name_length, code_length, country_length, itinerary_length, thing_count = \
+            RECORD.unpack_from(self._map, offset)
+        data = self._map
+        position = offset + RECORD.size
+        fields = []
+        for length in (name_length, code_length, country_length):
+            fields.append(data[position:position + length].decode("utf-8"))
+            position += length
+        things = []
+        for _ in range(thing_count):
+            length = THING.unpack_from(data, position)[0]
+            position += THING.size
+            things.append(data[position:position + length].decode("utf-8"))
+            position += length
+        return {
+            "Name": fields[0],
+            "CountryCode": fields[1],
+            "CountryName": fields[2],
+            "TopThingsToDo": things,
+            "Itinerary": data[position:position + itinerary_length].decode("utf-8")
+        }
+
+    def name_at(self, position):
+        "The name of the position'th city in name order"
+        return self._name(self._offset_at(position))
+
+    def get_city(self, name):
+        "A city, or None"
+        offset = self._find(name)
+        return self._city(offset) if offset is not None else None
+
+    def list_cities(self):
+        "Every city in name order"
+        for position in range(self.count):
+            yield self._city(self._offset_at(position))
+
+    def cities_page(self, page_size, cursor=None):
+        "One page of city links in name order and the cursor of the next, like Store.cities_page"
+        start = 0
+        after = decode_cursor(cursor)
+        if after:
+            start = bisect.bisect_right(_Names(self), after["CityName"])
+        links = [self._link(self._offset_at(position))
+                 for position in range(start, min(start + page_size, self.count))]
+        next_cursor = None
+        if links and start + page_size < self.count:
+            next_cursor = encode_cursor({"CityName": links[-1]["Name"]})
+        return links, next_cursor
+
+
+class SnapshotStore(Store):  # pylint: disable=too-many-instance-attributes
+    """
+    Serves the catalogue from a snapshot and everything else from store.
+    Every check_interval seconds it looks whether the snapshot file was
+    replaced, and if so maps the new one and calls on_swap. A new file that
+    cannot be read is logged and the old one kept.
+    """
+
+    # Catalogue reads are as cheap as a cache hit and shared by the workers
+    shared_catalogue = True
+
+    def __init__(self, path, store, check_interval=5.0, on_swap=None, clock=time.monotonic):
+        self.path = path
+        self.store = store
+        self.check_interval = check_interval
+        self.on_swap = on_swap
+        self.clock = clock
+        self.snapshot = CatalogueSnapshot(path)
+        self._checked = clock()
+        self._rejected = None
+        self._lock = threading.Lock()
+
+    def current(self):
+        "The snapshot to read, the newest one once a check is due"
+        if self.clock() - self._checked < self.check_interval:
+            return self.snapshot
+        with self._lock:
+            if self.clock() - self._checked >= self.check_interval:
+                self._checked = self.clock()
+                latest = self._replaced()
+                if latest and latest != self._rejected:
+                    try:
+                        snapshot = CatalogueSnapshot(self.path)
+                    except (OSError, ValueError):
+                        # Logged once per file, it is only retried once replaced again
+                        self._rejected = latest
+                        logger.exception(
+                            "Keeping the catalogue snapshot mapped, %s cannot be read", self.path
+                        )
+                        return self.snapshot
+                    # The old map is left to the garbage collector, other threads may still read it
+                    self.snapshot = snapshot
+                    if self.on_swap is not None:
+                        self.on_swap()
+        return self.snapshot
+
+    def _replaced(self):
+        "The identity of the file at path if it is no longer the mapped one, else None"
+        try:
+            latest = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        mapped = self.snapshot.identity
+        latest = (latest.st_ino, latest.st_dev, latest.st_mtime_ns)
+        return latest if latest != (mapped.st_ino, mapped.st_dev, mapped.st_mtime_ns) else None
+
+    def list_cities(self):
+        return self.current().list_cities()
+
+    def cities_page(self, page_size, cursor=None):
+        return self.current().cities_page(page_size, cursor)
+
+    def get_city(self, name):
+        return self.current().get_city(name)
+
+    def reviews_page(self, name, page_size, cursor=None):
+        return self.store.reviews_page(name, page_size, cursor)
+
+    def iter_reviews(self, name):
+        return self.store.iter_reviews(name)
+
+    def review_stats(self, name):
+        return self.store.review_stats(name)
+
+    def review_stats_many(self, names):
+        return self.store.review_stats_many(names)
+
+    def add_city(self, city):
+        # Shows up once the snapshot is rebuilt
+        self.store.add_city(city)
+
+    def add_review(self, name, review_id, content, stars):
+        self.store.add_review(name, review_id, content, stars)
+
+    def rebuild_review_stats(self, name):
+        self.store.rebuild_review_stats(name)
+
+
+def main():
+    "Build a snapshot from the store STORAGE_BACKEND selects"
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--out", default=os.getenv("CATALOGUE_SNAPSHOT", "catalogue.snap"))
+    args = parser.parse_args()
+
+    # pylint: disable=import-outside-toplevel
+    from storage import open_store
+    start = time.perf_counter()
+    count = build_snapshot(open_store().list_cities(), args.out)
+    print(f"Wrote {count} cities to {args.out} ({os.path.getsize(args.out)} bytes) "
+          f"in {time.perf_counter() - start:.1f}s")
+
+if __name__ == '__main__':
+    main()
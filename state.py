@@ -0,0 +1,168 @@
+"""
+State for app-simple.py: the todo list and the visit counter. MemoryState
+is per process, SqliteState is shared by every worker on the host.
+"""
+import atexit
+import datetime
+import itertools
+import os
+import sqlite3
+import threading
+import time
+
+def make_todo(todo_id, text, timestamp):
+    "A todo as the template and the API show it"
+    return {"id": todo_id, "text": text, "timestamp": timestamp}
+
+def now():
+    "The timestamp shown next to a new todo"
+    return datetime.datetime.now().strftime("%H:%M:%S")
+
+
+class MemoryState:
+    "State in this process only, safe to use from many threads"
+
+    def __init__(self):
+        self._todos = {}
+        self._ids = itertools.count(1)
+        self._visits = 0
+        self._lock = threading.Lock()
+
+    def visit(self):
+        "Count a visit and return the new total"
+        with self._lock:
+            self._visits += 1
+            return self._visits
+
+    def visits(self):
+        "The total number of visits"
+        return self._visits
+
+    def todos(self):
+        "Every todo, oldest first"
+        with self._lock:
+            return list(self._todos.values())
+
+    def add_todo(self, text):
+        "Add a todo and return it"
+        # next() on a count is atomic, so ids never repeat
+        todo = make_todo(next(self._ids), text, now())
+        with self._lock:
+            self._todos[todo["id"]] = todo
+        return todo
+
+    def delete_todo(self, todo_id):
+        "Delete a todo, returning whether it existed"
+        with self._lock:
+            return self._todos.pop(todo_id, None) is not None
+
+
+class SqliteState:  # pylint: disable=too-many-instance-attributes
+    """
+    State in a SQLite database in WAL mode, shared by the workers. Visits are
+    counted in memory and added to the database in batches, every
+    flush_every visits or flush_interval seconds, whichever comes first.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS todos (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, text TEXT NOT NULL, timestamp TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS counters (
+            name TEXT PRIMARY KEY, value INTEGER NOT NULL
+        ) WITHOUT ROWID;
+    """
+
+    def __init__(self, path, flush_every=100, flush_interval=1.0, clock=time.monotonic):
+        self.path = path
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.clock = clock
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._stored = 0
+        self._last_flush = clock()
+        with self._connect() as db:
+            db.executescript(self.SCHEMA)
+        self.flush()
+        atexit.register(self.flush)
+
+    def _connect(self):
+        "This thread's connection"
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = self._local.db = sqlite3.connect(self.path, timeout=30)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+        return db
+
+    def visit(self):
+        "Count a visit and return the new total as this worker sees it"
+        with self._lock:
+            self._pending += 1
+            due = (self._pending >= self.flush_every
+                   or self.clock() - self._last_flush >= self.flush_interval)
+        if due:
+            self.flush()
+        return self.visits()
+
+    def flush(self):
+        "Add the visits counted since the last flush to the database"
+        with self._lock:
+            pending, self._pending = self._pending, 0
+            self._last_flush = self.clock()
+        try:
+            with self._connect() as db:
+                if pending:
+                    db.execute(
+                        "INSERT INTO counters VALUES ('visits', ?) "
+                        "ON CONFLICT (name) DO UPDATE SET value = value + excluded.value",
+                        (pending,)
+                    )
+                row = db.execute("SELECT value FROM counters WHERE name = 'visits'").fetchone()
+        except sqlite3.Error:
+            # Keep the visits for the next flush
+            with self._lock:
+                self._pending += pending
+            raise
+        with self._lock:
+            self._stored = row[0] if row else 0
+
+    def visits(self):
+        "The shared total as of the last flush plus this worker's unflushed visits"
+        with self._lock:
+            return self._stored + self._pending
+
+    def todos(self):
+        "Every todo, oldest first"
+        rows = self._connect().execute("SELECT id, text, timestamp FROM todos ORDER BY id")
+        return [make_todo(*row) for row in rows]
+
+    def add_todo(self, text):
+        "Add a todo and return it"
+        timestamp = now()
+        with self._connect() as db:
+            cursor = db.execute(
+                "INSERT INTO todos (text, timestamp) VALUES (?, ?)", (text, timestamp)
+            )
+        return make_todo(cursor.lastrowid, text, timestamp)
+
+    def delete_todo(self, todo_id):
+        "Delete a todo, returning whether it existed"
+        with self._connect() as db:
+            return db.execute("DELETE FROM todos WHERE id = ?", (todo_id,)).rowcount > 0
+
+
+def open_state(backend=None):
+    "The state selected by STATE_BACKEND (memory or sqlite)"
+    backend = backend or os.getenv("STATE_BACKEND", "memory")
+    if backend == "memory":
+        return MemoryState()
+    if backend == "sqlite":
+        return SqliteState(
+            os.getenv("STATE_PATH", "app_state.db"),
+            flush_every=int(os.getenv("STATE_FLUSH_EVERY", "100")),
+            flush_interval=float(os.getenv("STATE_FLUSH_INTERVAL", "1.0"))
+        )
+    raise ValueError(f"Unknown STATE_BACKEND {backend!r}")
@@ -0,0 +1,625 @@
+"""
+Storage backends for the Cities and CityReviews data. DynamoStore is what
+runs in AWS, SqliteStore and MemoryStore hold the same data locally so the
+app can be developed, tested and load tested without AWS.
+"""
+from abc import ABC, abstractmethod
+import bisect
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+from boto3.dynamodb.conditions import Key
+from botocore.exceptions import ClientError
+from aws_helpers import backoff_delay, decode_cursor, encode_cursor, iter_items, read_page
+import clients
+
+# Only the attributes index.html renders
+CITY_LINK_PROJECTION = "CityName, CountryName"
+REVIEW_PROJECTION = "ReviewContent, Stars"
+STAR_BUCKETS = range(1, 6)
+# BatchGetItem takes at most this many keys
+BATCH_GET_SIZE = 100
+# Rounds of BatchGetItem calls for keys DynamoDB keeps returning as unprocessed
+BATCH_GET_ATTEMPTS = 8
+# Names per SQL IN list, well under SQLite's limit on parameters
+SQLITE_IN_SIZE = 500
+
+def make_city(item):
+    "Convert a Cities item for the templates"
+    return {
+        "Name": item['CityName'],
+        "CountryCode": item['CountryCode'],
+        "CountryName": item['CountryName'],
+        "TopThingsToDo": item['TopThingsToDo'],
+        "Itinerary": item['Itinerary']
+    }
+
+def make_review(item):
+    "Convert a CityReviews item for the templates"
+    return {
+        "ReviewContent": item['ReviewContent'],
+        "Stars": int(item['Stars'])
+    }
+
+def empty_stats():
+    "A rating aggregate with no reviews in it"
+    stats = {"ReviewCount": 0, "StarTotal": 0}
+    stats.update({f"Stars{stars}": 0 for stars in STAR_BUCKETS})
+    return stats
+
+def add_to_stats(stats, stars, direction=1):
+    "Fold one review into a rating aggregate"
+    stats["ReviewCount"] += direction
+    stats["StarTotal"] += direction * int(stars)
+    stats[f"Stars{int(stars)}"] += direction
+
+
+class Store(ABC):
+    """
+    What the app needs from a data store. Cities and reviews are returned in
+    the shape the templates use, pages come with an opaque cursor for the
+    next page (None on the last one).
+    """
+
+    # Whether catalogue reads are already shared by the workers and as cheap
+    # as a cache hit, so the app need not keep its own copy (see snapshot.py)
+    shared_catalogue = False
+
+    @abstractmethod
+    def list_cities(self):
+        "Iterate over every city"
+
+    @abstractmethod
+    def cities_page(self, page_size, cursor=None):
+        "One page of city links, ordered by name, and the next cursor"
+
+    @abstractmethod
+    def get_city(self, name):
+        "A single city, or None"
+
+    def get_cities(self, names):
+        "The cities among names that exist, as {name: city}"
+        cities = {}
+        for name in names:
+            city = self.get_city(name)
+            if city:
+                cities[name] = city
+        return cities
+
+    @abstractmethod
+    def reviews_page(self, name, page_size, cursor=None):
+        "One page of a city's reviews, newest ReviewId first, and the next cursor"
+
+    @abstractmethod
+    def iter_reviews(self, name):
+        "Iterate over all of a city's reviews"
+
+    @abstractmethod
+    def review_stats(self, name):
+        "The rating aggregate of a city (see empty_stats), or None"
+
+    def review_stats_many(self, names):
+        "The rating aggregates of the cities among names that have one, as {name: stats}"
+        found = {}
+        for name in names:
+            stats = self.review_stats(name)
+            if stats:
+                found[name] = stats
+        return found
+
+    @abstractmethod
+    def add_city(self, city):
+        "Insert or replace a city"
+
+    @abstractmethod
+    def add_review(self, name, review_id, content, stars):
+        "Insert a review and fold it into the city's rating aggregate"
+
+    @abstractmethod
+    def rebuild_review_stats(self, name):
+        "Recompute a city's aggregate from all of its reviews"
+
+    def add_cities(self, cities):
+        "Insert or replace many cities"
+        for city in cities:
+            self.add_city(city)
+
+    def add_reviews(self, reviews):
+        "Insert many (name, review_id, content, stars) reviews"
+        for review in reviews:
+            self.add_review(*review)
+
+
+class DynamoStore(Store):
+    """
+    The Cities, CityReviews and CityReviewStats tables in DynamoDB. The tables
+    come from clients.py, one set per thread, unless a resource is given.
+    """
+
+    def __init__(self, resource=None, cities_table='Cities', reviews_table='CityReviews',
+                 stats_table='CityReviewStats'):
+        self.resource = resource
+        self.table_names = {"cities": cities_table, "reviews": reviews_table, "stats": stats_table}
+        self._tables = {}
+
+    def _resource(self):
+        "The DynamoDB resource, this thread's unless one was given"
+        return self.resource if self.resource is not None else clients.resource('dynamodb')
+
+    def _table(self, role):
+        "The table playing role, created on first use"
+        if self.resource is None:
+            # Looked up every time so each thread and forked worker gets its own
+            return clients.table(self.table_names[role])
+        if role not in self._tables:
+            self._tables[role] = self.resource.Table(self.table_names[role])
+        return self._tables[role]
+
+    @property
+    def cities_table(self):
+        "The Cities table"
+        return self._table("cities")
+
+    @property
+    def reviews_table(self):
+        "The CityReviews table"
+        return self._table("reviews")
+
+    @property
+    def stats_table(self):
+        "The CityReviewStats table"
+        return self._table("stats")
+
+    def list_cities(self):
+        for item in iter_items(self.cities_table.scan):
+            yield make_city(item)
+
+    def cities_page(self, page_size, cursor=None):
+        items, next_cursor = read_page(
+            self.cities_table.scan,
+            page_size,
+            cursor,
+            ProjectionExpression=CITY_LINK_PROJECTION
+        )
+        cities = [{"Name": item['CityName'], "CountryName": item['CountryName']} for item in items]
+        return cities, next_cursor
+
+    def get_city(self, name):
+        response = self.cities_table.query(KeyConditionExpression=Key('CityName').eq(name))
+        if response['Items']:
+            return make_city(response['Items'][0])
+        return None
+
+    def get_cities(self, names):
+        return {name: make_city(item) for name, item in self._batch_get("cities", names).items()}
+
+    def _batch_get(self, role, names):
+        """
+        The items of a table keyed by CityName, BATCH_GET_SIZE keys per
+        BatchGetItem call, retrying unprocessed keys with backoff
+        """
+        resource = self._resource()
+        table_name = self.table_names[role]
+        names = list(dict.fromkeys(names))
+        items = {}
+        for start in range(0, len(names), BATCH_GET_SIZE):
+            request = {"Keys": [{"CityName": name} for name in names[start:start + BATCH_GET_SIZE]]}
+            for attempt in range(BATCH_GET_ATTEMPTS):
+                # Errors are retried by the client (clients.CLIENT_CONFIG), this loop is
+                # for unprocessed keys
+                response = resource.batch_get_item(RequestItems={table_name: request})
+                for item in response["Responses"].get(table_name, []):
+                    items[item["CityName"]] = item
+                request = response.get("UnprocessedKeys", {}).get(table_name)
+                if not request:
+                    break
+                time.sleep(backoff_delay(attempt))
+            else:
+                raise RuntimeError(f"{len(request['Keys'])} keys of {table_name} still unprocessed")
+        return items
+
+    def reviews_page(self, name, page_size, cursor=None):
+        items, next_cursor = read_page(
+            self.reviews_table.query,
+            page_size,
+            cursor,
+            KeyConditionExpression=Key('CityName').eq(name),
+            ProjectionExpression=REVIEW_PROJECTION,
+            ScanIndexForward=False
+        )
+        return [make_review(item) for item in items], next_cursor
+
+    def iter_reviews(self, name):
+        items = iter_items(
+            self.reviews_table.query,
+            KeyConditionExpression=Key('CityName').eq(name),
+            ProjectionExpression=REVIEW_PROJECTION,
+            ScanIndexForward=False
+        )
+        for item in items:
+            yield make_review(item)
+
+    def review_stats(self, name):
+        item = self.stats_table.get_item(Key={'CityName': name}).get('Item')
+        if not item:
+            return None
+        stats = empty_stats()
+        stats.update({key: int(item[key]) for key in stats if key in item})
+        return stats
+
+    def review_stats_many(self, names):
+        found = {}
+        for name, item in self._batch_get("stats", names).items():
+            stats = empty_stats()
+            stats.update({key: int(item[key]) for key in stats if key in item})
+            found[name] = stats
+        return found
+
+    def add_city(self, city):
+        self.cities_table.put_item(Item={
+            "CityName": city["Name"],
+            "CountryCode": city["CountryCode"],
+            "CountryName": city["CountryName"],
+            "TopThingsToDo": city["TopThingsToDo"],
+            "Itinerary": city["Itinerary"]
+        })
+
+    def add_review(self, name, review_id, content, stars):
+        # One transaction, so the aggregate never misses a review, and a
+        # retried review fails the condition rather than counting twice
+        try:
+            self._resource().meta.client.transact_write_items(TransactItems=[
+                {"Put": {
+                    "TableName": self.table_names["reviews"],
+                    "Item": {
+                        "CityName": name, "ReviewId": review_id,
+                        "ReviewContent": content, "Stars": stars
+                    },
+                    "ConditionExpression": "attribute_not_exists(ReviewId)"
+                }},
+                {"Update": {
+                    "TableName": self.table_names["stats"],
+                    "Key": {"CityName": name},
+                    **self.stats_update(stars)
+                }}
+            ])
+        except ClientError as error:
+            reasons = error.response.get("CancellationReasons", [])
+            if reasons and reasons[0].get("Code") == "ConditionalCheckFailed":
+                raise ValueError(f"Review {review_id} of {name} already exists") from error
+            raise
+
+    @staticmethod
+    def stats_update(stars, direction=1):
+        "Update arguments that add (or remove) one review from the aggregate"
+        return {
+            "UpdateExpression": "ADD ReviewCount :count, StarTotal :stars, #bucket :count",
+            "ExpressionAttributeNames": {"#bucket": f"Stars{int(stars)}"},
+            "ExpressionAttributeValues": {":count": direction, ":stars": direction * int(stars)}
+        }
+
+    def rebuild_review_stats(self, name):
+        stats = empty_stats()
+        items = iter_items(
+            self.reviews_table.query,
+            KeyConditionExpression=Key('CityName').eq(name),
+            ProjectionExpression="Stars"
+        )
+        for item in items:
+            add_to_stats(stats, item['Stars'])
+        self.stats_table.put_item(Item={"CityName": name, **stats})
+
+
+class MemoryStore(Store):
+    "Everything in process memory, for tests and benchmarks"
+
+    def __init__(self):
+        self._cities = {}
+        self._names = []
+        self._reviews = {}
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def list_cities(self):
+        return iter([dict(self._cities[name]) for name in self._names])
+
+    def cities_page(self, page_size, cursor=None):
+        start = 0
+        after = decode_cursor(cursor)
+        if after:
+            start = bisect.bisect_right(self._names, after["CityName"])
+        names = self._names[start:start + page_size]
+        links = [{"Name": name, "CountryName": self._cities[name]["CountryName"]} for name in names]
+        next_cursor = None
+        if names and start + page_size < len(self._names):
+            next_cursor = encode_cursor({"CityName": names[-1]})
+        return links, next_cursor
+
+    def get_city(self, name):
+        city = self._cities.get(name)
+        return dict(city) if city else None
+
+    def get_cities(self, names):
+        return {name: dict(self._cities[name]) for name in names if name in self._cities}
+
+    def reviews_page(self, name, page_size, cursor=None):
+        reviews = self._reviews.get(name, [])
+        end = len(reviews)
+        before = decode_cursor(cursor)
+        if before:
+            end = bisect.bisect_left(reviews, (before["ReviewId"],))
+        page = reviews[max(end - page_size, 0):end][::-1]
+        next_cursor = None
+        if page and end - page_size > 0:
+            next_cursor = encode_cursor({"CityName": name, "ReviewId": page[-1][0]})
+        return [make_review(item) for _, item in page], next_cursor
+
+    def iter_reviews(self, name):
+        for _, item in reversed(self._reviews.get(name, [])):
+            yield make_review(item)
+
+    def review_stats(self, name):
+        stats = self._stats.get(name)
+        return dict(stats) if stats else None
+
+    def review_stats_many(self, names):
+        return {name: dict(self._stats[name]) for name in names if name in self._stats}
+
+    def add_city(self, city):
+        with self._lock:
+            if city["Name"] not in self._cities:
+                bisect.insort(self._names, city["Name"])
+            self._cities[city["Name"]] = dict(city)
+
+    def add_review(self, name, review_id, content, stars):
+        item = {"ReviewContent": content, "Stars": int(stars)}
+        with self._lock:
+            reviews = self._reviews.setdefault(name, [])
+            position = bisect.bisect_left(reviews, (review_id,))
+            if position < len(reviews) and reviews[position][0] == review_id:
+                raise ValueError(f"Review {review_id} of {name} already exists")
+            reviews.insert(position, (review_id, item))
+            add_to_stats(self._stats.setdefault(name, empty_stats()), stars)
+
+    def rebuild_review_stats(self, name):
+        stats = empty_stats()
+        for _, item in self._reviews.get(name, []):
+            add_to_stats(stats, item["Stars"])
+        with self._lock:
+            self._stats[name] = stats
+
+
+class SqliteStore(Store):
+    "A SQLite database in WAL mode, with one connection per thread"
+
+    CITY_QUERY = "SELECT name, country_code, country_name, top_things, itinerary FROM cities"
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS cities (
+            name TEXT PRIMARY KEY, country_code TEXT, country_name TEXT,
+            top_things TEXT, itinerary TEXT
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS reviews (
+            city TEXT NOT NULL, review_id TEXT NOT NULL, content TEXT, stars INTEGER,
+            PRIMARY KEY (city, review_id)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS review_stats (
+            city TEXT PRIMARY KEY, stats TEXT NOT NULL
+        ) WITHOUT ROWID;
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        with self._connect() as db:
+            db.executescript(self.SCHEMA)
+
+    def _connect(self):
+        "This thread's connection"
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = self._local.db = sqlite3.connect(self.path, timeout=30)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+        return db
+
+    @staticmethod
+    def _city(row):
+        "Convert a cities row for the templates"
+        return {
+            "Name": row[0],
+            "CountryCode": row[1],
+            "CountryName": row[2],
+            "TopThingsToDo": json.loads(row[3]),
+            "Itinerary": row[4]
+        }
+
+    def list_cities(self):
+        rows = self._connect().execute(self.CITY_QUERY + " ORDER BY name")
+        for row in rows:
+            yield self._city(row)
+
+    def cities_page(self, page_size, cursor=None):
+        after = decode_cursor(cursor)
+        rows = self._connect().execute(
+            "SELECT name, country_name FROM cities WHERE name > ? ORDER BY name LIMIT ?",
+            (after["CityName"] if after else "", page_size + 1)
+        ).fetchall()
+        links = [{"Name": name, "CountryName": country} for name, country in rows[:page_size]]
+        next_cursor = None
+        if len(rows) > page_size:
+            next_cursor = encode_cursor({"CityName": links[-1]["Name"]})
+        return links, next_cursor
+
+    def get_city(self, name):
+        row = self._connect().execute(self.CITY_QUERY + " WHERE name = ?", (name,)).fetchone()
+        return self._city(row) if row else None
+
+    def _select_in(self, query, names):
+        "Run query, whose ? is replaced by a list of placeholders, over names in chunks"
+        names = list(dict.fromkeys(names))
+        db = self._connect()
+        for start in range(0, len(names), SQLITE_IN_SIZE):
+            chunk = names[start:start + SQLITE_IN_SIZE]
+            yield from db.execute(query.replace("?", ", ".join("?" * len(chunk))), chunk)
+
+    def get_cities(self, names):
+        rows = self._select_in(self.CITY_QUERY + " WHERE name IN (?)", names)
+        return {row[0]: self._city(row) for row in rows}
+
+    def reviews_page(self, name, page_size, cursor=None):
+        before = decode_cursor(cursor)
+        if before:
+            rows = self._connect().execute(
+                "SELECT review_id, content, stars FROM reviews WHERE city = ? AND review_id < ? "
+                "ORDER BY review_id DESC LIMIT ?",
+                (name, before["ReviewId"], page_size + 1)
+            ).fetchall()
+        else:
+            rows = self._connect().execute(
+                "SELECT review_id, content, stars FROM reviews WHERE city = ? "
+                "ORDER BY review_id DESC LIMIT ?",
+                (name, page_size + 1)
+            ).fetchall()
+        reviews = [
+            {"ReviewContent": content, "Stars": stars} for _, content, stars in rows[:page_size]
+        ]
+        next_cursor = None
+        if len(rows) > page_size:
+            next_cursor = encode_cursor({"CityName": name, "ReviewId": rows[page_size - 1][0]})
+        return reviews, next_cursor
+
+    def iter_reviews(self, name):
+        rows = self._connect().execute(
+            "SELECT content, stars FROM reviews WHERE city = ? ORDER BY review_id DESC", (name,)
+        )
+        for content, stars in rows:
+            yield {"ReviewContent": content, "Stars": stars}
+
+    def review_stats(self, name):
+        row = self._connect().execute(
+            "SELECT stats FROM review_stats WHERE city = ?", (name,)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def review_stats_many(self, names):
+        rows = self._select_in("SELECT city, stats FROM review_stats WHERE city IN (?)", names)
+        return {name: json.loads(stats) for name, stats in rows}
+
+    def add_city(self, city):
+        self.add_cities([city])
+
+    def add_cities(self, cities):
+        rows = (
+            (city["Name"], city["CountryCode"], city["CountryName"],
+             json.dumps(list(city["TopThingsToDo"])), city["Itinerary"])
+            for city in cities
+        )
+        with self._write_lock, self._connect() as db:
+            db.executemany("INSERT OR REPLACE INTO cities VALUES (?, ?, ?, ?, ?)", rows)
+
+    def add_review(self, name, review_id, content, stars):
+        try:
+            self.add_reviews([(name, review_id, content, stars)])
+        except sqlite3.IntegrityError as error:
+            raise ValueError(f"Review {review_id} of {name} already exists") from error
+
+    def add_reviews(self, reviews):
+        deltas = {}
+        rows = []
+        for name, review_id, content, stars in reviews:
+            rows.append((name, review_id, content, int(stars)))
+            add_to_stats(deltas.setdefault(name, empty_stats()), stars)
+        with self._write_lock, self._connect() as db:
+            db.executemany("INSERT INTO reviews VALUES (?, ?, ?, ?)", rows)
+            # Fold this batch into the stored aggregates instead of recounting
+            for name, delta in deltas.items():
+                row = db.execute(
+                    "SELECT stats FROM review_stats WHERE city = ?", (name,)
+                ).fetchone()
+                stats = json.loads(row[0]) if row else empty_stats()
+                for key, value in delta.items():
+                    stats[key] += value
+                db.execute(
+                    "INSERT OR REPLACE INTO review_stats VALUES (?, ?)", (name, json.dumps(stats))
+                )
+
+    def rebuild_review_stats(self, name):
+        stats = empty_stats()
+        rows = self._connect().execute("SELECT stars FROM reviews WHERE city = ?", (name,))
+        for (stars,) in rows:
+            add_to_stats(stats, stars)
+        with self._write_lock, self._connect() as db:
+            db.execute(
+                "INSERT OR REPLACE INTO review_stats VALUES (?, ?)", (name, json.dumps(stats))
+            )
+
+
+class LatencyStore(Store):
+    "Wraps a store and sleeps before every read, to stand in for network round trips"
+
+    def __init__(self, store, latency, jitter=0.0):
+        self.store = store
+        self.latency = latency
+        self.jitter = jitter
+
+    def _wait(self):
+        "Sleep for latency +/- jitter seconds"
+        time.sleep(max(self.latency + random.uniform(-self.jitter, self.jitter), 0))
+
+    def list_cities(self):
+        self._wait()
+        return self.store.list_cities()
+
+    def cities_page(self, page_size, cursor=None):
+        self._wait()
+        return self.store.cities_page(page_size, cursor)
+
+    def get_city(self, name):
+        self._wait()
+        return self.store.get_city(name)
+
+    def get_cities(self, names):
+        self._wait()
+        return self.store.get_cities(names)
+
+    def reviews_page(self, name, page_size, cursor=None):
+        self._wait()
+        return self.store.reviews_page(name, page_size, cursor)
+
+    def iter_reviews(self, name):
+        self._wait()
+        return self.store.iter_reviews(name)
+
+    def review_stats(self, name):
+        self._wait()
+        return self.store.review_stats(name)
+
+    def review_stats_many(self, names):
+        self._wait()
+        return self.store.review_stats_many(names)
+
+    def add_city(self, city):
+        self.store.add_city(city)
+
+    def add_review(self, name, review_id, content, stars):
+        self.store.add_review(name, review_id, content, stars)
+
+    def rebuild_review_stats(self, name):
+        self.store.rebuild_review_stats(name)
+
+
+def open_store(backend=None):
+    "The store selected by STORAGE_BACKEND (dynamodb, sqlite or memory)"
+    backend = backend or os.getenv("STORAGE_BACKEND", "dynamodb")
+    if backend == "dynamodb":
+        return DynamoStore(stats_table=os.getenv("REVIEW_STATS_TABLE", "CityReviewStats"))
+    if backend == "sqlite":
+        return SqliteStore(os.getenv("STORAGE_PATH", "cities.db"))
+    if backend == "memory":
+        return MemoryStore()
+    raise ValueError(f"Unknown STORAGE_BACKEND {backend!r}")
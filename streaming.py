@@ -0,0 +1,86 @@
+"Helpers for streaming generated text to clients"
+import contextvars
+import queue
+import threading
+import time
+
+# Marks the end of the upstream chunks
+_END = object()
+# Chunks read ahead of a slow client before upstream is held back
+READ_AHEAD = 256
+
+def _put(pending, item, stop):
+    "Queue an item, giving up once the reader has stopped"
+    while not stop.is_set():
+        try:
+            pending.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+def _pump(chunks, pending, stop):
+    "Move upstream chunks into pending until they run out or the reader stops, then close upstream"
+    try:
+        for chunk in chunks:
+            if not _put(pending, chunk, stop):
+                break
+        else:
+            _put(pending, _END, stop)
+    except Exception as error:  # pylint: disable=broad-except
+        _put(pending, error, stop)
+    finally:
+        close = getattr(chunks, "close", None)
+        if close is not None:
+            close()
+
+def coalesce(chunks, max_bytes=512, max_delay=0.05):
+    """
+    Join small chunks into larger writes. The first chunk is passed on at
+    once; after it, buffered text is flushed once it reaches max_bytes or has
+    waited max_delay seconds, and always when the stream ends. Upstream is
+    read on its own thread, so the delay holds however slow the next chunk
+    is. Closing the coalesced stream closes the upstream too, after the chunk
+    it is producing.
+    """
+    pending = queue.Queue(maxsize=READ_AHEAD)
+    stop = threading.Event()
+    # The request's context goes along, for the metrics of backend calls upstream makes
+    threading.Thread(
+        target=contextvars.copy_context().run, args=(_pump, chunks, pending, stop),
+        name="coalesce", daemon=True
+    ).start()
+    buffer = []
+    size = 0
+    deadline = None
+    first = True
+    try:
+        while True:
+            try:
+                timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+                chunk = pending.get(timeout=timeout)
+            except queue.Empty:
+                yield "".join(buffer)
+                buffer, size, deadline = [], 0, None
+                continue
+            if chunk is _END:
+                break
+            if isinstance(chunk, Exception):
+                raise chunk
+            if not chunk:
+                continue
+            if first:
+                first = False
+                yield chunk
+                continue
+            if not buffer:
+                deadline = time.monotonic() + max_delay
+            buffer.append(chunk)
+            size += len(chunk)
+            if size >= max_bytes:
+                yield "".join(buffer)
+                buffer, size, deadline = [], 0, None
+        if buffer:
+            yield "".join(buffer)
+    finally:
+        stop.set()
@@ -0,0 +1,40 @@
+"Jinja setup shared by the Flask apps"
+import os
+import posixpath
+from urllib.parse import urlparse
+from flask import g, request
+from jinja2 import FileSystemBytecodeCache
+
+def jinja_options(app):
+    """
+    The app's Jinja options plus a bytecode cache, so a new worker loads
+    compiled templates from JINJA_CACHE_DIR instead of compiling them again.
+    Set JINJA_BYTECODE_CACHE=0 to turn it off.
+    """
+    options = dict(app.jinja_options)
+    if os.getenv("JINJA_BYTECODE_CACHE", "1") != "0":
+        # With no directory Jinja picks a private one under the temp dir
+        options["bytecode_cache"] = FileSystemBytecodeCache(os.getenv("JINJA_CACHE_DIR"))
+    return options
+
+def request_base():
+    "The directory of the current request's path, worked out once per request"
+    base = g.get("relative_url_base")
+    if base is None:
+        base = g.relative_url_base = posixpath.dirname(urlparse(request.url).path)
+    return base
+
+def relative_path(endpoint, start):
+    "posixpath.relpath(endpoint, start) without its normalising in the common cases"
+    plain = endpoint.startswith("/") and "//" not in endpoint and "/." not in endpoint \
+        and not endpoint.endswith("/")
+    if plain:
+        if start == "/":
+            return endpoint[1:]
+        if endpoint.startswith(start + "/"):
+            return endpoint[len(start) + 1:]
+    return posixpath.relpath(endpoint, start=start)
+
+def relative_url(endpoint):
+    "Build a relative URL from an absolute path"
+    return relative_path(endpoint, request_base())
@@ -1,13 +1,39 @@
 "Unit tests for the travel app"
+import importlib.machinery
+import importlib.util
+import io
+import os
+import sys
+import tempfile
+import time
 import unittest
-from unittest.mock import patch
-import app
+from unittest.mock import Mock, patch
+
+# Keep precomputed KB answers out of the working directory
+os.environ.setdefault("KB_STORE_PATH", ":memory:")
+
+# pylint: disable=wrong-import-position
+from kb_store import KBAnswerStore
+from review_index import build_index
+
+def load_bedrock_app():
+    "Import app.pybkp, the Bedrock version of the app, as the bedrock_app module"
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.pybkp")
+    loader = importlib.machinery.SourceFileLoader("bedrock_app", path)
+    module = importlib.util.module_from_spec(importlib.util.spec_from_loader("bedrock_app", loader))
+    # Registered first, so Flask finds the templates next to it and patch() finds it by name
+    sys.modules["bedrock_app"] = module
+    loader.exec_module(module)
+    return module
+
+app = load_bedrock_app()
 
 FAKE_CITY1 = {
     "CityName": "Test-city-1",
     "CountryCode": "TC1",
     "CountryName": "TestCountry1",
-    "TopThingsToDo": ["TODO1", "TODO2"]
+    "TopThingsToDo": ["TODO1", "TODO2"],
+    "Itinerary": "Day one\nDay two"
 }
 
 FAKE_CITY2 = {
@@ -81,7 +107,12 @@ def mock_retrieve_and_generate_no_citations(input, retrieveAndGenerateConfigurat
 class FlaskTestCase(unittest.TestCase):
     "Test Fixture"
 
-    @patch('app.cities_table.scan', mock_cities_scan)
+    def setUp(self):
+        "Start every test without cached generations or KB answers"
+        app.generations.invalidate()
+        app.kb_answers.clear()
+
+    @patch('bedrock_app.cities_table.scan', mock_cities_scan)
     def test_homepage(self):
         "Test the homepage has results from the data store"
         tester = app.app.test_client(self)
@@ -90,16 +121,19 @@ class FlaskTestCase(unittest.TestCase):
         self.assertIn('Test-city-1, TestCountry', response.data.decode('utf-8'))
         self.assertIn('Test-city-2, TestCountry2', response.data.decode('utf-8'))
 
-    @patch('app.cities_table.query', mock_cities_query)
+    @patch('bedrock_app.cities_table.query', mock_cities_query)
     def test_city_detail_page(self):
-        "Test a details page has todo, itinerary, and reviews"
+        "Test a details page has the things to do and the itinerary"
         tester = app.app.test_client(self)
         response = tester.get('/city/Test-city-1')
-        self.assertIn('Itinerary Planner Test-city-1', response.data.decode('utf-8'))
         self.assertEqual(response.status_code, 200)
+        page = response.data.decode('utf-8')
+        self.assertIn('Top things to do in Test-city-1', page)
+        self.assertIn('<li>TODO2</li>', page)
+        self.assertIn('Day one<br>Day two', page)
 
 
-    @patch('app.cities_table.query', mock_cities_query_no_results)
+    @patch('bedrock_app.cities_table.query', mock_cities_query_no_results)
     def test_city_detail_404(self):
         "Test empty results from the data store"
         tester = app.app.test_client(self)
@@ -107,8 +141,9 @@ class FlaskTestCase(unittest.TestCase):
         self.assertEqual(response.status_code, 404)
 
 
-    @patch('app.cities_table.query', mock_cities_query)
-    @patch('app.bedrock.invoke_model_with_response_stream', mock_invoke_model_with_response_stream)
+    @patch('bedrock_app.cities_table.query', mock_cities_query)
+    @patch('bedrock_app.bedrock.invoke_model_with_response_stream',
+           mock_invoke_model_with_response_stream)
     def test_suggestions(self):
         "Test the suggestions route"
         tester = app.app.test_client(self)
@@ -121,8 +156,26 @@ class FlaskTestCase(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertIn(b"response text", response.data)
 
-    @patch('app.cities_table.query', mock_cities_query)
-    @patch('app.bedrock_agent.retrieve_and_generate', mock_retrieve_and_generate)
+    @patch('bedrock_app.cities_table.query', mock_cities_query)
+    def test_suggestions_are_cached(self):
+        "Test identical itinerary requests reuse the first generation"
+        tester = app.app.test_client(self)
+        with patch('bedrock_app.bedrock.invoke_model_with_response_stream',
+                   side_effect=mock_invoke_model_with_response_stream) as invoke:
+            first = tester.post('/suggestions/Test-city-1', data={
+                'days': '2',
+                'interests': ['nightlife', 'museums']
+            })
+            self.assertIn(b"response text", first.data)
+            second = tester.post('/suggestions/Test-city-1', data={
+                'days': '2 ',
+                'interests': ['museums', 'nightlife']
+            })
+            self.assertIn(b"response text", second.data)
+        self.assertEqual(invoke.call_count, 1)
+
+    @patch('bedrock_app.cities_table.query', mock_cities_query)
+    @patch('bedrock_app.bedrock_agent.retrieve_and_generate', mock_retrieve_and_generate)
     def test_knowledgebase(self):
         "Test the suggestions route"
         tester = app.app.test_client(self)
@@ -132,8 +185,9 @@ class FlaskTestCase(unittest.TestCase):
         self.assertEqual("Answer text<sup>[1]</sup>", response.json['Output'])
         self.assertEqual("⭐️⭐️⭐️⭐️ Review text", response.json['Reviews'][0])
 
-    @patch('app.cities_table.query', mock_cities_query)
-    @patch('app.bedrock_agent.retrieve_and_generate', mock_retrieve_and_generate_no_citations)
+    @patch('bedrock_app.cities_table.query', mock_cities_query)
+    @patch('bedrock_app.bedrock_agent.retrieve_and_generate',
+           mock_retrieve_and_generate_no_citations)
     def test_knowledgebase_no_citations(self):
         "Ensure the correct response when KB has no citations"
         tester = app.app.test_client(self)
@@ -144,3 +198,101 @@ class FlaskTestCase(unittest.TestCase):
             "Sorry, I don't have enough reviews for this location.",
             response.json['Output']
         )
+
+    @patch('bedrock_app.cities_table.query', mock_cities_query)
+    def test_knowledgebase_local_index(self):
+        "Test KB answers from the local review index, with and without a model"
+        folder = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.addCleanup(folder.cleanup)
+        path = os.path.join(folder.name, "index")
+        build_index([
+            {"CityName": "Test-city-1", "Stars": 5,
+             "ReviewContent": "The food market was wonderful"},
+            {"CityName": "Test-city-2", "Stars": 1, "ReviewContent": "The food was bad"}
+        ], path)
+        model_output = io.BytesIO(b'{"results": [{"outputText": "Try the market [1]."}]}')
+        tester = app.app.test_client(self)
+        with patch('bedrock_app.REVIEW_INDEX_PATH', path), \
+                patch('bedrock_app.bedrock.invoke_model',
+                      return_value={"body": model_output}) as invoke:
+            response = tester.post('/kb/Test-city-1', data={'q': '1'})
+            self.assertEqual("Try the market <sup>[1]</sup>.", response.json['Output'])
+            self.assertEqual(["⭐️⭐️⭐️⭐️⭐️ The food market was wonderful"], response.json['Reviews'])
+            self.assertIn("[1] The food market was wonderful", invoke.call_args.kwargs["body"])
+            app.kb_answers.clear()
+            with patch('bedrock_app.KB_GENERATION', "extractive"):
+                response = tester.post('/kb/Test-city-1', data={'q': '1'})
+            self.assertEqual(1, invoke.call_count)
+            self.assertEqual("The food market was wonderful<sup>[1]</sup>", response.json['Output'])
+            # A rebuilt index is picked up without a restart
+            build_index([
+                {"CityName": "Test-city-1", "Stars": 4, "ReviewContent": "The new food hall"}
+            ], path)
+            app.kb_answers.clear()
+            with patch('bedrock_app.KB_GENERATION', "extractive"):
+                response = tester.post('/kb/Test-city-1', data={'q': '1'})
+        self.assertEqual("The new food hall<sup>[1]</sup>", response.json['Output'])
+
+    @patch('bedrock_app.cities_table.query', mock_cities_query)
+    def test_knowledgebase_served_from_store(self):
+        "Test repeated KB questions are answered from the store"
+        tester = app.app.test_client(self)
+        with patch('bedrock_app.bedrock_agent.retrieve_and_generate',
+                   side_effect=mock_retrieve_and_generate) as retrieve:
+            tester.post('/kb/Test-city-1', data={'q': '0'})
+            response = tester.post('/kb/Test-city-1', data={'q': '0'})
+        self.assertEqual(retrieve.call_count, 1)
+        self.assertEqual("Answer text<sup>[1]</sup>", response.json['Output'])
+
+    @patch('bedrock_app.cities_table.query', mock_cities_query)
+    @patch('bedrock_app.bedrock_agent.retrieve_and_generate', mock_retrieve_and_generate)
+    def test_knowledgebase_stale_while_revalidate(self):
+        "Test a stale answer is served while it is refreshed in the background"
+        app.kb_answers.put("Test-city-1", 0, {"Output": "Old answer"})
+        tester = app.app.test_client(self)
+        later = time.time() + 2 * app.kb_answers.max_age
+        with patch.object(app.kb_answers, 'clock', lambda: later):
+            response = tester.post('/kb/Test-city-1', data={'q': '0'})
+            self.assertEqual("Old answer", response.json['Output'])
+            for _ in range(100):
+                answer, _ = app.kb_answers.get("Test-city-1", 0)
+                if answer["Output"] != "Old answer":
+                    break
+                time.sleep(0.01)
+        self.assertEqual("Answer text<sup>[1]</sup>", answer['Output'])
+
+    @patch('bedrock_app.cities_table.query', mock_cities_query)
+    def test_knowledgebase_unknown_prompt(self):
+        "Test prompt numbers out of range are refused"
+        tester = app.app.test_client(self)
+        for q_index in ("-1", "4", "x", "", "²"):
+            response = tester.post('/kb/Test-city-1', data={'q': q_index})
+            self.assertEqual(400, response.status_code, q_index)
+
+    def test_knowledgebase_failed_refresh(self):
+        "Test a failed background refresh is logged and the stale answer kept"
+        store = KBAnswerStore(":memory:", max_age=0)
+        store.put("Test-city-1", 0, {"Output": "Old answer"})
+        with self.assertLogs("kb_store", "ERROR"):
+            store.refresh("Test-city-1", 0, Mock(side_effect=RuntimeError("Throttled"))).result()
+        self.assertEqual("Old answer", store.get("Test-city-1", 0)[0]["Output"])
+
+    @patch('bedrock_app.cities_table.scan', mock_cities_scan)
+    @patch('bedrock_app.bedrock_agent.retrieve_and_generate', mock_retrieve_and_generate)
+    def test_precompute_kb_command(self):
+        "Test the precompute job answers every prompt for every city"
+        result = app.app.test_cli_runner().invoke(args=['precompute-kb'])
+        self.assertIn("Stored 8 answers for 2 cities, 0 failed", result.output)
+        self.assertIsNotNone(app.kb_answers.get("Test-city-2", 3))
+
+    def test_precompute_keeps_going_after_failures(self):
+        "Test a failed answer is logged and counted, and the others are still stored"
+        store = KBAnswerStore(":memory:")
+        def compute(city, prompt):
+            if (city, prompt) == ("Test-city-1", 1):
+                raise RuntimeError("Throttled")
+            return {"Output": f"{city} {prompt}"}
+        with self.assertLogs("kb_store", "ERROR"):
+            self.assertEqual((7, 1), store.precompute(["Test-city-1", "Test-city-2"], 4, compute))
+        self.assertIsNone(store.get("Test-city-1", 1))
+        self.assertEqual("Test-city-2 3", store.get("Test-city-2", 3)[0]["Output"])
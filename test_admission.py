@@ -0,0 +1,122 @@
+"Unit tests for admission control"
+import threading
+import time
+import unittest
+from flask import Flask
+from admission import Admission, Limit, init_admission
+from metrics import Registry
+
+def make_app(admission):
+    "An app with a streamed slow route, a quick route and a health check"
+    app = Flask(__name__)
+    init_admission(app, admission, registry=Registry())
+    started = threading.Event()
+    finish = threading.Event()
+
+    @app.route('/slow')
+    def slow():
+        def generate():
+            started.set()
+            finish.wait(5)
+            yield "done"
+        return app.response_class(generate())
+
+    @app.route('/quick')
+    def quick():
+        return "quick"
+
+    @app.route('/health')
+    def health():
+        return admission.health()[0]
+
+    @app.route('/ready')
+    def ready():
+        report, is_ready = admission.health()
+        return report, 200 if is_ready else 503
+
+    return app, started, finish
+
+class LimitTestCase(unittest.TestCase):
+    "Test Fixture"
+
+    def test_queue_then_shed(self):
+        "Test requests beyond the slots wait in the queue and beyond the queue are shed"
+        limit = Limit(concurrency=1, queue=1, wait=5)
+        self.assertTrue(limit.acquire())
+        admitted = []
+        waiter = threading.Thread(target=lambda: admitted.append(limit.acquire()))
+        waiter.start()
+        while limit.waiting == 0:
+            time.sleep(0.001)
+        self.assertFalse(limit.acquire())
+        self.assertEqual(1.0, limit.saturation())
+        limit.release()
+        waiter.join()
+        self.assertEqual([True], admitted)
+        self.assertEqual({"Active": 1, "Waiting": 0, "Admitted": 2, "Shed": 1},
+                         {key: limit.stats()[key]
+                          for key in ("Active", "Waiting", "Admitted", "Shed")})
+
+    def test_wait_timeout(self):
+        "Test a queued request gives up after the class's wait"
+        now = [0.0]
+        limit = Limit(concurrency=1, queue=5, wait=0.01, clock=lambda: now[0])
+        limit.acquire()
+        # pylint: disable-next=protected-access
+        limit._condition.wait = lambda timeout: now.__setitem__(0, now[0] + timeout)
+        self.assertFalse(limit.acquire())
+        self.assertEqual(0, limit.waiting)
+
+class AdmissionTestCase(unittest.TestCase):
+    "Test Fixture"
+
+    def setUp(self):
+        self.admission = Admission({
+            "slow": Limit(concurrency=1, queue=0, retry_after=7),
+            "pages": Limit(concurrency=10, queue=10)
+        }, routes={"slow": "slow"}, default="pages")
+        self.app, self.started, self.finish = make_app(self.admission)
+
+    def test_stream_holds_slot_and_sheds(self):
+        "Test a stream keeps its slot, others of its class get a 503, other classes are served"
+        client = self.app.test_client()
+        results = []
+        streaming = threading.Thread(target=lambda: results.append(client.get('/slow').data))
+        streaming.start()
+        self.started.wait(5)
+        shed = client.get('/slow')
+        self.assertEqual(503, shed.status_code)
+        self.assertEqual("7", shed.headers["Retry-After"])
+        self.assertEqual(b"quick", client.get('/quick').data)
+        health = client.get('/health')
+        self.assertEqual(200, health.status_code)
+        self.assertEqual("overloaded", health.json["Status"])
+        self.assertEqual(1, health.json["Classes"]["slow"]["Shed"])
+        self.assertEqual(503, client.get('/ready').status_code)
+        self.finish.set()
+        streaming.join()
+        self.assertEqual([b"done"], results)
+        self.assertEqual(0, self.admission.limits["slow"].active)
+        self.assertEqual(200, client.get('/ready').status_code)
+
+    def test_abandoned_stream_releases(self):
+        "Test closing a stream before it started still frees the slot"
+        self.finish.set()
+        response = self.app.test_client().get('/slow', buffered=False)
+        self.assertEqual(1, self.admission.limits["slow"].active)
+        response.close()
+        self.assertEqual(0, self.admission.limits["slow"].active)
+
+    def test_error_releases(self):
+        "Test a failing view frees its slot"
+        @self.app.route('/broken')
+        def broken():
+            raise RuntimeError("broken")
+        self.app.testing = False
+        response = self.app.test_client().get('/broken')
+        self.assertEqual(500, response.status_code)
+        response.close()
+        self.assertEqual(0, self.admission.limits["pages"].active)
+
+if __name__ == '__main__':
+    unittest.main()
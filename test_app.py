@@ -1,10 +1,16 @@
 "Unit tests for the travel app"
+import os
+import tempfile
+import threading
+import time
 import unittest
 from unittest.mock import patch
 import app
+from snapshot import SnapshotStore, build_snapshot
+from storage import MemoryStore
 
 FAKE_CITY1 = {
-    "CityName": "Test-city-1",
+    "Name": "Test-city-1",
     "CountryCode": "TC1",
     "CountryName": "TestCountry1",
     "TopThingsToDo": ["TODO1", "TODO2"],
@@ -12,46 +18,35 @@ FAKE_CITY1 = {
 }
 
 FAKE_CITY2 = {
-    "CityName": "Test-city-2",
+    "Name": "Test-city-2",
     "CountryCode": "TC2",
     "CountryName": "TestCountry2",
     "TopThingsToDo": ["TODO1", "TODO2"],
     "Itinerary": "Day one\nDay two"
 }
 
-FAKE_REVIEW1 = {
-    "ReviewContent": "This is a review",
-    "Stars": 5
-}
-
-FAKE_REVIEW2 = {
-    "ReviewContent": "This is also a review",
-    "Stars": 4
-}
+FAKE_REVIEW1 = ("Test-city-1", "r1", "This is a review", 5)
 
-def mock_cities_scan():
-    "The cities returned from the database"
-    return {"Items" : [ FAKE_CITY1, FAKE_CITY2 ]}
+FAKE_REVIEW2 = ("Test-city-1", "r2", "This is also a review", 4)
 
-#  pylint: disable=invalid-name, unused-argument
-def mock_cities_query(KeyConditionExpression):
-    "Query for a single city"
-    return {"Items" : [ FAKE_CITY1 ]}
+def make_store():
+    "An in-memory data store with the fake cities and reviews"
+    store = MemoryStore()
+    store.add_cities([FAKE_CITY1, FAKE_CITY2])
+    store.add_reviews([FAKE_REVIEW1, FAKE_REVIEW2])
+    return store
 
-#  pylint: disable=invalid-name, unused-argument
-def mock_cities_query_no_results(KeyConditionExpression):
-    "Query for a single city"
-    return {"Items" : [ ]}
-
-#  pylint: disable=invalid-name, unused-argument
-def mock_reviews_query(KeyConditionExpression):
-    "Query for city reviews"
-    return {"Items" : [ FAKE_REVIEW1, FAKE_REVIEW2 ]}
-
-class FlaskTestCase(unittest.TestCase):
+class FlaskTestCase(unittest.TestCase):  # pylint: disable=too-many-public-methods
     "Test Fixture"
 
-    @patch('app.cities_table.scan', mock_cities_scan)
+    def setUp(self):
+        "Start every test with fresh data and a cold catalogue cache"
+        self.store = make_store()
+        patcher = patch('app.store', self.store)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        app.invalidate_cities()
+
     def test_homepage(self):
         "Test the homepage has results from the data store"
         tester = app.app.test_client(self)
@@ -60,8 +55,6 @@ class FlaskTestCase(unittest.TestCase):
         self.assertIn('Test-city-1, TestCountry', response.data.decode('utf-8'))
         self.assertIn('Test-city-2, TestCountry2', response.data.decode('utf-8'))
 
-    @patch('app.cities_table.query', mock_cities_query)
-    @patch('app.reviews_table.query', mock_reviews_query)
     def test_city_detail_page(self):
         "Test a details page has todo, itinerary, and reviews"
         tester = app.app.test_client(self)
@@ -73,7 +66,251 @@ class FlaskTestCase(unittest.TestCase):
         self.assertIn('⭐️⭐️⭐️⭐️⭐️ This is a review', response.data.decode('utf-8'))
         self.assertIn('⭐️⭐️⭐️⭐️ This is also a review', response.data.decode('utf-8'))
 
-    @patch('app.cities_table.query', mock_cities_query_no_results)
+    @patch('app.CITIES_PAGE_SIZE', 1)
+    def test_homepage_pagination(self):
+        "Test the homepage links to the next page of cities"
+        tester = app.app.test_client(self)
+        first = tester.get('/').data.decode('utf-8')
+        self.assertIn('Test-city-1, TestCountry1', first)
+        self.assertNotIn('Test-city-2', first)
+        next_cursor = app.load_cities_page()[1]
+        self.assertIn(f'?page={next_cursor}', first)
+        second = tester.get(f'/?page={next_cursor}').data.decode('utf-8')
+        self.assertIn('Test-city-2, TestCountry2', second)
+
+    def test_homepage_is_cached(self):
+        "Test repeated homepage hits only read the data store once"
+        tester = app.app.test_client(self)
+        hits = tester.get('/api/cache').json['Cities']['Hits']
+        with patch.object(self.store, 'cities_page', side_effect=self.store.cities_page) as scan:
+            tester.get('/')
+            tester.get('/')
+        self.assertEqual(scan.call_count, 1)
+        self.assertEqual(hits + 1, tester.get('/api/cache').json['Cities']['Hits'])
+
+    def test_city_detail_review_stats(self):
+        "Test the rating aggregate is shown above the reviews"
+        self.store.add_reviews([("Test-city-1", "r3", "Fine", 5), ("Test-city-1", "r4", "Meh", 3)])
+        tester = app.app.test_client(self)
+        page = tester.get('/city/Test-city-1').data.decode('utf-8')
+        self.assertIn('<strong>4.2 ⭐️</strong> from 4 reviews', page)
+        self.assertLess(page.index('review-stats'), page.index('This is a review'))
+
+    @patch('app.TOP_REVIEWS', 1)
+    def test_city_detail_top_reviews(self):
+        "Test the top rated mode only shows the best reviews"
+        tester = app.app.test_client(self)
+        page = tester.get('/city/Test-city-1?sort=top').data.decode('utf-8')
+        self.assertIn('⭐️⭐️⭐️⭐️⭐️ This is a review', page)
+        self.assertNotIn('This is also a review', page)
+
+    @patch('app.REVIEWS_PAGE_SIZE', 1)
+    def test_city_detail_review_pagination(self):
+        "Test reviews are paged newest first"
+        tester = app.app.test_client(self)
+        first = tester.get('/city/Test-city-1').data.decode('utf-8')
+        self.assertIn('This is also a review', first)
+        self.assertNotIn('This is a review', first)
+        next_cursor = app.load_city_reviews('Test-city-1')[1]
+        second = tester.get(f'/city/Test-city-1?reviews={next_cursor}').data.decode('utf-8')
+        self.assertIn('This is a review', second)
+
+    def test_invalid_cursors(self):
+        "Test cursors that do not decode to a key of the right shape are refused, not cached"
+        tester = app.app.test_client(self)
+        other_city = app.encode_cursor({"CityName": "Test-city-2", "ReviewId": "r1"})
+        for url in ('/?page=junk', '/?page=' + app.encode_cursor({"CityName": 1}),
+                    '/city/Test-city-1?reviews=junk', '/city/Test-city-1?reviews=' + other_city):
+            self.assertEqual(400, tester.get(url).status_code, url)
+        self.assertEqual(0, app.page_cache.stats()["Size"])
+        self.assertEqual(200, tester.get('/city/Test-city-1?sort=top&reviews=junk').status_code)
+
+    def test_city_page_conditional_get(self):
+        "Test city pages are cached, carry an ETag and answer If-None-Match with 304"
+        tester = app.app.test_client(self)
+        with patch.object(self.store, 'reviews_page', side_effect=self.store.reviews_page) as query:
+            first = tester.get('/city/Test-city-1')
+            second = tester.get('/city/Test-city-1',
+                                headers={'If-None-Match': first.headers['ETag']})
+        self.assertEqual(query.call_count, 1)
+        self.assertIn('public', first.headers['Cache-Control'])
+        self.assertEqual(second.status_code, 304)
+        self.assertEqual(b'', second.data)
+
+    def test_city_page_invalidated_by_new_review(self):
+        "Test a new review drops the cached page"
+        tester = app.app.test_client(self)
+        tester.get('/city/Test-city-1')
+        app.record_review("Test-city-1", "r3", "Brand new review", 4)
+        self.assertIn('Brand new review', tester.get('/city/Test-city-1').data.decode('utf-8'))
+
+    def test_record_review_updates_stats(self):
+        "Test a new review is added to the aggregate without a full query"
+        app.record_review("Test-city-1", "r3", "Great", 4)
+        stats = app.load_review_stats("Test-city-1")
+        self.assertEqual(3, stats["Count"])
+        self.assertEqual(2, stats["Histogram"][1]["Count"])
+
+    @patch('app.CITY_PAGE_DEADLINE', 0.05)
+    def test_city_detail_slow_reviews(self):
+        "Test the city still renders when the reviews miss the deadline"
+        def slow_reviews_page(*args):
+            time.sleep(0.2)
+            return self.store.reviews_page(*args)
+
+        tester = app.app.test_client(self)
+        with patch.object(self.store, 'reviews_page', side_effect=slow_reviews_page):
+            response = tester.get('/city/Test-city-1')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('Day one<br>Day two', response.data.decode('utf-8'))
+        self.assertIn('Reviews are not available right now.', response.data.decode('utf-8'))
+
+    def test_city_detail_failed_reviews_and_stats(self):
+        "Test the city still renders, uncached, when the reviews and stats lookups fail"
+        tester = app.app.test_client(self)
+        with patch.object(self.store, 'review_stats', side_effect=RuntimeError("No table")), \
+                patch.object(self.store, 'reviews_page', side_effect=RuntimeError("Throttled")), \
+                self.assertLogs(app.app.logger, "ERROR"):
+            response = tester.get('/city/Test-city-1')
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('Reviews are not available right now.', response.data.decode('utf-8'))
+        self.assertIn('This is also a review', tester.get('/city/Test-city-1').data.decode('utf-8'))
+
+    def test_search(self):
+        "Test the search endpoint follows changes to the catalogue"
+        tester = app.app.test_client(self)
+        found = tester.get('/api/cities/search?q=test-city').json['Cities']
+        self.assertEqual(['Test-city-1', 'Test-city-2'], [city['Name'] for city in found])
+        self.store.add_city(dict(FAKE_CITY1, Name="Test-city-3"))
+        app.invalidate_cities("Test-city-3")
+        found = tester.get('/api/cities/search?q=test-city-3').json['Cities']
+        self.assertEqual('Test-city-3', found[0]['Name'])
+        self.assertIn('city-search', tester.get('/').data.decode('utf-8'))
+
+    def test_search_follows_catalogue_reloads(self):
+        "Test the index catches up with unannounced changes once the cached catalogue expires"
+        tester = app.app.test_client(self)
+        tester.get('/api/cities/search?q=test-city')
+        # As if another worker added a city, then the catalogue's TTL ran out
+        self.store.add_city(dict(FAKE_CITY1, Name="Test-city-3"))
+        app.cities_cache.invalidate(("cities",))
+        found = tester.get('/api/cities/search?q=test-city-3').json['Cities']
+        self.assertEqual('Test-city-3', found[0]['Name'])
+
+    def test_batch(self):
+        "Test many cities come back in the order asked for, missing ones flagged"
+        tester = app.app.test_client(self)
+        response = tester.get('/api/cities/batch?name=Test-city-2&name=Nowhere'
+                              '&name=Test-city-1&name=Test-city-2')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(
+            [FAKE_CITY2, {"Name": "Nowhere", "Found": False}, FAKE_CITY1],
+            response.json
+        )
+        response = tester.post('/api/cities/batch',
+                               json={"Names": ["Test-city-1", "Test-city-2"], "Stats": True})
+        self.assertEqual(4.5, response.json[0]["Stats"]["Mean"])
+        self.assertIsNone(response.json[1]["Stats"])
+
+    def test_batch_chunks_and_limits(self):
+        "Test big batches are fetched in chunks and oversized or malformed ones are refused"
+        self.store.add_cities([dict(FAKE_CITY1, Name=f"City-{n:03d}") for n in range(250)])
+        names = [f"City-{n:03d}" for n in range(250)]
+        tester = app.app.test_client(self)
+        with patch.object(self.store, 'get_cities', wraps=self.store.get_cities) as get_cities:
+            response = tester.post('/api/cities/batch', json={"Names": names})
+            self.assertEqual(names, [city["Name"] for city in response.json])
+        sizes = sorted((len(c.args[0]) for c in get_cities.call_args_list), reverse=True)
+        self.assertEqual([100, 100, 50], sizes)
+        with patch('app.BATCH_MAX_CITIES', 10):
+            response = tester.post('/api/cities/batch', json={"Names": names})
+            self.assertEqual(400, response.status_code)
+        response = tester.post('/api/cities/batch', json={"Names": "City-001"})
+        self.assertEqual(400, response.status_code)
+        for body in (["City-001"], "City-001", 1, None):
+            self.assertEqual(400, tester.post('/api/cities/batch', json=body).status_code, body)
+        self.assertEqual(400, tester.post('/api/cities/batch', data="not json").status_code)
+
+    def test_batch_leaves_page_threads_free(self):
+        "Test batch chunks run on their own pool, not the one city pages use"
+        threads = []
+        get_cities = self.store.get_cities
+        def recording_get_cities(chunk):
+            threads.append(threading.current_thread().name)
+            return get_cities(chunk)
+        tester = app.app.test_client(self)
+        with patch.object(self.store, 'get_cities', side_effect=recording_get_cities):
+            tester.post('/api/cities/batch',
+                        json={"Names": ["Test-city-1", "Test-city-2"]}).get_data()
+        self.assertTrue(threads)
+        self.assertTrue(all(name.startswith("batch") for name in threads))
+
+    def test_batch_failed_chunks(self):
+        "Test a chunk that fails or misses the deadline gives error entries, the array still closes"
+        self.store.add_cities([dict(FAKE_CITY1, Name=f"City-{n:03d}") for n in range(150)])
+        names = [f"City-{n:03d}" for n in range(150)]
+        get_cities = self.store.get_cities
+        def failing_get_cities(chunk):
+            if "City-000" in chunk:
+                raise RuntimeError("Throttled")
+            return get_cities(chunk)
+        tester = app.app.test_client(self)
+        with patch.object(self.store, 'get_cities', side_effect=failing_get_cities), \
+                self.assertLogs(app.app.logger, "WARNING"):
+            cities = tester.post('/api/cities/batch', json={"Names": names}).json
+        self.assertEqual(names, [city["Name"] for city in cities])
+        self.assertIn("Error", cities[0])
+        self.assertEqual("TestCountry1", cities[-1]["CountryName"])
+        def slow_get_cities(chunk):
+            time.sleep(0.2)
+            return get_cities(chunk)
+        with patch.object(self.store, 'get_cities', side_effect=slow_get_cities), \
+                patch('app.BATCH_DEADLINE', 0.05), self.assertLogs(app.app.logger, "WARNING"):
+            cities = tester.post('/api/cities/batch', json={"Names": names[:2]}).json
+        self.assertEqual(["Error", "Error"], [sorted(city)[0] for city in cities])
+
+    def test_health(self):
+        "Test the health check reports the load of every class of routes"
+        tester = app.app.test_client(self)
+        response = tester.get('/health')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual("ok", response.json["Status"])
+        self.assertEqual({"pages", "batch"}, set(response.json["Classes"]))
+        self.assertIn('admission_shed{class="batch"}', tester.get('/metrics').data.decode("utf-8"))
+        with patch.object(app.admission.limits["pages"], 'queue', 0), \
+                patch.object(app.admission.limits["pages"], 'active', 64):
+            response = tester.get('/city/Test-city-1')
+            self.assertEqual(503, response.status_code)
+            self.assertIn("Retry-After", response.headers)
+            self.assertEqual(200, tester.get('/health').status_code)
+            self.assertEqual("overloaded", tester.get('/health').json["Status"])
+            self.assertEqual(503, tester.get('/ready').status_code)
+
+    def test_catalogue_snapshot(self):
+        "Test pages are served from a snapshot without filling the catalogue cache"
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "catalogue.snap")
+            build_snapshot(self.store.list_cities(), path)
+            with patch('app.store', SnapshotStore(path, self.store)):
+                tester = app.app.test_client(self)
+                self.assertIn('Test-city-2', tester.get('/').data.decode('utf-8'))
+                response = tester.get('/city/Test-city-1')
+                self.assertEqual(200, response.status_code)
+                self.assertIn('This is also a review', response.data.decode('utf-8'))
+                self.assertIsNone(app.cities_cache.get(("page", None)))
+                self.assertIsNone(app.cities_cache.get(("city", "Test-city-1")))
+
+    def test_metrics(self):
+        "Test /metrics has the city route timings and the cache counters"
+        tester = app.app.test_client(self)
+        tester.get('/city/Test-city-1')
+        text = tester.get('/metrics').data.decode('utf-8')
+        self.assertIn('http_request_duration_seconds_count'
+                      '{route="/city/<name>",phase="total"}', text)
+        self.assertIn('http_request_duration_seconds_count'
+                      '{route="/city/<name>",phase="render"}', text)
+        self.assertIn('cache_hit_ratio{cache="pages"}', text)
+
     def test_city_detail_404(self):
         "Test empty results from the data store"
         # I'll finish this later
@@ -0,0 +1,91 @@
+"Unit tests for the fingerprinted static assets"
+import gzip
+import os
+import tempfile
+import unittest
+from flask import Flask, render_template_string
+from assets import ASSET_MAX_AGE, file_digest, init_assets
+from build_assets import build
+
+class AssetsTestCase(unittest.TestCase):
+    "Test Fixture"
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        os.makedirs(os.path.join(self.folder.name, "css"))
+        self.path = os.path.join(self.folder.name, "css", "style.css")
+        with open(self.path, "w", encoding="utf-8") as file:
+            file.write("body { color: red; }\n" * 50)
+        self.app = Flask(__name__, static_folder=self.folder.name, static_url_path="/static")
+        init_assets(self.app)
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def asset_url(self, filename):
+        "The URL the templates get for filename"
+        with self.app.test_request_context('/'):
+            return render_template_string("{{ asset_url(name) }}", name=filename)
+
+    def test_url_has_content_hash(self):
+        "Test the URL carries the file's hash and unknown files fall back to /static"
+        self.assertEqual(f"/assets/{file_digest(self.path)}/css/style.css",
+                         self.asset_url("css/style.css"))
+        self.assertEqual("/static/missing.css", self.asset_url("missing.css"))
+
+    def test_immutable_caching(self):
+        "Test the current version is cacheable for a year"
+        response = self.client.get(self.asset_url("css/style.css"))
+        self.assertEqual(200, response.status_code)
+        self.assertEqual("text/css", response.mimetype)
+        self.assertEqual(ASSET_MAX_AGE, response.cache_control.max_age)
+        self.assertTrue(response.cache_control.immutable)
+        self.assertTrue(response.cache_control.public)
+        self.assertFalse(response.cache_control.no_cache)
+        response.close()
+
+    def test_old_digest_not_pinned(self):
+        "Test an outdated hash gets the file without long caching"
+        response = self.client.get('/assets/000000000000/css/style.css')
+        self.assertEqual(200, response.status_code)
+        self.assertIsNone(response.cache_control.max_age)
+        self.assertTrue(response.cache_control.no_cache)
+        response.close()
+        self.assertEqual(404, self.client.get('/assets/000000000000/missing.css').status_code)
+
+    def test_precompressed(self):
+        "Test the built .gz file is sent to clients that accept gzip"
+        built = build(self.folder.name)
+        self.assertIn(".gz", built[self.path][1])
+        response = self.client.get(self.asset_url("css/style.css"),
+                                   headers={"Accept-Encoding": "gzip"})
+        self.assertEqual("gzip", response.headers["Content-Encoding"])
+        self.assertEqual("text/css", response.mimetype)
+        self.assertIn("Accept-Encoding", response.headers["Vary"])
+        self.assertEqual(b"body { color: red; }\n" * 50, gzip.decompress(response.data))
+        response.close()
+        plain = self.client.get(self.asset_url("css/style.css"))
+        self.assertNotIn("Content-Encoding", plain.headers)
+        plain.close()
+
+    def test_stale_precompressed(self):
+        "Test a copy of an older version is neither sent nor kept by the next build"
+        build(self.folder.name)
+        old = f"{self.path}.{file_digest(self.path)}.gz"
+        with open(self.path, "w", encoding="utf-8") as file:
+            file.write("body { color: blue; }\n" * 50)
+        app = Flask(__name__, static_folder=self.folder.name, static_url_path="/static")
+        init_assets(app)
+        with app.test_request_context('/'):
+            url = render_template_string("{{ asset_url('css/style.css') }}")
+        response = app.test_client().get(url, headers={"Accept-Encoding": "gzip"})
+        self.assertNotIn("Content-Encoding", response.headers)
+        self.assertEqual(b"body { color: blue; }\n" * 50, response.data)
+        response.close()
+        build(self.folder.name)
+        self.assertFalse(os.path.exists(old))
+        self.assertTrue(os.path.exists(f"{self.path}.{file_digest(self.path)}.gz"))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,26 @@
+"Unit tests for the benchmark helpers"
+import unittest
+from benchlib import compare_results, percentile, summarize
+
+class BenchlibTestCase(unittest.TestCase):
+    "Test Fixture"
+
+    def test_percentile(self):
+        "Test nearest-rank percentiles"
+        samples = list(range(1, 101))
+        self.assertEqual(50, percentile(samples, 50))
+        self.assertEqual(99, percentile(samples, 99))
+        self.assertEqual(0.0, percentile([], 50))
+
+    def test_compare_within_tolerance(self):
+        "Test small slowdowns are not regressions"
+        baseline = {"home": summarize([0.010] * 10, 0.1)}
+        results = {"home": summarize([0.011] * 10, 0.11)}
+        self.assertEqual([], compare_results(results, baseline, 0.25))
+
+    def test_compare_finds_regressions(self):
+        "Test a slower p95 and a lower throughput are both reported"
+        baseline = {"home": summarize([0.010] * 10, 0.1), "city": summarize([0.010] * 10, 0.1)}
+        regressions = compare_results({"home": summarize([0.020] * 10, 0.2)}, baseline, 0.25)
+        self.assertEqual(2, len(regressions))
+        self.assertTrue(all(line.startswith("home:") for line in regressions))
@@ -0,0 +1,166 @@
+"Unit tests for the bulk loader"
+import json
+import os
+import tempfile
+import threading
+import unittest
+from decimal import Decimal
+from unittest.mock import patch
+from boto3.dynamodb.types import TypeDeserializer
+import bulk_load
+
+class FakeDynamo:
+    "A DynamoDB client stand-in that leaves the last item of every other batch unprocessed"
+
+    def __init__(self, throttle=True):
+        self.tables = {}
+        self.calls = 0
+        self.biggest = 0
+        self.throttle = throttle
+        self._lock = threading.Lock()
+
+    # pylint: disable=invalid-name
+    def describe_table(self, TableName):
+        "The key schema of Cities or CityReviews"
+        keys = [{"AttributeName": "CityName", "KeyType": "HASH"}]
+        if TableName == "CityReviews":
+            keys.append({"AttributeName": "ReviewId", "KeyType": "RANGE"})
+        return {"Table": {"TableName": TableName, "KeySchema": keys}}
+
+    def batch_write_item(self, RequestItems):
+        "Store the items, maybe returning some as unprocessed"
+        deserializer = TypeDeserializer()
+        unprocessed = {}
+        with self._lock:
+            self.calls += 1
+            for table, requests in RequestItems.items():
+                self.biggest = max(self.biggest, len(requests))
+                if self.throttle and self.calls % 2 and len(requests) > 1:
+                    unprocessed[table], requests = requests[-1:], requests[:-1]
+                keys = [(request["PutRequest"]["Item"]["CityName"]["S"],
+                         request["PutRequest"]["Item"].get("ReviewId", {}).get("S"))
+                        for request in requests]
+                if len(set(keys)) < len(keys):
+                    raise ValueError("Provided list of item keys contains duplicates")
+                for request in requests:
+                    item = {name: deserializer.deserialize(value)
+                            for name, value in request["PutRequest"]["Item"].items()}
+                    key = (item["CityName"], item.get("ReviewId"))
+                    self.tables.setdefault(table, {})[key] = item
+        return {"UnprocessedItems": unprocessed}
+
+def make_reviews(count):
+    "Reviews spread over three cities"
+    return [{"CityName": f"City-{n % 3}", "ReviewId": f"{n:05d}",
+             "ReviewContent": f"Review {n}", "Stars": 1 + n % 5}
+            for n in range(count)]
+
+class BulkLoadTestCase(unittest.TestCase):
+    "Test Fixture"
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        backoff = patch.object(bulk_load, "backoff_delay", return_value=0)
+        backoff.start()
+        self.addCleanup(backoff.stop)
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def write_file(self, name, text):
+        "A file in the temporary folder"
+        path = os.path.join(self.folder.name, name)
+        with open(path, "w", encoding="utf-8") as file:
+            file.write(text)
+        return path
+
+    def test_read_jsonl_and_csv(self):
+        "Test both formats give the same items, with numbers as numbers"
+        jsonl = self.write_file(
+            "reviews.jsonl", "".join(json.dumps(r) + "\n" for r in make_reviews(3)) + "\n"
+        )
+        rows = "".join(f"{r['CityName']},{r['ReviewId']},{r['ReviewContent']},{r['Stars']}\n"
+                       for r in make_reviews(3))
+        csv_path = self.write_file("reviews.csv", "CityName,ReviewId,ReviewContent,Stars\n" + rows)
+        self.assertEqual(make_reviews(3), list(bulk_load.read_items(jsonl)))
+        self.assertEqual(make_reviews(3), list(bulk_load.read_items(csv_path)))
+        self.assertIsInstance(next(bulk_load.read_items(csv_path))["Stars"], Decimal)
+        with self.assertRaises(ValueError):
+            list(bulk_load.read_items(jsonl, "xml"))
+
+    def test_load_retries_unprocessed(self):
+        "Test every item arrives in batches of at most 25 despite unprocessed items"
+        client = FakeDynamo()
+        counts = bulk_load.bulk_load(client, "CityReviews", iter(make_reviews(1000)), workers=4,
+                                     counts=bulk_load.LoadCounts(interval=3600))
+        self.assertEqual(1000, len(client.tables["CityReviews"]))
+        self.assertEqual(1000, counts.items)
+        self.assertEqual(40, counts.batches)
+        self.assertGreater(counts.retries, 0)
+        self.assertEqual(bulk_load.BATCH_SIZE, client.biggest)
+
+    def test_gives_up(self):
+        "Test items that stay unprocessed fail the load"
+        client = FakeDynamo()
+        client.batch_write_item = lambda RequestItems: {"UnprocessedItems": RequestItems}
+        with self.assertRaises(RuntimeError):
+            bulk_load.bulk_load(client, "Cities", iter([{"CityName": "Paris"}]), workers=2)
+
+    def test_duplicate_keys(self):
+        "Test items with the same key in a batch are written once, the last one winning"
+        client = FakeDynamo(throttle=False)
+        reviews = make_reviews(3) + [dict(make_reviews(1)[0], ReviewContent="Edited")]
+        counts = bulk_load.bulk_load(client, "CityReviews", iter(reviews),
+                                     counts=bulk_load.LoadCounts(interval=3600))
+        self.assertEqual(3, counts.items)
+        self.assertEqual("Edited",
+                         client.tables["CityReviews"][("City-0", "00000")]["ReviewContent"])
+
+    def test_stops_after_first_error(self):
+        "Test batches still waiting when the first one fails are not written"
+        client = FakeDynamo(throttle=False)
+        write = client.batch_write_item
+        calls = []
+        #  pylint: disable=invalid-name
+        def batch_write_item(RequestItems):
+            calls.append(RequestItems)
+            if len(calls) == 1:
+                raise RuntimeError("boom")
+            return write(RequestItems)
+        client.batch_write_item = batch_write_item
+        with self.assertRaises(RuntimeError):
+            bulk_load.bulk_load(client, "CityReviews", iter(make_reviews(1000)), workers=1)
+        self.assertEqual(1, len(calls))
+        self.assertNotIn("CityReviews", client.tables)
+
+    def test_rate_limiter(self):
+        "Test the limiter spends a second's burst, then waits for capacity"
+        now = [0.0]
+        waits = []
+        def sleep(seconds):
+            waits.append(seconds)
+            now[0] += seconds
+        limiter = bulk_load.RateLimiter(100, clock=lambda: now[0], sleep=sleep)
+        limiter.acquire(100)
+        self.assertEqual([], waits)
+        limiter.acquire(50)
+        self.assertEqual([0.5], waits)
+        now[0] += 1.0
+        limiter.acquire(100)
+        self.assertEqual([0.5], waits)
+
+    def test_item_units(self):
+        "Test big items cost more than one unit"
+        self.assertEqual(1, bulk_load.item_units({"CityName": {"S": "Paris"}}))
+        self.assertEqual(3, bulk_load.item_units({"Itinerary": {"S": "x" * 2500}}))
+
+    def test_review_stats(self):
+        "Test the aggregates of the loaded reviews"
+        stats = {}
+        list(bulk_load.with_review_stats(make_reviews(30), stats))
+        self.assertEqual(10, stats["City-0"]["ReviewCount"])
+        self.assertEqual(sum(r["Stars"] for r in make_reviews(30) if r["CityName"] == "City-1"),
+                         stats["City-1"]["StarTotal"])
+
+if __name__ == '__main__':
+    unittest.main()
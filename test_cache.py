@@ -0,0 +1,158 @@
+"Unit tests for the in-process caches"
+import threading
+import time
+import unittest
+from cache import StreamCache, TTLCache
+
+class FakeClock:  # pylint: disable=too-few-public-methods
+    "A clock the tests can move forward"
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+class TTLCacheTestCase(unittest.TestCase):
+    "Test Fixture"
+
+    def test_hit_and_miss_counters(self):
+        "Test a second lookup is served from the cache"
+        cache = TTLCache(ttl=10)
+        self.assertEqual(1, cache.get_or_load("a", lambda: 1))
+        self.assertEqual(1, cache.get_or_load("a", lambda: 2))
+        self.assertEqual(1, cache.stats()["Hits"])
+        self.assertEqual(1, cache.stats()["Misses"])
+
+    def test_entries_expire(self):
+        "Test entries are reloaded once the TTL has passed"
+        clock = FakeClock()
+        cache = TTLCache(ttl=10, clock=clock)
+        cache.get_or_load("a", lambda: 1)
+        clock.now = 11
+        self.assertEqual(2, cache.get_or_load("a", lambda: 2))
+
+    def test_lru_eviction(self):
+        "Test the least recently used entry is evicted first"
+        cache = TTLCache(ttl=10, maxsize=2)
+        cache.get_or_load("a", lambda: 1)
+        cache.get_or_load("b", lambda: 2)
+        cache.get_or_load("a", lambda: 1)
+        cache.get_or_load("c", lambda: 3)
+        self.assertEqual(1, cache.stats()["Evictions"])
+        self.assertEqual(1, cache.get_or_load("a", lambda: 10))
+        self.assertEqual(20, cache.get_or_load("b", lambda: 20))
+
+    def test_invalidate(self):
+        "Test invalidated keys are loaded again"
+        cache = TTLCache(ttl=10)
+        cache.get_or_load("a", lambda: 1)
+        cache.get_or_load("b", lambda: 1)
+        cache.invalidate("a")
+        self.assertEqual(2, cache.get_or_load("a", lambda: 2))
+        cache.invalidate()
+        self.assertEqual(0, cache.stats()["Size"])
+
+    def test_single_flight(self):
+        "Test concurrent misses only call the loader once"
+        cache = TTLCache(ttl=10)
+        calls = []
+
+        def loader():
+            calls.append(1)
+            time.sleep(0.05)
+            return "value"
+
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(cache.get_or_load("a", loader)))
+            for _ in range(8)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(1, len(calls))
+        self.assertEqual(["value"] * 8, results)
+
+    def test_loader_errors_are_not_cached(self):
+        "Test a failing load is retried on the next lookup"
+        cache = TTLCache(ttl=10)
+
+        def failing():
+            raise RuntimeError("backend down")
+
+        with self.assertRaises(RuntimeError):
+            cache.get_or_load("a", failing)
+        self.assertEqual(1, cache.get_or_load("a", lambda: 1))
+
+class StreamCacheTestCase(unittest.TestCase):
+    "Test Fixture"
+
+    def test_finished_streams_are_replayed(self):
+        "Test a second request replays the chunks without calling the producer"
+        cache = StreamCache(ttl=10)
+        calls = []
+
+        def producer():
+            calls.append(1)
+            return iter(["a", "b"])
+
+        self.assertEqual(["a", "b"], list(cache.stream("key", producer)))
+        self.assertEqual(["a", "b"], list(cache.stream("key", producer)))
+        self.assertEqual(1, len(calls))
+        self.assertEqual(1, cache.stats()["Replays"])
+
+    def test_concurrent_requests_share_one_upstream(self):
+        "Test requests for a key that is still streaming follow the same upstream"
+        cache = StreamCache(ttl=10)
+        calls = []
+
+        def producer():
+            calls.append(1)
+            for chunk in ["a", "b", "c"]:
+                time.sleep(0.02)
+                yield chunk
+
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(list(cache.stream("key", producer))))
+            for _ in range(4)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(1, len(calls))
+        self.assertEqual([["a", "b", "c"]] * 4, results)
+        self.assertEqual(3, cache.stats()["Coalesced"])
+
+    def test_abandoned_stream_is_closed_and_not_cached(self):
+        "Test the upstream stops when its only reader disconnects"
+        cache = StreamCache(ttl=10)
+        closed = []
+
+        def producer():
+            try:
+                yield "a"
+                yield "b"
+            finally:
+                closed.append(1)
+
+        stream = cache.stream("key", producer)
+        self.assertEqual("a", next(stream))
+        stream.close()
+        self.assertEqual([1], closed)
+        self.assertEqual(0, cache.stats()["Size"])
+
+    def test_upstream_errors_are_not_cached(self):
+        "Test a failed generation is retried by the next request"
+        cache = StreamCache(ttl=10)
+
+        def failing():
+            yield "a"
+            raise RuntimeError("model error")
+
+        with self.assertRaises(RuntimeError):
+            list(cache.stream("key", failing))
+        self.assertEqual(["b"], list(cache.stream("key", lambda: iter(["b"]))))
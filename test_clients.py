@@ -0,0 +1,69 @@
+"Unit tests for the shared AWS clients"
+import os
+import threading
+import unittest
+from unittest.mock import MagicMock, patch
+from botocore.stub import Stubber
+import clients
+
+class ClientsTestCase(unittest.TestCase):
+    "Test Fixture"
+
+    def setUp(self):
+        "Start every test without clients, in a fixed region"
+        environ = patch.dict(os.environ, {"AWS_DEFAULT_REGION": "us-east-1"})
+        environ.start()
+        self.addCleanup(environ.stop)
+        clients.reset()
+        self.addCleanup(clients.reset)
+
+    def test_clients_are_shared(self):
+        "Test a client is built once and reused"
+        first = clients.client('dynamodb')
+        self.assertIs(first, clients.client('dynamodb'))
+        self.assertEqual(
+            clients.CLIENT_CONFIG.max_pool_connections,  # pylint: disable=no-member
+            first.meta.config.max_pool_connections
+        )
+        self.assertIs(clients.table('Cities'), clients.table('Cities'))
+
+    def test_resources_are_per_thread(self):
+        "Test each thread gets its own resource and Tables, and shares the client"
+        mine = (clients.resource('dynamodb'), clients.table('Cities'), clients.client('dynamodb'))
+        theirs = []
+        thread = threading.Thread(target=lambda: theirs.extend(
+            (clients.resource('dynamodb'), clients.table('Cities'), clients.client('dynamodb'))
+        ))
+        thread.start()
+        thread.join()
+        self.assertIs(mine[0], clients.resource('dynamodb'))
+        self.assertIsNot(mine[0], theirs[0])
+        self.assertIsNot(mine[1], theirs[1])
+        self.assertIs(mine[2], theirs[2])
+
+    def test_new_process_builds_new_clients(self):
+        "Test a forked worker does not reuse the parent's clients"
+        first = clients.client('dynamodb')
+        table = clients.table('Cities')
+        with patch('clients.os.getpid', return_value=-1):
+            self.assertIsNot(first, clients.client('dynamodb'))
+            self.assertIsNot(table, clients.table('Cities'))
+
+    def test_lazy_builds_on_first_use(self):
+        "Test a Lazy stand-in only calls its factory when used"
+        factory = MagicMock()
+        lazy = clients.Lazy(factory, 'Cities')
+        factory.assert_not_called()
+        lazy.scan()
+        factory.assert_called_once_with('Cities')
+        factory.return_value.scan.assert_called_once_with()
+
+    def test_aws_calls_are_timed(self):
+        "Test every AWS call is recorded as a backend call"
+        dynamodb = clients.client('dynamodb')
+        calls = clients.REGISTRY.backend_seconds.count('dynamodb', 'GetItem')
+        with Stubber(dynamodb) as stubber:
+            stubber.add_response('get_item', {},
+                                 {'TableName': 'Cities', 'Key': {'CityName': {'S': 'A'}}})
+            dynamodb.get_item(TableName='Cities', Key={'CityName': {'S': 'A'}})
+        self.assertEqual(calls + 1, clients.REGISTRY.backend_seconds.count('dynamodb', 'GetItem'))
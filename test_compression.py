@@ -0,0 +1,99 @@
+"Unit tests for response compression"
+import gzip
+import json
+import unittest
+import brotli
+from flask import Flask, Response, jsonify, request, stream_with_context
+from compression import compress_stream, init_compression  # pylint: disable=wrong-import-order
+
+def make_app():
+    "An app with a big page, a small page, a stream and a PNG"
+    app = Flask(__name__)
+    init_compression(app, min_size=100)
+
+    @app.route('/big')
+    def big():
+        response = Response("<p>hello</p>" * 100, mimetype="text/html")
+        response.set_etag("page")
+        return response.make_conditional(request)
+
+    @app.route('/small')
+    def small():
+        return jsonify(ok=True)
+
+    @app.route('/stream')
+    def stream():
+        return Response(stream_with_context(f"<li>{n}</li>" for n in range(2000)),
+                        mimetype="text/html")
+
+    @app.route('/image')
+    def image():
+        return Response(b"\x89PNG" * 100, mimetype="image/png")
+
+    return app
+
+class CompressionTestCase(unittest.TestCase):
+    "Test Fixture"
+
+    def setUp(self):
+        self.client = make_app().test_client()
+
+    def test_brotli_preferred(self):
+        "Test br wins when the client accepts both"
+        response = self.client.get('/big', headers={"Accept-Encoding": "gzip, br"})
+        self.assertEqual("br", response.headers["Content-Encoding"])
+        self.assertIn("Accept-Encoding", response.headers["Vary"])
+        self.assertEqual(b"<p>hello</p>" * 100, brotli.decompress(response.data))
+        self.assertEqual('"page-br"', response.headers["ETag"])
+
+    def test_gzip(self):
+        "Test gzip when br is not accepted"
+        response = self.client.get('/big', headers={"Accept-Encoding": "gzip"})
+        self.assertEqual("gzip", response.headers["Content-Encoding"])
+        self.assertEqual(b"<p>hello</p>" * 100, gzip.decompress(response.data))
+        self.assertEqual(len(response.data), int(response.headers["Content-Length"]))
+
+    def test_encoded_etag_revalidates(self):
+        "Test the ETag of a compressed page gives a 304 for that encoding only"
+        response = self.client.get(
+            '/big', headers={"Accept-Encoding": "br", "If-None-Match": '"page-br"'}
+        )
+        self.assertEqual(304, response.status_code)
+        self.assertEqual('"page-br"', response.headers["ETag"])
+        response = self.client.get(
+            '/big', headers={"Accept-Encoding": "gzip", "If-None-Match": '"page-br"'}
+        )
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('"page-gzip"', response.headers["ETag"])
+
+    def test_identity(self):
+        "Test nothing changes without Accept-Encoding"
+        response = self.client.get('/big')
+        self.assertNotIn("Content-Encoding", response.headers)
+        self.assertIn("Accept-Encoding", response.headers["Vary"])
+
+    def test_below_threshold_and_other_types(self):
+        "Test small bodies and images are sent as they are"
+        small = self.client.get('/small', headers={"Accept-Encoding": "gzip, br"})
+        self.assertNotIn("Content-Encoding", small.headers)
+        self.assertEqual({"ok": True}, json.loads(small.data))
+        image = self.client.get('/image', headers={"Accept-Encoding": "gzip, br"})
+        self.assertNotIn("Content-Encoding", image.headers)
+
+    def test_stream(self):
+        "Test streamed pages are compressed as they stream"
+        response = self.client.get('/stream', headers={"Accept-Encoding": "gzip"})
+        self.assertEqual("gzip", response.headers["Content-Encoding"])
+        self.assertNotIn("Content-Length", response.headers)
+        expected = "".join(f"<li>{n}</li>" for n in range(2000)).encode()
+        self.assertEqual(expected, gzip.decompress(response.data))
+
+    def test_compress_stream_flushes(self):
+        "Test each flush yields bytes the client can decode so far"
+        level = {"gzip": 6, "br": 5}
+        chunks = list(compress_stream(iter([b"a" * 9000, b"b" * 9000]), "br", level))
+        decompressor = brotli.Decompressor()
+        self.assertEqual(b"a" * 9000, decompressor.process(chunks[0]))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,283 @@
+"Unit tests for the knowledge base export"
+import json
+import os
+import tempfile
+import unittest
+from botocore.exceptions import ClientError
+import dbb_reviews_to_s3 as export
+
+def make_reviews(count):
+    "Reviews spread over two cities"
+    return [
+        {
+            "CityName": f"City-{n % 2}",
+            "ReviewId": str(n),
+            "ReviewContent": f"Review {n}",
+            "Stars": 1 + n % 5
+        }
+        for n in range(count)
+    ]
+
+class FakeTable:
+    "A reviews table that returns page_size items per scan page"
+
+    def __init__(self, items, page_size=3, fail_after=None):
+        self.items = items
+        self.page_size = page_size
+        self.fail_after = fail_after
+        self.item_count = len(items)
+        self.scans = 0
+
+    #  pylint: disable=invalid-name
+    def scan(self, ExclusiveStartKey=None, Segment=0, TotalSegments=1):
+        "Scan one page of this segment's items"
+        self.scans += 1
+        if self.fail_after is not None and self.scans > self.fail_after:
+            raise KeyboardInterrupt()
+        mine = [i for n, i in enumerate(self.items) if n % TotalSegments == Segment]
+        start = 0
+        if ExclusiveStartKey:
+            start = 1 + next(n for n, i in enumerate(mine)
+                             if i["ReviewId"] == ExclusiveStartKey["ReviewId"])
+        page = mine[start:start + self.page_size]
+        response = {"Items": page}
+        if start + self.page_size < len(mine):
+            response["LastEvaluatedKey"] = {
+                "CityName": page[-1]["CityName"], "ReviewId": page[-1]["ReviewId"]
+            }
+        return response
+
+    #  pylint: disable=invalid-name, unused-argument
+    def query(self, KeyConditionExpression, ProjectionExpression=None, ExclusiveStartKey=None):
+        "All the reviews of one city, in a single page"
+        city_name = KeyConditionExpression.get_expression()["values"][1]
+        return {"Items": [i for i in self.items if i["CityName"] == city_name]}
+
+class FakeS3:
+    "A local S3 stand-in that keeps objects in a dict"
+
+    def __init__(self):
+        self.objects = {}
+        self.puts = 0
+        self.uploads = {}
+
+    #  pylint: disable=invalid-name
+    def put_object(self, Body, Bucket, Key):
+        "Store an object"
+        self.puts += 1
+        self.objects[(Bucket, Key)] = Body
+
+    #  pylint: disable=invalid-name, unused-argument
+    def create_multipart_upload(self, Bucket, Key):
+        "Start a multipart upload"
+        upload_id = f"upload-{len(self.uploads)}"
+        self.uploads[upload_id] = []
+        return {"UploadId": upload_id}
+
+    #  pylint: disable=invalid-name, too-many-arguments, unused-argument
+    def upload_part(self, Body, Bucket, Key, PartNumber, UploadId):
+        "Store one part of a multipart upload"
+        self.uploads[UploadId].append((PartNumber, Body))
+        return {"ETag": f"etag-{PartNumber}"}
+
+    #  pylint: disable=invalid-name
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        "Join the parts into the object"
+        parts = dict(self.uploads.pop(UploadId))
+        numbers = [part["PartNumber"] for part in MultipartUpload["Parts"]]
+        self.objects[(Bucket, Key)] = b"".join(parts[number] for number in numbers)
+
+    #  pylint: disable=invalid-name
+    def list_objects_v2(self, Bucket, Prefix="", ContinuationToken=None):
+        "List keys under a prefix, two per page"
+        keys = sorted(key for bucket, key in self.objects
+                      if bucket == Bucket and key.startswith(Prefix))
+        start = int(ContinuationToken or 0)
+        response = {
+            "Contents": [{"Key": key} for key in keys[start:start + 2]],
+            "IsTruncated": start + 2 < len(keys)
+        }
+        if response["IsTruncated"]:
+            response["NextContinuationToken"] = str(start + 2)
+        return response
+
+    #  pylint: disable=invalid-name
+    def delete_objects(self, Bucket, Delete):
+        "Delete a batch of objects"
+        for item in Delete["Objects"]:
+            self.objects.pop((Bucket, item["Key"]), None)
+
+class FlakyS3(FakeS3):
+    "An S3 stand-in that throttles every other request"
+
+    #  pylint: disable=invalid-name
+    def put_object(self, Body, Bucket, Key):
+        "Throttle, then store the object on the retry"
+        self.puts += 1
+        if self.puts % 2:
+            raise ClientError({"Error": {"Code": "SlowDown"}}, "PutObject")
+        self.objects[(Bucket, Key)] = Body
+
+class ExportTestCase(unittest.TestCase):
+    "Test Fixture"
+
+    def test_export_follows_pages(self):
+        "Test every review and metadata file is uploaded across scan pages"
+        reviews = make_reviews(10)
+        s3 = FakeS3()
+        result = export.export_reviews(lambda: FakeTable(reviews), s3, "bucket")
+        self.assertEqual(10, result["Exported"])
+        self.assertEqual(20, len(s3.objects))
+        metadata = json.loads(s3.objects[("bucket", "City-1_3.txt.metadata.json")])
+        self.assertEqual({"City": "City-1", "Stars": 4}, metadata["metadataAttributes"])
+        self.assertEqual("Review 3", s3.objects[("bucket", "City-1_3.txt")])
+
+    def test_parallel_segments(self):
+        "Test a segmented scan exports every review once"
+        s3 = FakeS3()
+        result = export.export_reviews(lambda: FakeTable(make_reviews(11)), s3, "bucket",
+                                       segments=3)
+        self.assertEqual(11, result["Exported"])
+        self.assertEqual(22, s3.puts)
+
+    def test_resume_from_checkpoint(self):
+        "Test an interrupted export carries on from the last finished page"
+        reviews = make_reviews(10)
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "checkpoint.json")
+            s3 = FakeS3()
+            with self.assertRaises(KeyboardInterrupt):
+                export.export_reviews(
+                    lambda: FakeTable(reviews, fail_after=2), s3, "bucket",
+                    checkpoint=export.Checkpoint(path, 1)
+                )
+            self.assertEqual(12, s3.puts)
+            result = export.export_reviews(
+                lambda: FakeTable(reviews), s3, "bucket",
+                checkpoint=export.Checkpoint(path, 1)
+            )
+        self.assertEqual(10, result["Exported"])
+        self.assertEqual(20, s3.puts)
+        self.assertEqual(20, len(s3.objects))
+
+    def test_resume_from_checkpoint_without_run_id(self):
+        "Test a checkpoint written before run ids resumes as a new run"
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "checkpoint.json")
+            with open(path, "w", encoding="utf-8") as file:
+                json.dump({"TotalSegments": 1, "Exported": 4,
+                           "Segments": {"0": {"Cursor": None, "Done": False}}}, file)
+            checkpoint = export.Checkpoint(path, 1)
+        self.assertEqual(4, checkpoint.exported)
+        self.assertTrue(checkpoint.run_id)
+
+    def test_throttled_uploads_are_retried(self):
+        "Test throttled uploads are retried with backoff"
+        s3 = FlakyS3()
+        export.export_reviews(lambda: FakeTable(make_reviews(2)), s3, "bucket")
+        self.assertEqual(4, len(s3.objects))
+
+    def test_incremental_only_uploads_changes(self):
+        "Test an incremental run skips unchanged reviews and uploads changed ones"
+        reviews = make_reviews(6)
+        s3 = FakeS3()
+        manifest = export.Manifest(":memory:")
+        first = export.export_reviews(lambda: FakeTable(reviews), s3, "bucket", manifest=manifest)
+        self.assertEqual(6, first["Uploaded"])
+        reviews[2] = dict(reviews[2], ReviewContent="Edited")
+        reviews.append(
+            {"CityName": "City-0", "ReviewId": "new", "ReviewContent": "New", "Stars": 5}
+        )
+        puts = s3.puts
+        second = export.export_reviews(lambda: FakeTable(reviews), s3, "bucket", manifest=manifest)
+        self.assertEqual({"Exported": 7, "Uploaded": 2, "Skipped": 5, "Deleted": 0}, second)
+        self.assertEqual(puts + 4, s3.puts)
+        self.assertEqual("Edited", s3.objects[("bucket", "City-0_2.txt")])
+
+    def test_incremental_deletes_removed_reviews(self):
+        "Test removed reviews are deleted when asked to"
+        reviews = make_reviews(4)
+        s3 = FakeS3()
+        manifest = export.Manifest(":memory:")
+        export.export_reviews(lambda: FakeTable(reviews), s3, "bucket", manifest=manifest)
+        result = export.export_reviews(
+            lambda: FakeTable(reviews[1:]), s3, "bucket", manifest=manifest, delete_removed=True
+        )
+        self.assertEqual(1, result["Deleted"])
+        self.assertEqual(3, result["Skipped"])
+        self.assertNotIn(("bucket", "City-0_0.txt"), s3.objects)
+        self.assertNotIn(("bucket", "City-0_0.txt.metadata.json"), s3.objects)
+        self.assertEqual(6, len(s3.objects))
+
+    def test_bundles_per_city_and_stars(self):
+        "Test reviews are packed per city and star rating with matching metadata"
+        s3 = FakeS3()
+        result = export.export_bundles(
+            lambda: FakeTable(make_reviews(20)), s3, "bucket", ["City-0", "City-1"]
+        )
+        self.assertEqual({"Exported": 20, "Objects": 20, "Deleted": 0}, result)
+        bundle = s3.objects[("bucket", "City-1_2stars_0001.txt")]
+        self.assertEqual(b"Review 1\n\nReview 11", bundle)
+        metadata = json.loads(s3.objects[("bucket", "City-1_2stars_0001.txt.metadata.json")])
+        self.assertEqual({"City": "City-1", "Stars": 2}, metadata["metadataAttributes"])
+
+    def test_bundles_are_size_bounded_and_multipart(self):
+        "Test full bundles roll over and large ones are uploaded in parts"
+        reviews = [
+            {"CityName": "Big", "ReviewId": str(n), "ReviewContent": "x" * 40, "Stars": 5}
+            for n in range(5)
+        ]
+        s3 = FakeS3()
+        result = export.export_bundles(
+            lambda: FakeTable(reviews), s3, "bucket", ["Big"], bundle_bytes=100, part_size=32
+        )
+        self.assertEqual(6, result["Objects"])
+        self.assertEqual(82, len(s3.objects[("bucket", "Big_5stars_0001.txt")]))
+        self.assertEqual(40, len(s3.objects[("bucket", "Big_5stars_0003.txt")]))
+        self.assertEqual({}, s3.uploads)
+
+    def test_bundles_replace_older_objects(self):
+        "Test old bundles and per-review files of the city are deleted, other cities kept"
+        reviews = [{"CityName": "Big", "ReviewId": str(n), "ReviewContent": "x" * 40, "Stars": 5}
+                   for n in range(5)]
+        s3 = FakeS3()
+        for key in ("Big_0.txt", "Big_0.txt.metadata.json", "Big_Town_5stars_0001.txt",
+                    "Bigger_1.txt"):
+            s3.put_object(Body="old", Bucket="bucket", Key=key)
+        export.export_bundles(lambda: FakeTable(reviews), s3, "bucket", ["Big", "Big_Town"],
+                              bundle_bytes=100)
+        self.assertIn(("bucket", "Big_5stars_0003.txt"), s3.objects)
+        self.assertNotIn(("bucket", "Big_0.txt"), s3.objects)
+        self.assertIn(("bucket", "Bigger_1.txt"), s3.objects)
+        # Big_Town has no reviews left, so its old bundle goes, but not because of Big
+        self.assertNotIn(("bucket", "Big_Town_5stars_0001.txt"), s3.objects)
+        result = export.export_bundles(
+            lambda: FakeTable(reviews[:1]), s3, "bucket", ["Big"], bundle_bytes=100
+        )
+        self.assertEqual(4, result["Deleted"])
+        self.assertEqual(
+            ["Big_5stars_0001.txt", "Big_5stars_0001.txt.metadata.json", "Bigger_1.txt"],
+            sorted(key for _, key in s3.objects)
+        )
+
+    def test_bundles_resume_from_checkpoint(self):
+        "Test an interrupted bundle export skips the cities it finished"
+        reviews = make_reviews(10)
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "checkpoint.json")
+            checkpoint = export.BundleCheckpoint(path)
+            checkpoint.finish("City-0", 5, 10, 0)
+            s3 = FakeS3()
+            result = export.export_bundles(
+                lambda: FakeTable(reviews), s3, "bucket", ["City-0", "City-1"],
+                checkpoint=export.BundleCheckpoint(path)
+            )
+            self.assertEqual({"Exported": 10, "Objects": 20, "Deleted": 0}, result)
+            self.assertFalse(any(key.startswith("City-0") for _, key in s3.objects))
+            with self.assertRaises(ValueError):
+                export.Checkpoint(path, 1)
+
+    def test_unlisted_cities(self):
+        "Test cities with reviews but no Cities entry are found"
+        self.assertEqual(["Atlantis"],
+                         export.unlisted_cities(["Paris"], ["Paris", "Atlantis", "Atlantis"]))
@@ -0,0 +1,102 @@
+"Unit tests for the request metrics"
+import time
+import unittest
+from flask import Flask, render_template_string
+from metrics import HistogramMetric, Registry, current_route, instrument
+
+def make_app(registry, profile_token=None):
+    "A small app instrumented with registry"
+    app = Flask(__name__)
+    instrument(app, registry, profile_token=profile_token)
+
+    @app.route('/page/<name>')
+    def page(name):
+        registry.observe_backend("dynamodb", "Query", 0.002)
+        return render_template_string("Hello {{ name }}", name=name)
+
+    @app.route('/stream')
+    def stream():
+        def generate():
+            for word in ("slow", "stream"):
+                time.sleep(0.1)
+                yield word
+        return app.response_class(generate(), mimetype="text/plain")
+
+    @app.route('/slow')
+    def slow():
+        time.sleep(0.05)
+        return "done"
+
+    return app
+
+class MetricsTestCase(unittest.TestCase):
+    "Test Fixture"
+
+    def setUp(self):
+        "A fresh registry and app for every test"
+        self.registry = Registry()
+        self.tester = make_app(self.registry, profile_token="secret").test_client()
+
+    def test_histogram_buckets(self):
+        "Test observations land in cumulative buckets"
+        histogram = HistogramMetric("test_seconds", "Test", ("route",), buckets=(0.1, 1.0))
+        histogram.observe(0.05, "/")
+        histogram.observe(0.5, "/")
+        lines = list(histogram.render())
+        self.assertIn('test_seconds_bucket{route="/",le="0.1"} 1', lines)
+        self.assertIn('test_seconds_bucket{route="/",le="1.0"} 2', lines)
+        self.assertIn('test_seconds_bucket{route="/",le="+Inf"} 2', lines)
+        self.assertIn('test_seconds_count{route="/"} 2', lines)
+
+    def test_request_phases(self):
+        "Test a request records total, render and backend time against its route"
+        self.tester.get('/page/one')
+        seconds = self.registry.request_seconds
+        for phase in ("total", "render", "backend"):
+            self.assertEqual(1, seconds.count("/page/<name>", phase), phase)
+        self.assertEqual(1, self.registry.requests.value("/page/<name>", "GET", "200"))
+        self.assertEqual(0, self.registry.in_flight.value("/page/<name>"))
+        self.assertEqual("none", current_route.get())
+
+    def test_streamed_request(self):
+        "Test a streamed response is timed and in flight until its body is sent"
+        response = self.tester.get('/stream', buffered=False)
+        self.assertEqual(1, self.registry.in_flight.value("/stream"))
+        self.assertEqual(0, self.registry.request_seconds.count("/stream", "total"))
+        self.assertEqual(b"slowstream", response.get_data())
+        response.close()
+        self.assertEqual(0, self.registry.in_flight.value("/stream"))
+        self.assertEqual(1, self.registry.request_seconds.count("/stream", "total"))
+        self.assertIn('http_request_duration_seconds_bucket'
+                      '{route="/stream",phase="total",le="0.1"} 0', self.registry.render())
+
+    def test_metrics_endpoint(self):
+        "Test /metrics serves the Prometheus text format"
+        self.tester.get('/page/one')
+        response = self.tester.get('/metrics')
+        self.assertTrue(response.content_type.startswith('text/plain'))
+        text = response.data.decode('utf-8')
+        self.assertIn('# TYPE http_request_duration_seconds histogram', text)
+        self.assertIn('http_requests_total{route="/page/<name>",method="GET",status="200"} 1', text)
+        self.assertIn('backend_call_duration_seconds_count'
+                      '{backend="dynamodb",operation="Query"} 1', text)
+
+    def test_cache_gauges(self):
+        "Test cache stats are exported as gauges"
+        class FakeCache:  # pylint: disable=too-few-public-methods
+            "Cache stand-in"
+            def stats(self):
+                "Fixed counters"
+                return {"Hits": 3, "HitRatio": 0.75, "TTL": 300}
+        self.registry.add_caches({"cities": FakeCache()})
+        text = self.registry.render()
+        self.assertIn('cache_hits{cache="cities"} 3', text)
+        self.assertIn('cache_hit_ratio{cache="cities"} 0.75', text)
+        self.assertIn('cache_ttl{cache="cities"} 300', text)
+
+    def test_profile_header(self):
+        "Test the right X-Profile token returns sampled stacks instead of the body"
+        response = self.tester.get('/slow', headers={'X-Profile': 'secret'})
+        self.assertGreater(int(response.headers['X-Profile-Samples']), 0)
+        self.assertIn('slow (', response.data.decode('utf-8'))
+        self.assertEqual(b'done', self.tester.get('/slow', headers={'X-Profile': 'wrong'}).data)
@@ -0,0 +1,89 @@
+"Unit tests for the local review index"
+import os
+import tempfile
+import unittest
+from review_index import LatestReviewIndex, ReviewIndex, build_index
+
+REVIEWS = [
+    {"CityName": "Paris", "Stars": 5, "ReviewContent": "Wonderful croissants at the bakery"},
+    {"CityName": "Paris", "Stars": 2, "ReviewContent": "The museums were crowded"},
+    {"CityName": "Paris", "Stars": 4, "ReviewContent": "Great museums and a quiet park"},
+    {"CityName": "Lyon", "Stars": 3,
+     "ReviewContent": "Croissants were fine, the bouchons were better"},
+    {"CityName": "Lyon", "Stars": 5, "ReviewContent": "Éclairs and croissants everywhere"}
+]
+
+class ReviewIndexTestCase(unittest.TestCase):
+    "Test Fixture"
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.path = os.path.join(self.folder.name, "index")
+        build_index(REVIEWS, self.path)
+        self.index = ReviewIndex(self.path)
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_city_filter(self):
+        "Test results only come from the city asked about"
+        results = self.index.search("croissants", "Paris")
+        self.assertEqual(["Wonderful croissants at the bakery"],
+                         [r["ReviewContent"] for r in results])
+        self.assertEqual(5, results[0]["Stars"])
+        self.assertEqual(2, len(self.index.search("croissants", "Lyon")))
+        self.assertEqual([], self.index.search("croissants", "Rome"))
+
+    def test_stars_filter(self):
+        "Test the stars range narrows the results"
+        results = self.index.search("museums", "Paris", min_stars=3)
+        self.assertEqual(["Great museums and a quiet park"], [r["ReviewContent"] for r in results])
+        results = self.index.search("museums", "Paris", max_stars=2)
+        self.assertEqual(["The museums were crowded"], [r["ReviewContent"] for r in results])
+        self.assertEqual([], self.index.search("croissants", "Lyon", min_stars=4, max_stars=4))
+        results = self.index.search("museums croissants", "Paris", min_stars=0, max_stars=6)
+        self.assertEqual(3, len(results))
+        self.assertEqual([], self.index.search("museums", "Paris", min_stars=4, max_stars=3))
+
+    def test_best_first_across_cities(self):
+        "Test ranking, accent folding and k without a city"
+        results = self.index.search("eclairs croissants", k=2)
+        self.assertEqual("Éclairs and croissants everywhere", results[0]["ReviewContent"])
+        self.assertEqual(2, len(results))
+        self.assertGreaterEqual(results[0]["Score"], results[1]["Score"])
+
+    def test_batch_matches_single_queries(self):
+        "Test a batch of queries gives what the queries give one at a time"
+        queries = ["croissants", "museums", "quiet park", "nothing like this"]
+        self.assertEqual([self.index.search(q, "Paris") for q in queries],
+                         self.index.search_many(queries, "Paris"))
+
+    def test_rebuild_replaces(self):
+        "Test a rebuild switches the symlink and keeps only the previous build"
+        latest = LatestReviewIndex(self.path)
+        self.assertEqual(5, len(latest.current()))
+        first = os.path.realpath(self.path)
+        build_index(REVIEWS[:1], self.path)
+        second = os.path.realpath(self.path)
+        self.assertEqual(1, len(ReviewIndex(self.path)))
+        self.assertEqual(1, len(latest.current()))
+        self.assertEqual(5, len(self.index))
+        self.assertTrue(os.path.isdir(first))
+        build_index(REVIEWS[:2], self.path)
+        self.assertFalse(os.path.exists(first))
+        self.assertTrue(os.path.isdir(second))
+        self.assertEqual(2, len(latest.current()))
+
+    def test_rebuild_over_a_directory(self):
+        "Test an index built before the symlinks is replaced too"
+        path = os.path.join(self.folder.name, "plain")
+        build_index(REVIEWS, path)
+        os.replace(os.path.realpath(path), path + ".tmp")
+        os.remove(path)
+        os.replace(path + ".tmp", path)
+        build_index(REVIEWS[:1], path)
+        self.assertTrue(os.path.islink(path))
+        self.assertEqual(1, len(ReviewIndex(path)))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+"Unit tests for the city search index"
+import threading
+import unittest
+from search import CityIndex, normalize
+
+CITIES = [
+    {"Name": "Paris", "CountryName": "France"},
+    {"Name": "Parma", "CountryName": "Italy"},
+    {"Name": "São Paulo", "CountryName": "Brazil"},
+    {"Name": "Rio de Janeiro", "CountryName": "Brazil"}
+]
+
+class CityIndexTestCase(unittest.TestCase):
+    "Test Fixture"
+
+    def setUp(self):
+        "An index over the test cities"
+        self.index = CityIndex().ensure(lambda: CITIES)
+
+    def names(self, query, limit=10):
+        "Names of the cities found for query"
+        return [city["Name"] for city in self.index.search(query, limit)]
+
+    def test_normalize(self):
+        "Test accents, case and punctuation are ignored"
+        self.assertEqual("sao paulo", normalize("São-Paulo!"))
+
+    def test_prefix(self):
+        "Test city name prefixes match in name order"
+        self.assertEqual(["Paris", "Parma"], self.names("par"))
+        self.assertEqual(["São Paulo"], self.names("sao p"))
+        self.assertEqual(["Rio de Janeiro"], self.names("jan"))
+        self.assertEqual(["Paris"], self.names("par", limit=1))
+
+    def test_country(self):
+        "Test country prefixes match after city names"
+        self.assertEqual(["Rio de Janeiro", "São Paulo"], self.names("braz"))
+
+    def test_typos(self):
+        "Test near misses still find the city"
+        self.assertEqual("Paris", self.names("Pariss")[0])
+        self.assertIn("Rio de Janeiro", self.names("rio de janiero"))
+        self.assertEqual([], self.names("zzzz"))
+
+    def test_incremental_updates(self):
+        "Test cities can be added, changed and removed one at a time"
+        self.index.add({"Name": "Parintins", "CountryName": "Brazil"})
+        self.assertIn("Parintins", self.names("pari"))
+        self.index.add({"Name": "Parintins", "CountryName": "Peru"})
+        self.assertEqual(["Parintins"], self.names("peru"))
+        self.index.remove("Paris")
+        self.assertNotIn("Paris", self.names("pari"))
+        self.assertEqual(4, len(self.index))
+
+    def test_resync(self):
+        "Test a stale index catches up with the catalogue"
+        self.index.mark_stale()
+        self.index.ensure(lambda: CITIES[1:] + [{"Name": "Lyon", "CountryName": "France"}])
+        self.assertEqual(["Lyon"], self.names("fran"))
+        self.assertNotIn("Paris", self.names("paris"))
+
+    def test_searches_do_not_wait_for_a_resync(self):
+        "Test searches use the current index while another caller loads the catalogue"
+        loading = threading.Event()
+        release = threading.Event()
+
+        def slow_load():
+            loading.set()
+            release.wait(5)
+            return CITIES + [{"Name": "Lyon", "CountryName": "France"}]
+
+        self.index.mark_stale()
+        syncing = threading.Thread(target=self.index.ensure, args=(slow_load,))
+        syncing.start()
+        loading.wait(5)
+        self.assertEqual([], self.index.ensure(slow_load).search("lyon"))
+        release.set()
+        syncing.join()
+        self.assertEqual(["Lyon"], self.names("lyon"))
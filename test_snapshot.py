@@ -0,0 +1,111 @@
+"Unit tests for the catalogue snapshot"
+import os
+import tempfile
+import unittest
+from storage import MemoryStore
+from snapshot import CatalogueSnapshot, SnapshotStore, build_snapshot
+
+def make_city(name, country="France"):
+    "A city with non-ASCII text in every field"
+    return {
+        "Name": name,
+        "CountryCode": "FR",
+        "CountryName": country,
+        "TopThingsToDo": ["Musée", "Café"],
+        "Itinerary": "Jour un\nJour deux"
+    }
+
+CITIES = [make_city(name) for name in ("Paris", "Lyon", "Nîmes", "Annecy", "Caen")]
+
+class SnapshotTestCase(unittest.TestCase):
+    "Test Fixture"
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.addCleanup(self.folder.cleanup)
+        self.path = os.path.join(self.folder.name, "catalogue.snap")
+        build_snapshot(CITIES, self.path)
+
+    def test_lookup(self):
+        "Test every city is found by name with all its fields, and missing ones are not"
+        snapshot = CatalogueSnapshot(self.path)
+        self.assertEqual(5, len(snapshot))
+        for city in CITIES:
+            self.assertEqual(city, snapshot.get_city(city["Name"]))
+        self.assertIsNone(snapshot.get_city("Rome"))
+        self.assertIsNone(snapshot.get_city("paris"))
+
+    def test_matches_memory_store(self):
+        "Test listing and paging give what the other stores give"
+        store = MemoryStore()
+        store.add_cities(CITIES)
+        snapshot = CatalogueSnapshot(self.path)
+        self.assertEqual(list(store.list_cities()), list(snapshot.list_cities()))
+        cursor, expected_cursor = None, None
+        while True:
+            links, cursor = snapshot.cities_page(2, cursor)
+            expected, expected_cursor = store.cities_page(2, expected_cursor)
+            self.assertEqual(expected, links)
+            self.assertEqual(expected_cursor, cursor)
+            if cursor is None:
+                break
+
+    def test_empty(self):
+        "Test an empty catalogue"
+        build_snapshot([], self.path)
+        snapshot = CatalogueSnapshot(self.path)
+        self.assertIsNone(snapshot.get_city("Paris"))
+        self.assertEqual(([], None), snapshot.cities_page(10))
+
+    def test_not_a_snapshot(self):
+        "Test other files are refused"
+        with open(self.path, "wb") as file:
+            file.write(b"\0" * 64)
+        with self.assertRaises(ValueError):
+            CatalogueSnapshot(self.path)
+
+    def test_big_fields(self):
+        "Test fields longer than 64 KB round trip"
+        city = dict(make_city("Paris"), Itinerary="Jour " * 20000, TopThingsToDo=["Musée " * 20000])
+        build_snapshot([city], self.path)
+        self.assertEqual(city, CatalogueSnapshot(self.path).get_city("Paris"))
+
+    def test_unreadable_swap_keeps_the_old_map(self):
+        "Test a corrupt or truncated new file is logged once and the mapped one kept"
+        now = [0.0]
+        store = SnapshotStore(self.path, MemoryStore(), check_interval=5, clock=lambda: now[0])
+        for data in (b"\0" * 64, b"", b"CITYSNAP"):
+            with open(self.path + ".tmp", "wb") as file:
+                file.write(data)
+            os.replace(self.path + ".tmp", self.path)
+            now[0] += 5.0
+            with self.assertLogs("snapshot", "ERROR"):
+                self.assertEqual("Paris", store.get_city("Paris")["Name"])
+        now[0] += 5.0
+        with self.assertNoLogs("snapshot", "ERROR"):
+            self.assertEqual("Paris", store.get_city("Paris")["Name"])
+        build_snapshot([make_city("Rome", "Italy")], self.path)
+        now[0] += 5.0
+        self.assertEqual("Italy", store.get_city("Rome")["CountryName"])
+
+    def test_swap(self):
+        "Test a rebuilt snapshot is picked up once the check interval passes"
+        now = [0.0]
+        swaps = []
+        reviews = MemoryStore()
+        reviews.add_review("Paris", "r1", "Très bien", 5)
+        store = SnapshotStore(self.path, reviews, check_interval=5,
+                              on_swap=lambda: swaps.append(True), clock=lambda: now[0])
+        old = store.current()
+        build_snapshot(CITIES + [make_city("Rome", "Italy")], self.path)
+        self.assertIsNone(store.get_city("Rome"))
+        now[0] = 5.0
+        self.assertEqual("Italy", store.get_city("Rome")["CountryName"])
+        self.assertEqual([True], swaps)
+        # The old map stays readable for requests that already hold it
+        self.assertEqual("Paris", old.get_city("Paris")["Name"])
+        self.assertEqual(1, store.review_stats("Paris")["ReviewCount"])
+        now[0] = 10.0
+        store.get_city("Rome")
+        self.assertEqual([True], swaps)
+        self.assertFalse(os.path.exists(self.path + ".tmp"))
@@ -0,0 +1,92 @@
+"Unit tests for the app-simple state backends"
+import os
+import tempfile
+import threading
+import unittest
+from state import MemoryState, SqliteState
+
+class FakeClock:  # pylint: disable=too-few-public-methods
+    "A clock the tests move by hand"
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class StateTests(unittest.TestCase):
+    "Behaviour shared by the state backends, run by a subclass per backend"
+
+    def make_state(self):
+        "A new empty state, the in-process one unless a subclass says otherwise"
+        return MemoryState()
+
+    def setUp(self):
+        "A fresh state for every test"
+        self.state = self.make_state()
+
+    def test_todos_by_id(self):
+        "Test todos keep their ids when others are deleted"
+        first = self.state.add_todo("one")
+        second = self.state.add_todo("two")
+        self.assertNotEqual(first["id"], second["id"])
+        self.assertTrue(self.state.delete_todo(first["id"]))
+        self.assertFalse(self.state.delete_todo(first["id"]))
+        self.assertEqual([second], self.state.todos())
+
+    def test_concurrent_visits(self):
+        "Test no visit is lost when many threads count at once"
+        def visit():
+            for _ in range(250):
+                self.state.visit()
+        threads = [threading.Thread(target=visit) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(2000, self.state.visits())
+
+
+class MemoryStateTestCase(StateTests):
+    "Test the in-process state"
+
+
+class SqliteStateTestCase(StateTests):
+    "Test the shared SQLite state"
+
+    def make_state(self, **kwargs):
+        folder = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.addCleanup(folder.cleanup)
+        self.path = os.path.join(folder.name, "state.db")
+        return SqliteState(self.path, **kwargs)
+
+    def test_visits_are_batched(self):
+        "Test visits reach the database every flush_every visits or flush_interval seconds"
+        clock = FakeClock()
+        state = SqliteState(self.path, flush_every=3, flush_interval=10, clock=clock)
+        other_worker = SqliteState(self.path, clock=clock)
+        state.visit()
+        state.visit()
+        self.assertEqual(2, state.visits())
+        self.assertEqual(0, other_worker.visits())
+        state.visit()
+        other_worker.flush()
+        self.assertEqual(3, other_worker.visits())
+        state.visit()
+        clock.now = 11
+        state.visit()
+        other_worker.flush()
+        self.assertEqual(5, other_worker.visits())
+
+    def test_todos_are_shared(self):
+        "Test every worker sees the same todos"
+        other_worker = SqliteState(self.path)
+        todo = self.state.add_todo("shared")
+        self.assertEqual([todo], other_worker.todos())
+        other_worker.delete_todo(todo["id"])
+        self.assertEqual([], self.state.todos())
+
+
+# Only the subclasses run the shared tests
+del StateTests
@@ -0,0 +1,167 @@
+"Unit tests for the storage backends"
+import functools
+import unittest
+from unittest.mock import MagicMock, patch
+from botocore.exceptions import ClientError
+from storage import DynamoStore, MemoryStore, SqliteStore
+
+CITY = {
+    "Name": "Test-city-1",
+    "CountryCode": "TC1",
+    "CountryName": "TestCountry1",
+    "TopThingsToDo": ["Museum", "Harbour"],
+    "Itinerary": "Day one\nDay two"
+}
+
+class LocalStoreTests(unittest.TestCase):
+    "Behaviour shared by the local stores, run by a subclass per store"
+
+    # Makes a new empty store
+    store_factory = MemoryStore
+
+    def setUp(self):
+        "Start with three cities and three reviews"
+        self.store = self.store_factory()
+        self.store.add_cities([dict(CITY, Name=f"City-{n}") for n in (2, 0, 1)])
+        self.store.add_reviews([("City-0", f"r{n}", f"Review {n}", n + 3) for n in range(3)])
+
+    def test_cities_pages(self):
+        "Test city pages are ordered by name and chained by cursors"
+        first, cursor = self.store.cities_page(2)
+        self.assertEqual(["City-0", "City-1"], [city["Name"] for city in first])
+        second, cursor = self.store.cities_page(2, cursor)
+        self.assertEqual(["City-2"], [city["Name"] for city in second])
+        self.assertIsNone(cursor)
+
+    def test_get_city(self):
+        "Test a city round trips and a missing one is None"
+        self.assertEqual(dict(CITY, Name="City-1"), self.store.get_city("City-1"))
+        self.assertIsNone(self.store.get_city("Nowhere"))
+
+    def test_get_cities(self):
+        "Test many cities and aggregates are looked up at once"
+        cities = self.store.get_cities(["City-2", "Nowhere", "City-0"])
+        self.assertEqual(["City-0", "City-2"], sorted(cities))
+        self.assertEqual("City-2", self.store.get_cities(["City-2"])["City-2"]["Name"])
+        stats = self.store.review_stats_many(["City-0", "City-1"])
+        self.assertEqual(["City-0"], list(stats))
+        self.assertEqual(3, stats["City-0"]["ReviewCount"])
+
+    def test_reviews_pages(self):
+        "Test reviews come newest first, one page at a time"
+        first, cursor = self.store.reviews_page("City-0", 2)
+        self.assertEqual(["Review 2", "Review 1"], [review["ReviewContent"] for review in first])
+        second, cursor = self.store.reviews_page("City-0", 2, cursor)
+        self.assertEqual([{"ReviewContent": "Review 0", "Stars": 3}], second)
+        self.assertIsNone(cursor)
+
+    def test_review_stats(self):
+        "Test new reviews are folded into the aggregate"
+        self.store.add_review("City-0", "r3", "Review 3", 5)
+        stats = self.store.review_stats("City-0")
+        self.assertEqual(4, stats["ReviewCount"])
+        self.assertEqual(17, stats["StarTotal"])
+        self.assertEqual(2, stats["Stars5"])
+        self.store.rebuild_review_stats("City-0")
+        self.assertEqual(stats, self.store.review_stats("City-0"))
+        self.assertIsNone(self.store.review_stats("City-1"))
+
+    def test_duplicate_review(self):
+        "Test a review id can only be used once per city"
+        with self.assertRaises(ValueError):
+            self.store.add_review("City-0", "r1", "Again", 1)
+        self.assertEqual(3, self.store.review_stats("City-0")["ReviewCount"])
+
+
+class MemoryStoreTestCase(LocalStoreTests):
+    "Test the in-memory store"
+
+    store_factory = MemoryStore
+
+
+class SqliteStoreTestCase(LocalStoreTests):
+    "Test the SQLite store"
+
+    store_factory = functools.partial(SqliteStore, ":memory:")
+
+
+# Only the subclasses run the shared tests
+del LocalStoreTests
+
+
+class DynamoStoreTestCase(unittest.TestCase):
+    "Test the DynamoDB store against mocked tables"
+
+    def setUp(self):
+        "Give every table its own mock"
+        resource = MagicMock()
+        resource.Table.side_effect = lambda name: MagicMock(name=name)
+        self.store = DynamoStore(resource)
+
+    def test_list_cities_follows_last_evaluated_key(self):
+        "Test all pages of the Cities scan are read"
+        self.store.cities_table.scan.side_effect = [
+            {"Items": [{"CityName": "A", "CountryCode": "AA", "CountryName": "Aland",
+                        "TopThingsToDo": [], "Itinerary": ""}],
+             "LastEvaluatedKey": {"CityName": "A"}},
+            {"Items": [{"CityName": "B", "CountryCode": "BB", "CountryName": "Bland",
+                        "TopThingsToDo": [], "Itinerary": ""}]}
+        ]
+        self.assertEqual(["A", "B"], [city["Name"] for city in self.store.list_cities()])
+        self.assertEqual(
+            {"CityName": "A"},
+            self.store.cities_table.scan.call_args_list[1].kwargs["ExclusiveStartKey"]
+        )
+
+    def test_add_review_updates_stats(self):
+        "Test a new review and its ADD to the aggregate are written in one transaction"
+        self.store.add_review("Test-city-1", "r3", "Great", 4)
+        transact_write_items = self.store.resource.meta.client.transact_write_items
+        put, update = transact_write_items.call_args.kwargs["TransactItems"]
+        self.assertEqual("CityReviews", put["Put"]["TableName"])
+        self.assertEqual("attribute_not_exists(ReviewId)", put["Put"]["ConditionExpression"])
+        update = update["Update"]
+        self.assertEqual("CityReviewStats", update["TableName"])
+        self.assertEqual({'CityName': 'Test-city-1'}, update['Key'])
+        self.assertEqual({"#bucket": "Stars4"}, update['ExpressionAttributeNames'])
+        self.assertEqual({":count": 1, ":stars": 4}, update['ExpressionAttributeValues'])
+
+    def test_duplicate_review(self):
+        "Test a review id that already exists cancels the transaction"
+        self.store.resource.meta.client.transact_write_items.side_effect = ClientError({
+            "Error": {"Code": "TransactionCanceledException", "Message": "Cancelled"},
+            "CancellationReasons": [{"Code": "ConditionalCheckFailed"}, {"Code": "None"}]
+        }, "TransactWriteItems")
+        with self.assertRaises(ValueError):
+            self.store.add_review("Test-city-1", "r3", "Great", 4)
+
+    def test_review_stats_missing(self):
+        "Test a city without an aggregate has no stats"
+        self.store.stats_table.get_item.return_value = {}
+        self.assertIsNone(self.store.review_stats("Test-city-1"))
+
+    def test_get_cities_batches_and_retries(self):
+        "Test BatchGetItem is called 100 keys at a time and unprocessed keys are retried"
+        def batch_get_item(RequestItems):  # pylint: disable=invalid-name
+            keys = RequestItems["Cities"]["Keys"]
+            # The last key of every call comes back unprocessed once
+            deferred = [key for key in keys[-1:] if key["CityName"] not in pending]
+            pending.update(key["CityName"] for key in deferred)
+            done = [key for key in keys if key not in deferred]
+            items = [{"CityName": key["CityName"], "CountryCode": "AA", "CountryName": "Aland",
+                      "TopThingsToDo": [], "Itinerary": ""}
+                     for key in done if key["CityName"] != "Nowhere"]
+            unprocessed = [key for key in keys if key not in done]
+            return {"Responses": {"Cities": items},
+                    "UnprocessedKeys": {"Cities": {"Keys": unprocessed}} if unprocessed else {}}
+        pending = set()
+        self.store.resource.batch_get_item.side_effect = batch_get_item
+        names = [f"City-{n}" for n in range(150)] + ["Nowhere"]
+        with patch("storage.time.sleep") as sleep:
+            cities = self.store.get_cities(names + names[:3])
+        self.assertEqual(150, len(cities))
+        self.assertEqual("Aland", cities["City-149"]["CountryName"])
+        calls = self.store.resource.batch_get_item.call_args_list
+        self.assertEqual(100, len(calls[0].kwargs["RequestItems"]["Cities"]["Keys"]))
+        self.assertEqual(4, len(calls))
+        self.assertEqual(2, sleep.call_count)
@@ -0,0 +1,68 @@
+"Unit tests for the streaming helpers"
+import time
+import unittest
+from streaming import coalesce
+
+def paced(chunks, delay):
+    "Yield chunks with delay seconds before each one but the first"
+    for number, chunk in enumerate(chunks):
+        if number:
+            time.sleep(delay)
+        yield chunk
+
+class CoalesceTestCase(unittest.TestCase):
+    "Test Fixture"
+
+    def test_small_chunks_are_joined(self):
+        "Test the first chunk goes out at once and later ones once enough characters are buffered"
+        chunks = ["ab", "cd", "ef", "g"]
+        self.assertEqual(["ab", "cdef", "g"], list(coalesce(chunks, max_bytes=4, max_delay=60)))
+
+    def test_first_chunk_is_not_held(self):
+        "Test the first chunk is passed on before the second arrives"
+        stream = coalesce(paced(["a", "b"], 1.0), max_bytes=100, max_delay=5)
+        started = time.monotonic()
+        self.assertEqual("a", next(stream))
+        self.assertLess(time.monotonic() - started, 0.5)
+        stream.close()
+
+    def test_slow_chunks_are_flushed(self):
+        "Test buffered text is flushed once it has waited max_delay, before the next chunk arrives"
+        stream = coalesce(paced(["a", "b", "c"], 0.3), max_bytes=100, max_delay=0.05)
+        self.assertEqual("a", next(stream))
+        started = time.monotonic()
+        self.assertEqual("b", next(stream))
+        # b arrives after 0.3s and goes out 0.05s later, not when c arrives
+        self.assertLess(time.monotonic() - started, 0.5)
+        self.assertEqual(["c"], list(stream))
+
+    def test_upstream_errors_are_raised(self):
+        "Test an upstream failure reaches the reader"
+        def failing():
+            yield "a"
+            raise RuntimeError("Throttled")
+
+        stream = coalesce(failing())
+        self.assertEqual("a", next(stream))
+        with self.assertRaises(RuntimeError):
+            next(stream)
+
+    def test_closing_stops_upstream(self):
+        "Test a client disconnect closes the upstream generator"
+        closed = []
+
+        def upstream():
+            try:
+                while True:
+                    yield "x" * 10
+            finally:
+                closed.append(1)
+
+        stream = coalesce(upstream(), max_bytes=5)
+        next(stream)
+        stream.close()
+        for _ in range(100):
+            if closed:
+                break
+            time.sleep(0.01)
+        self.assertEqual([1], closed)
@@ -0,0 +1,33 @@
+"Unit tests for the shared Jinja setup"
+import posixpath
+import unittest
+from flask import Flask
+from templating import jinja_options, relative_path, relative_url
+
+class TemplatingTestCase(unittest.TestCase):
+    "Test Fixture"
+
+    def test_relative_path_matches_relpath(self):
+        "Test the fast paths give what posixpath.relpath gives"
+        cases = [
+            ("/city/Paris", "/"), ("/", "/"), ("/?page=abc", "/"),
+            ("/static/css/style.css", "/city"),
+            ("/city/Paris?reviews=abc", "/city"), ("/city/", "/city"), ("/city/../x", "/"),
+            ("/", "/city"), ("/static/js/app.js", "/city/Paris")
+        ]
+        for endpoint, start in cases:
+            self.assertEqual(posixpath.relpath(endpoint, start), relative_path(endpoint, start),
+                             endpoint)
+
+    def test_relative_url_in_request(self):
+        "Test the filter uses the request path"
+        app = Flask(__name__)
+        with app.test_request_context('/city/Paris'):
+            self.assertEqual("../static/css/style.css", relative_url("/static/css/style.css"))
+            self.assertEqual("Lyon", relative_url("/city/Lyon"))
+
+    def test_bytecode_cache(self):
+        "Test the Jinja options gain a bytecode cache"
+        app = Flask(__name__)
+        app.jinja_options = jinja_options(app)
+        self.assertIsNotNone(app.jinja_env.bytecode_cache)